@@ -27,10 +27,19 @@
 ################################################################################
 # IMPORT
 ################################################################################
-import OSPIUtility, logging, urllib2
+import OSPIUtility, logging, json
 from OSPIUtility import *
-from urllib import quote
-from urllib2 import URLError
+from OSPIAdjustmentPolicy import OSPIPolicySet
+from OSPIWeatherBatch import OSPIWeatherBatch
+from OSPISnapshotCache import OSPISnapshotCache
+from OSPISingleFlight import OSPISingleFlight
+from OSPIControllerHealth import OSPIControllerHealth
+from OSPIRequestScheduler import OSPIRequestScheduler
+from OSPICassette import OSPICassette
+from OSPIProgramTransaction import OSPIProgramTransaction
+from OSPIWateringPlan import OSPIWateringPlan
+from OSPIResponseCache import OSPIResponseCache
+from OSPIJobScheduler import OSPIJobScheduler
 
 ################################################################################
 # LOGGING
@@ -50,51 +59,118 @@ log.addHandler(logger1)
 def main():
 	"""main - runs the main script"""
 
-	# Read in the weather info
 	ors = OSPIReadSettings()
 	my_settings = ors.add_settings()
-	my_ospi_ip = my_settings['open_sprinkler_ip']
-	my_ospi_pass = my_settings['md5_pass']
-	owi = OSPIWeatherInformation()
-	owi.get_weather_information()
-	my_max_temp = owi.max_temp
-	log.debug("OSPIAdjustProgramData:main: Tomorrow's max temp will be {0}".format(my_max_temp))
-
-	# Get the sprinkler information 
-	opcs = OSPICheckStatus(my_ospi_ip,my_ospi_pass)
-	opcs.return_program_data()
-	my_program_data = opcs.program_data
-	log.debug("OSPIDefaultZoneInformation:return_default_zone_times: my_program_data {0}".format(my_program_data))
+	OSPIRequestScheduler.configure(my_settings)
+	OSPIResponseCache.configure(my_settings)
+	OSPIJobScheduler.configure(my_settings)
+	OSPICassette.from_settings(my_settings)
+	run_adjustments(my_settings, ors.return_controllers())
+
+def run_adjustments(settings, controllers, fleet=None):
+	"""run_adjustments - adjusts each of controllers (a OSPIShard worker passes just its own, and every controller as fleet), returns the names of the ones that went through"""
+	if fleet == None:
+		fleet = controllers
+
+	# Controllers that are known to be down are skipped until they're due a probe
+	my_controllers, my_dead = OSPIControllerHealth.split_fleet(settings, controllers)
+	for my_controller, och in my_dead:
+		print "OSPIAdjustProgramData: {0} is not answering (score {1}), skipping".format(my_controller['name'], och.score)
+
+	# Read in the weather info, one forecast request per grid cell of controllers
+	owb = OSPIWeatherBatch.from_settings(settings)
+	my_models = owb.fetch_all(my_controllers)
+
+	# Each controller's adjustment starts at its own spot in the schedule window
+	ojs = OSPIJobScheduler.from_settings(settings)
+	for my_controller in my_controllers:
+		ojs.add_job(my_controller['name'], "adjust", lambda my_controller=my_controller: adjust_controller(settings, my_controller, my_models.get(owb.controller_key(my_controller)), len(fleet) > 1))
+	ojs.run()
+	log.debug("OSPIAdjustProgramData:run_adjustments: response cache {0}".format(OSPIResponseCache.shared().report()))
+	return [my_job.controller for my_job in ojs.jobs if my_job.result == True]
+
+def adjust_controller(settings, controller, owm, fleet=False):
+	"""adjust_controller - adjusts one controller with the forecast shared by its grid cell, True when it went through"""
+
+	my_ospi_ip = controller['open_sprinkler_ip']
+	my_ospi_pass = controller['md5_pass']
+	my_forecast = None
+	if owm:
+		my_forecast = owm.forecast_for(1)
+	my_max_temp = None
+	if my_forecast:
+		my_max_temp = my_forecast["max_temp"]
+	log.debug("OSPIAdjustProgramData:adjust_controller: {0} tomorrow's max temp will be {1}".format(controller.get('name'), my_max_temp))
 
 	# Can't connect to weather service?
 	if my_max_temp == None:
-		print "OSPIAdjustProgramData could not communicate with the Weather Service. Quitting"
-		log.debug("OSPIAdjustProgramData:main: Weather service could not be reached, quitting")
-		sys.exit(0)
-
-	# These are my own personal values, feel free to make this as fancy as you want
-	if my_max_temp >= 80 and my_max_temp <= 95:
-		my_percentage = .15
-		adjust_water_duration(my_program_data, my_percentage, 1)
-		send_weather_change_notification(my_max_temp, my_percentage)
-	elif my_max_temp > 95:
-		my_percentage = .30
-		adjust_water_duration(my_program_data, my_percentage, 1)
-		send_weather_change_notification(my_max_temp, my_percentage)
-		
-	# Weather is normal, no adjustment needed
+		print "OSPIAdjustProgramData could not communicate with the Weather Service for {0}. Skipping".format(controller.get('name'))
+		log.debug("OSPIAdjustProgramData:adjust_controller: Weather service could not be reached, skipping {0}".format(controller.get('name')))
+		return False
+
+	# The programs are read fresh, they're what we roll back to if the changes don't go in
+	osf = OSPISingleFlight.from_settings(settings)
+	och = OSPIControllerHealth.from_settings(settings, controller.get('name'))
+	opt = OSPIProgramTransaction.from_settings(settings, controller, och)
+	my_program_data = opt.begin()
+	log.debug("OSPIDefaultZoneInformation:return_default_zone_times: my_program_data {0}".format(my_program_data))
+
+	# Can't connect to the controller?
+	if not my_program_data:
+		print "OSPIAdjustProgramData could not get the programs from {0}. Skipping".format(controller.get('name'))
+		log.error("OSPIAdjustProgramData:adjust_controller: no program data from {0}, skipping".format(controller.get('name')))
+		return False
+
+	# The station names come from the snapshot when nothing has changed, the programs just read are checked against it
+	opcs = OSPICheckStatus(my_ospi_ip,my_ospi_pass,osf,och,settings.get('query_timeout', QUERY_TIMEOUT))
+	ossc = OSPISnapshotCache.from_settings(settings, controller.get('name'))
+	ossc.warm_start(opcs, opt.snapshot)
+
+	# Either scale by the ET water budget, or by the adjustment policies in the settings.
+	# Feel free to make the policies as fancy as you want
+	# From the answer rather than the copy, so the zone times are only worked out once for each /jp
+	my_zone_count = len(OSPIDefaultZoneInformation().return_default_zone_times(opt.snapshot))
+	if settings.get('weather_model') == "water_budget":
+		my_crop_coefficients = controller.get('crop_coefficients', settings.get('crop_coefficients'))
+		my_baseline_et = settings.get('baseline_et', 5.0)
+		my_zone_scales = owm.zone_water_budget(my_zone_count, my_crop_coefficients, my_baseline_et)
+		my_scale = owm.zone_water_budget(1, None, my_baseline_et)[0]
+	else:
+		opps = OSPIPolicySet.from_settings(settings)
+		my_zone_scales = opps.zone_scales(my_forecast, my_zone_count)
+		my_scale = opps.default_scale(my_forecast)
+
+	# Longer runs get moved around so they still fit in the watering window
+	owp = OSPIWateringPlan.from_settings(settings, controller)
+	if owp:
+		owp.configure(settings, controller.get('name'), opcs.station_names, my_zone_count)
+
+	# When the weather is normal the scales are all 1.0, and the zones go back to default values
+	if not adjust_water_duration(opt, my_program_data, my_zone_scales, osf, owp):
+		print "OSPIAdjustProgramData could not adjust {0}, the programs were put back. Skipping".format(controller.get('name'))
+		ossc.invalidate()
+		return False
+
+	if owp and not owp.fits():
+		print "OSPIAdjustProgramData: {0} needs {1} minutes to water, the window is {2}".format(controller.get('name'), owp.makespan // 60, owp.window_minutes)
+
+	# Keep the programs we just checked for the next run
+	if opt.verified and opcs.controller_values and opcs.station_names:
+		ossc.save(ossc.fingerprint(opcs.controller_values), opcs.station_names, opt.verified, opcs.controller_options)
+	else:
+		ossc.invalidate()
+	if my_scale != 1.0:
+		send_weather_change_notification(my_max_temp, my_scale, controller.get('name') if fleet else None)
 	else:
-		# Make sure the zones are set to default values
-		adjust_water_duration(my_program_data, 0, None, None, 1)
-		log.debug("OSPIAdjustProgramData:main: Tomorrow's max temp will be {0}, no adjustment made".format(my_max_temp))
+		log.debug("OSPIAdjustProgramData:adjust_controller: Tomorrow's max temp will be {0}, no adjustment made".format(my_max_temp))
+	return True
 
-def send_weather_change_notification(max_temp, percentage):
+def send_weather_change_notification(max_temp, scale, controller=None):
 	"""send_weather_change_notification - email a notification about adjustment"""
 
 	# Send a notification that we've adjusted the water duration
 	cno = CreateNotificationObject()
 	cno.create_header()
-	my_percentage = None
 	ors = OSPIReadSettings()
 	my_settings = ors.add_settings()
 	my_ospi_email = my_settings['email_login_user']
@@ -104,14 +180,10 @@ def send_weather_change_notification(max_temp, percentage):
 
 	# Send a EMAIL every day with the log
 	osem = OSPIEmail(my_ospi_email,my_ospi_email_pass,my_ospi_email_from,my_ospi_email_to)
-	my_tmp_percentage = str(percentage)
-	my_tp_percentage = my_tmp_percentage[2:]
-	# Fix percentage
-	if len(my_tp_percentage) == 1:
-		my_percentage = "{0}0".format(my_tp_percentage)
-	else:
-		my_percentage = my_tp_percentage
+	my_percentage = int(round((scale - 1.0) * 100))
 	my_subject = "Watering Adjustment Notification"
+	if controller:
+		my_subject = "{0} - {1}".format(my_subject, controller)
 	my_add_to_body = """
 		<p>Weather adjustment made.</br>
 		Temperature tomorrow will be {0}.</br>
@@ -123,46 +195,21 @@ def send_weather_change_notification(max_temp, percentage):
 	log.debug("send_weather_change_notification: sending email notification {0}".format(my_body))
 	osem.send_email_message(my_subject,my_body)
 
-def adjust_water_duration(program_data, percentage, positive=None, negative=None, default=None):
-	"""adjust_water_duration - calls the OSPI module and adjusts value postive or negative"""
+def adjust_water_duration(opt, program_data, zone_scales, single_flight=None, plan=None):
+	"""adjust_water_duration - scales each zone by its policy, fits the start times to the plan, and writes the programs as one transaction"""
 
-	ors = OSPIReadSettings()
-	my_settings = ors.add_settings()
-	my_ospi_ip = my_settings['open_sprinkler_ip']
-	my_ospi_pass = my_settings['md5_pass']
-	my_adjustment_prefix = "{0}/cp?pw={1}".format(my_ospi_ip,my_ospi_pass)
-	my_adjustment = None
 	owa = OSPIWaterAdjustment(program_data)
-
-	if default:
-		my_adjustment_list = owa.adjust_duration_default()
-	elif positive:
-		my_adjustment_list = owa.adjust_duration_positive(percentage)
-	elif negative:
-		my_adjustment_list = owa.adjust_duration_negative(percentage)
-
-	my_count = 0
-	for my_adjustment in my_adjustment_list:
-		my_program_name = my_adjustment[-1]
-		my_adjustment = my_adjustment[:-1]
-		my_encoded_name = quote(my_program_name)
-		my_tmp_adjustment = "{0}&pid={1}&v={2}&name={3}".format(my_adjustment_prefix,my_count,my_adjustment,my_encoded_name)
-		my_adjustment = "".join(my_tmp_adjustment.split())
-		my_count += 1
-		log.debug("adjust_water_duration: my_adjustment {0}".format(my_adjustment))
-
-		# Run command for each adjustment
-		run_adjustment(my_adjustment)
-
-def run_adjustment(ospi_cmd):
-	"""run_adjustment - takes the OSPI command and runs it"""
-
-	# Execute the command for adjusting the water duration based on the temp.
-	try:
-		fh = urllib2.urlopen(ospi_cmd)
-		my_result = fh.read()
-		log.debug("run_adjustment: urllib returned {0}".format(my_result))
-	except HTTPError, e:
-		log.debug("run_adjustment: {0}".format(e))
-
-main()
+	owa.adjust_duration_scaled(zone_scales)
+	if plan:
+		plan.schedule(program_data)
+	my_pids = opt.update(program_data)
+	log.debug("adjust_water_duration: programs to change {0}".format(my_pids))
+
+	# A overlapping run making the same change shares the transaction
+	if single_flight and my_pids:
+		my_key = "{0}/cp?{1}".format(opt.station_address, json.dumps([[my_pid, opt.writes[my_pid]] for my_pid in my_pids]))
+		return single_flight.run(my_key, opt.commit)
+	return opt.commit()
+
+if __name__ == "__main__":
+	main()
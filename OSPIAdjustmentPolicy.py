@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPIAdjustmentPolicy.py
+
+	DESCRIPTION:
+	Adjustment policies that map forecast inputs (max temp, humidity, rain
+	and evapotranspiration) to a watering scale factor for each zone.
+
+	NOTES:
+	A policy is a set of curves, one per forecast input. A curve is either
+	a step ladder ("steps": [[lower_bound, factor], ...]) or a piecewise
+	linear curve ("points": [[x, factor], ...]). Curves are compiled into
+	lookup tables when the policy is loaded, so evaluating a policy is a
+	table lookup per input and the factors are multiplied together.
+
+	"adjustment_policies" : {
+		"default" : {
+			"max_temp" : {"steps" : [[80, 1.15], [96, 1.30]]}
+		}
+	},
+	"zone_policies" : {"3" : "shade"}
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import logging, math
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospiadjustmentpolicy')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospiadjustmentpolicy.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CONSTANTS
+################################################################################
+# Table resolution for each forecast input, in the input's own units
+POLICY_RESOLUTION = {
+	"max_temp" : 1.0,	# degrees fahrenheit
+	"humidity" : 1.0,	# percent
+	"rain" : 0.1,		# millimeters
+	"et" : 0.1,		# millimeters per day
+}
+
+# My original temperature ladder, used when the settings don't define any policies
+DEFAULT_POLICIES = {
+	"default" : {
+		"max_temp" : {"steps" : [[80, 1.15], [96, 1.30]]}
+	}
+}
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPIAdjustmentPolicy(object):
+	"""OSPIAdjustmentPolicy - a compiled policy that turns a forecast into a scale factor"""
+
+	def __init__(self, name, curves, limits=None):
+		self.name = name
+		self.curves = curves
+		self.limits = limits or [0.0, 2.0]
+		self._tables = {}
+		self.compile_policy()
+
+	def compile_policy(self):
+		# Each curve becomes (lower bound, step, value below the bound, table of factors)
+		for my_input, my_curve in self.curves.iteritems():
+			my_step = float(my_curve.get("resolution", POLICY_RESOLUTION.get(my_input, 1.0)))
+			if "steps" in my_curve:
+				my_points = sorted(my_curve["steps"])
+				my_below = float(my_curve.get("below", 1.0))
+			else:
+				my_points = sorted(my_curve["points"])
+				my_below = float(my_points[0][1])
+
+			my_low = float(my_points[0][0])
+			my_high = float(my_points[-1][0])
+			my_size = int(round((my_high - my_low) / my_step)) + 1
+			my_table = []
+			for my_index in xrange(my_size):
+				my_x = my_low + (my_index * my_step)
+				if "steps" in my_curve:
+					my_table.append(self.step_value(my_points, my_x, my_below))
+				else:
+					my_table.append(self.linear_value(my_points, my_x))
+
+			self._tables[my_input] = (my_low, my_step, my_below, my_table)
+			log.debug("OSPIAdjustmentPolicy:compile_policy: {0} {1} compiled to {2} entries".format(self.name, my_input, my_size))
+
+	@staticmethod
+	def step_value(points, x, below):
+		my_value = below
+		for my_bound, my_factor in points:
+			if x >= my_bound:
+				my_value = float(my_factor)
+		return my_value
+
+	@staticmethod
+	def linear_value(points, x):
+		for my_count in xrange(1, len(points)):
+			my_x0, my_y0 = points[my_count - 1]
+			my_x1, my_y1 = points[my_count]
+			if x <= my_x1:
+				if my_x1 == my_x0:
+					return float(my_y1)
+				return my_y0 + ((x - my_x0) * (my_y1 - my_y0) / float(my_x1 - my_x0))
+		return float(points[-1][1])
+
+	def factor_for(self, my_input, value):
+		my_low, my_step, my_below, my_table = self._tables[my_input]
+		if value < my_low:
+			return my_below
+		my_index = int(math.floor(((value - my_low) / my_step) + 1e-9))
+		if my_index >= len(my_table):
+			return my_table[-1]
+		return my_table[my_index]
+
+	def scale_for(self, forecast):
+		# Inputs missing from the forecast don't change the scale
+		my_scale = 1.0
+		for my_input in self._tables:
+			my_value = forecast.get(my_input)
+			if my_value != None:
+				my_scale *= self.factor_for(my_input, my_value)
+		my_scale = min(max(my_scale, self.limits[0]), self.limits[1])
+		log.debug("OSPIAdjustmentPolicy:scale_for: {0} forecast {1} scale {2}".format(self.name, forecast, my_scale))
+		return my_scale
+
+class OSPIPolicySet(object):
+	"""OSPIPolicySet - the compiled policies and which zones use them"""
+
+	def __init__(self, policies, zone_policies=None, default="default"):
+		self.policies = {}
+		for my_name, my_curves in policies.iteritems():
+			my_curves = dict(my_curves)
+			my_limits = my_curves.pop("limits", None)
+			self.policies[my_name] = OSPIAdjustmentPolicy(my_name, my_curves, my_limits)
+		self.zone_policies = {}
+		for my_zone, my_name in (zone_policies or {}).iteritems():
+			self.zone_policies[int(my_zone)] = my_name
+		self.default = default
+
+	@classmethod
+	def from_settings(cls, settings):
+		return cls(settings.get("adjustment_policies", DEFAULT_POLICIES), settings.get("zone_policies"))
+
+	def default_scale(self, forecast):
+		return self.policies[self.default].scale_for(forecast)
+
+	def zone_scales(self, forecast, zone_count):
+		# Every policy is evaluated once, then zones just pick up their policy's scale
+		my_scales = {}
+		for my_name, my_policy in self.policies.iteritems():
+			my_scales[my_name] = my_policy.scale_for(forecast)
+
+		my_default_scale = my_scales[self.default]
+		my_zone_scales = [my_default_scale] * zone_count
+		for my_zone, my_name in self.zone_policies.iteritems():
+			if my_zone < zone_count:
+				my_zone_scales[my_zone] = my_scales.get(my_name, my_default_scale)
+
+		log.debug("OSPIPolicySet:zone_scales: {0}".format(my_zone_scales))
+		return my_zone_scales
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPICassette.py
+
+	DESCRIPTION:
+	Record every exchange with the controllers and the weather service
+	to a cassette file, and play it back later with no network. A real
+	day can be run again on any box, as many times as we like, without
+	watering anything or sending any email.
+
+	NOTES:
+	"cassette_mode" : "record" or "replay" (null for neither)
+	"cassette_path" : "/tmp/ospi.cassette"
+	"cassette_speed" : 1.0 (0 answers right away, 0.5 twice as fast)
+
+	The passwords (pw=) and api keys (appid=) are scrubbed out of the
+	urls before they're written. The cassette is gzipped JSON, each
+	body is kept once however many times it was answered.
+
+	A replay answers each url with what was recorded for it, in the
+	order it was recorded (the last answer is repeated once they run
+	out), after the recorded time scaled by "cassette_speed". Errors
+	(timeouts, refused connections) are replayed too. A url that was
+	never recorded is a URLError, like a controller that's down.
+
+	Point the snapshot, health, flight and weather cache dirs somewhere
+	empty for a replay, or they'll answer before the cassette does.
+
+	pyowm makes its own requests, so only OSPIWeatherBatch's forecasts
+	are on the cassette.
+
+	python OSPICassette.py <cassette>
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import os, sys, logging, json, gzip, time, re, hashlib, threading, atexit, fcntl, socket, httplib, urllib2
+from OSPIUtility import OSPITransport
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospicassette')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospicassette.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CONSTANTS
+################################################################################
+CASSETTE_VERSION = 1
+
+# Anything secret in a url
+CASSETTE_SCRUB = re.compile(r'([?&](?:pw|appid)=)[^&]*', re.IGNORECASE)
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPICassette(object):
+	"""OSPICassette - a OSPITransport that records the exchanges, or replays them"""
+
+	def __init__(self, path, mode="replay", speed=1.0):
+		self.path = path
+		self.mode = mode
+		self.speed = speed
+		self.offline = mode == "replay"
+		self.bodies = {}
+		self.exchanges = []
+		self.hits = 0
+		self.misses = 0
+		self._answers = {}
+		self._positions = {}
+		self._lock = threading.Lock()
+		if self.offline:
+			self.load()
+
+	@classmethod
+	def from_settings(cls, settings):
+		"""from_settings - installs a cassette when "cassette_mode" is set, returns it (or None)"""
+		my_mode = settings.get('cassette_mode')
+		if not my_mode:
+			return None
+		occ = cls(settings.get('cassette_path', "/tmp/ospi.cassette"), my_mode, settings.get('cassette_speed', 1.0))
+		occ.install()
+		return occ
+
+	################################################################################
+	# FUNCTIONS
+	################################################################################
+	@staticmethod
+	def scrub(url):
+		return CASSETTE_SCRUB.sub(r'\1*', url)
+
+	def install(self):
+		OSPITransport.install(self)
+		if self.mode == "record":
+			atexit.register(self.save)
+		log.debug("OSPICassette:install: {0} {1}".format(self.mode, self.path))
+
+	def exchange(self, url, call):
+		if self.offline:
+			return self.replay(url)
+		return self.record(url, call)
+
+	def record(self, url, call):
+		my_start = time.time()
+		try:
+			my_status, my_body = call()
+		except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+			self.add(url, my_start, None, None, e)
+			raise
+		self.add(url, my_start, my_status, my_body, None)
+		return my_status, my_body
+
+	def add(self, url, start, status, body, error):
+		my_elapsed = round(time.time() - start, 4)
+		my_body_key = None
+		if body != None:
+			my_body_key = hashlib.md5(body).hexdigest()[:16]
+		my_error = None
+		if error != None:
+			if isinstance(error, socket.timeout) or "timed out" in str(error):
+				my_error = ["timeout", str(error)]
+			elif isinstance(error, urllib2.URLError):
+				my_error = ["url", str(error.reason)]
+			elif isinstance(error, httplib.HTTPException):
+				my_error = ["http", str(error)]
+			else:
+				my_error = ["socket", str(error)]
+		with self._lock:
+			if my_body_key != None:
+				self.bodies[my_body_key] = body.decode('latin-1')
+			self.exchanges.append([round(start, 3), self.scrub(url), status, my_elapsed, my_body_key, my_error])
+
+	def replay(self, url):
+		my_url = self.scrub(url)
+		with self._lock:
+			my_answers = self._answers.get(my_url)
+			if not my_answers:
+				self.misses += 1
+				log.error("OSPICassette:replay: {0} is not on the cassette".format(my_url))
+				raise urllib2.URLError("{0} is not on the cassette".format(my_url))
+			my_position = self._positions.get(my_url, 0)
+			self._positions[my_url] = my_position + 1
+			self.hits += 1
+		my_start, my_url, my_status, my_elapsed, my_body_key, my_error = my_answers[min(my_position, len(my_answers) - 1)]
+
+		if self.speed > 0 and my_elapsed > 0:
+			time.sleep(my_elapsed * self.speed)
+		if my_error != None:
+			my_type, my_message = my_error
+			if my_type == "timeout":
+				raise socket.timeout(my_message)
+			if my_type == "url":
+				raise urllib2.URLError(my_message)
+			if my_type == "http":
+				raise httplib.HTTPException(my_message)
+			raise socket.error(my_message)
+		return my_status, self.bodies[my_body_key].encode('latin-1')
+
+	def read_file(self, my_file):
+		my_cassette = json.loads(gzip.GzipFile(fileobj=my_file, mode='rb').read())
+		if my_cassette.get("version") != CASSETTE_VERSION:
+			raise ValueError("{0} is not a cassette we know".format(self.path))
+		return my_cassette
+
+	def load(self):
+		my_file = open(self.path, 'rb')
+		try:
+			my_cassette = self.read_file(my_file)
+		finally:
+			my_file.close()
+		self.bodies = my_cassette["bodies"]
+		self.exchanges = sorted(my_cassette["exchanges"])
+		self._answers = {}
+		for my_exchange in self.exchanges:
+			self._answers.setdefault(my_exchange[1], []).append(my_exchange)
+		log.debug("OSPICassette:load: {0} exchanges, {1} bodies from {2}".format(len(self.exchanges), len(self.bodies), self.path))
+
+	def save(self):
+		"""save - add what was recorded to the cassette, other runs recording at the same time add theirs"""
+		if not self.exchanges:
+			return
+		my_lock = open("{0}.lock".format(self.path), 'a')
+		fcntl.flock(my_lock, fcntl.LOCK_EX)
+		try:
+			my_bodies = {}
+			my_exchanges = []
+			if os.path.exists(self.path):
+				my_file = open(self.path, 'rb')
+				try:
+					my_cassette = self.read_file(my_file)
+				finally:
+					my_file.close()
+				my_bodies = my_cassette["bodies"]
+				my_exchanges = my_cassette["exchanges"]
+			with self._lock:
+				my_bodies.update(self.bodies)
+				my_exchanges.extend(self.exchanges)
+				self.exchanges = []
+
+			my_tmp_path = "{0}.{1}".format(self.path, os.getpid())
+			my_file = gzip.open(my_tmp_path, 'wb')
+			my_file.write(json.dumps({"version": CASSETTE_VERSION, "bodies": my_bodies, "exchanges": sorted(my_exchanges)}, separators=(',', ':')))
+			my_file.close()
+			os.rename(my_tmp_path, self.path)
+			log.debug("OSPICassette:save: {0} exchanges, {1} bodies in {2}".format(len(my_exchanges), len(my_bodies), self.path))
+		finally:
+			fcntl.flock(my_lock, fcntl.LOCK_UN)
+			my_lock.close()
+
+	def report(self):
+		return {"exchanges": len(self.exchanges), "bodies": len(self.bodies), "hits": self.hits, "misses": self.misses}
+
+################################################################################
+# RUN AS SCRIPT
+################################################################################
+
+if __name__ == "__main__":
+	occ = OSPICassette(sys.argv[1])
+	my_counts = {}
+	for my_exchange in occ.exchanges:
+		my_command = my_exchange[1].split("?")[0]
+		my_count, my_elapsed, my_errors = my_counts.get(my_command, (0, 0.0, 0))
+		my_counts[my_command] = (my_count + 1, my_elapsed + my_exchange[3], my_errors + (1 if my_exchange[5] else 0))
+	if occ.exchanges:
+		print "{0} exchanges over {1:.0f} seconds, {2} bodies, {3} bytes".format(len(occ.exchanges), occ.exchanges[-1][0] - occ.exchanges[0][0], len(occ.bodies), os.path.getsize(occ.path))
+	for my_command, (my_count, my_elapsed, my_errors) in sorted(my_counts.iteritems()):
+		print "{0}: {1} requests, {2:.3f}s average, {3} errors".format(my_command, my_count, my_elapsed / my_count, my_errors)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPIControllerHealth.py
+
+	DESCRIPTION:
+	Keep track of how each controller has been answering, and stop
+	calling one that's gone dark. A controller that fails a few queries
+	in a row is marked open, and every query to it returns None right
+	away (no connect timeout) until it's time to probe it again. The
+	probes back off, doubling each time the controller still doesn't
+	answer.
+
+	NOTES:
+	closed     queries go through
+	open       queries are skipped until the next probe
+	half_open  one query is let through as the probe, if it answers the
+	           controller is closed again, if not it's open again with a
+	           longer wait
+
+	/tmp/ospi_health_<controller>.json (or "health_dir")
+	"health_failure_threshold" : 3 (failures in a row before it's open)
+	"health_probe_backoff" : 60 (seconds before the first probe)
+	"health_max_backoff" : 3600
+	"query_timeout" : 10 (seconds to wait on the controller)
+
+	The state is a file so every cron run and the poller share it.
+	Every change re-reads the file and writes it back under a flock on
+	/tmp/ospi_health_<controller>.json.lock, so a change made by another
+	process (or another thread's OSPIControllerHealth) isn't lost, and
+	allow() picks up the file again whenever it has changed.
+	The score is 0 - 100, a moving average of the queries that worked.
+
+	python OSPIControllerHealth.py
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import os, logging, json, time, re, threading, fcntl, contextlib
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospicontrollerhealth')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospicontrollerhealth.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CONSTANTS
+################################################################################
+HEALTH_CLOSED = "closed"
+HEALTH_OPEN = "open"
+HEALTH_HALF_OPEN = "half_open"
+
+# How much each query moves the score and the latency average
+HEALTH_ALPHA = 0.2
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPIControllerHealth(object):
+	"""OSPIControllerHealth - circuit breaker and health score for one controller"""
+
+	def __init__(self, controller, health_dir="/tmp", failure_threshold=3, probe_backoff=60, max_backoff=3600, probe_timeout=60):
+		self.controller = controller
+		self.health_dir = health_dir
+		self.failure_threshold = max(1, failure_threshold)
+		self.probe_backoff = probe_backoff
+		self.max_backoff = max_backoff
+		self.probe_timeout = probe_timeout
+		self._lock = threading.Lock()
+		self._changed = None
+		self.state = self.read_state()
+
+	@classmethod
+	def from_settings(cls, settings, controller):
+		return cls(controller, settings.get('health_dir', "/tmp"), settings.get('health_failure_threshold', 3), settings.get('health_probe_backoff', 60), settings.get('health_max_backoff', 3600), settings.get('query_timeout', 10) * 2)
+
+	@classmethod
+	def split_fleet(cls, settings, controllers):
+		"""split_fleet - (controllers to sweep, [(controller, health)] known to be dead right now)"""
+		my_live = []
+		my_dead = []
+		for my_controller in controllers:
+			och = cls.from_settings(settings, my_controller['name'])
+			if och.dead:
+				my_dead.append((my_controller, och))
+			else:
+				my_live.append(my_controller)
+		if my_dead:
+			log.error("OSPIControllerHealth:split_fleet: skipping {0}".format(", ".join(my_controller['name'] for my_controller, och in my_dead)))
+		return my_live, my_dead
+
+	################################################################################
+	# PROPERTIES
+	################################################################################
+	@property
+	def path(self):
+		my_key = re.sub(r'[^A-Za-z0-9.\-]+', '_', self.controller)
+		return os.path.join(self.health_dir, "ospi_health_{0}.json".format(my_key))
+
+	@property
+	def breaker(self):
+		return self.state["breaker"]
+
+	@property
+	def score(self):
+		return int(round(self.state["success"] * 100))
+
+	@property
+	def backoff(self):
+		# Doubles every time a probe fails
+		if self.state["trips"] == 0:
+			return 0
+		return min(self.max_backoff, self.probe_backoff * (2 ** (self.state["trips"] - 1)))
+
+	@property
+	def next_probe(self):
+		if self.breaker == HEALTH_CLOSED:
+			return None
+		return self.state["opened"] + self.backoff
+
+	@property
+	def dead(self):
+		# Open and not due a probe, or another run is probing it right now
+		my_now = time.time()
+		if self.breaker == HEALTH_OPEN:
+			return my_now < self.next_probe
+		if self.breaker == HEALTH_HALF_OPEN:
+			return (my_now - self.state["probe_started"]) < self.probe_timeout
+		return False
+
+	################################################################################
+	# FUNCTIONS
+	################################################################################
+	def changed(self):
+		try:
+			return os.stat(self.path).st_mtime
+		except OSError:
+			return None
+
+	def read_state(self):
+		self._changed = self.changed()
+		my_state = {"breaker": HEALTH_CLOSED, "failures": 0, "trips": 0, "opened": None, "probe_started": None, "success": 1.0, "latency": None, "last_error": None, "last_success": None}
+		if os.path.exists(self.path):
+			try:
+				my_file = open(self.path, 'r')
+				my_state.update(json.load(my_file))
+				my_file.close()
+			except ValueError, e:
+				log.error("OSPIControllerHealth:read_state: {0} is not readable, starting over. Received error {1}".format(self.path, e))
+		return my_state
+
+	def write_state(self):
+		if not os.path.isdir(self.health_dir):
+			os.makedirs(self.health_dir)
+		my_tmp_path = "{0}.{1}.{2}".format(self.path, os.getpid(), threading.current_thread().ident)
+		my_file = open(my_tmp_path, 'w')
+		json.dump(self.state, my_file)
+		my_file.close()
+		os.rename(my_tmp_path, self.path)
+		self._changed = self.changed()
+
+	@contextlib.contextmanager
+	def update(self):
+		"""update - the latest state from the file, written back when the block ends, with every other writer locked out"""
+		with self._lock:
+			if not os.path.isdir(self.health_dir):
+				os.makedirs(self.health_dir)
+			my_lock_file = open("{0}.lock".format(self.path), 'a')
+			try:
+				fcntl.flock(my_lock_file.fileno(), fcntl.LOCK_EX)
+				self.state = self.read_state()
+				yield self.state
+				self.write_state()
+			finally:
+				my_lock_file.close()
+
+	def refresh(self):
+		# Only read again when someone has written it since
+		with self._lock:
+			if self.changed() != self._changed:
+				self.state = self.read_state()
+
+	def allow(self):
+		"""allow - True when a query to the controller should go through"""
+		self.refresh()
+		if self.breaker == HEALTH_CLOSED:
+			return True
+		with self.update():
+			# Checked again under the lock, so only one process probes
+			if self.breaker == HEALTH_CLOSED:
+				return True
+			if self.dead:
+				log.debug("OSPIControllerHealth:allow: {0} is {1}, skipping until {2:.0f}".format(self.controller, self.breaker, self.next_probe or 0))
+				return False
+
+			# Time to probe, this query is it
+			self.state["breaker"] = HEALTH_HALF_OPEN
+			self.state["probe_started"] = time.time()
+			log.debug("OSPIControllerHealth:allow: {0} probing after {1} seconds".format(self.controller, self.backoff))
+			return True
+
+	def record_success(self, latency):
+		with self.update():
+			if self.breaker != HEALTH_CLOSED:
+				log.debug("OSPIControllerHealth:record_success: {0} is answering again".format(self.controller))
+			my_latency = self.state["latency"]
+			self.state["latency"] = latency if my_latency == None else my_latency + (HEALTH_ALPHA * (latency - my_latency))
+			self.state["success"] += HEALTH_ALPHA * (1.0 - self.state["success"])
+			self.state.update({"breaker": HEALTH_CLOSED, "failures": 0, "trips": 0, "opened": None, "probe_started": None, "last_success": time.time()})
+
+	def record_failure(self, error):
+		with self.update():
+			self.state["failures"] += 1
+			self.state["success"] -= HEALTH_ALPHA * self.state["success"]
+			self.state["last_error"] = str(error)
+
+			if self.breaker == HEALTH_HALF_OPEN or (self.breaker == HEALTH_CLOSED and self.state["failures"] >= self.failure_threshold):
+				self.state["trips"] += 1
+				self.state["breaker"] = HEALTH_OPEN
+				self.state["opened"] = time.time()
+				self.state["probe_started"] = None
+				log.error("OSPIControllerHealth:record_failure: {0} is open, next probe in {1} seconds. Received error {2}".format(self.controller, self.backoff, error))
+
+	def summary(self):
+		return {
+			"controller": self.controller,
+			"breaker": self.breaker,
+			"score": self.score,
+			"latency": self.state["latency"],
+			"next_probe": self.next_probe,
+			"last_error": self.state["last_error"],
+			"last_success": self.state["last_success"],
+		}
+
+################################################################################
+# RUN AS SCRIPT
+################################################################################
+
+if __name__ == "__main__":
+	from OSPIUtility import OSPIReadSettings
+	ors = OSPIReadSettings()
+	my_settings = ors.add_settings()
+	for my_controller in ors.return_controllers():
+		my_summary = OSPIControllerHealth.from_settings(my_settings, my_controller['name']).summary()
+		my_line = "{controller}: {breaker}, score {score}".format(**my_summary)
+		if my_summary["latency"] != None:
+			my_line += ", {0:.2f}s per query".format(my_summary["latency"])
+		if my_summary["next_probe"] != None:
+			my_line += ", next probe in {0:.0f}s, last error {1}".format(max(0, my_summary["next_probe"] - time.time()), my_summary["last_error"])
+		print my_line
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPIEventIngest.py
+
+	DESCRIPTION:
+	Follow the station and flow events the OpenSprinkler publishes over
+	MQTT, instead of polling /js and /jc. The events are turned into the
+	same stations_running and flow_value a OSPICheckStatus has. We only
+	go back to polling the controller when we've lost the broker, or the
+	broker says the controller has gone offline.
+
+	NOTES:
+	Firmware 2.1.9 and up publishes (with "opensprinkler" as the topic)
+	opensprinkler/station/<sid>	{"state": 1, "duration": 600}
+	opensprinkler/sensor/flow	{"count": 12, "volume": 3.4}
+	opensprinkler/availability	online / offline
+
+	"mqtt_broker" : "192.168.100.2",
+	"mqtt_port" : 1883,
+	"mqtt_topic" : "opensprinkler",
+	"mqtt_poll_interval" : 60
+
+	The firmware only publishes when something changes, a idle system is
+	quiet for hours, so how long it's been quiet says nothing. The
+	controller's last will sets availability to offline when it drops off
+	the broker. /js and /jc are polled every "mqtt_poll_interval" seconds
+	while we're not connected or the controller is offline, and once
+	after every (re)connect, for whatever changed while we weren't
+	listening.
+
+	listeners are called on every change, flow_listeners only on the flow
+	events and polls, which have a new flow value. A message we can't
+	make sense of (a station that isn't a number, a payload that isn't
+	JSON) is logged and skipped.
+
+	Needs paho-mqtt (pip install paho-mqtt).
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import logging, json, time, threading
+from OSPIUtility import OSPICheckStatus, OSPIReadSettings, QUERY_TIMEOUT
+from OSPIControllerHealth import OSPIControllerHealth
+from OSPIRequestScheduler import OSPIRequestScheduler
+from OSPICassette import OSPICassette
+from OSPILiveState import OSPILiveState
+from OSPIFlowHistory import flow_recorder
+from OSPIPoller import OSPIPoller
+
+try:
+	import paho.mqtt.client as mqtt
+except ImportError:
+	mqtt = None
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospieventingest')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospieventingest.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPIEventIngest(object):
+	"""OSPIEventIngest - keeps a OSPICheckStatus up to date from MQTT events"""
+
+	def __init__(self, opcs, broker, port=1883, topic="opensprinkler", poll_interval=60, client=None):
+		self.opcs = opcs
+		self.broker = broker
+		self.port = port
+		self.topic = topic.rstrip("/")
+		self.poll_interval = poll_interval
+		self.station_states = []
+		self.listeners = []
+		self.flow_listeners = []
+		self.connected = False
+		# None until the broker tells us, the retained availability comes in on subscribe
+		self.available = None
+		self.synced = False
+		self.last_event = None
+		self.last_poll = None
+		self.event_count = 0
+		self.poll_count = 0
+		self.poller = OSPIPoller(opcs.station_address, opcs.passwd, opcs.timeout, opcs.health)
+		self._lock = threading.Lock()
+		self._running = False
+
+		if client == None:
+			if mqtt == None:
+				raise ImportError("OSPIEventIngest needs paho-mqtt, pip install paho-mqtt")
+			client = mqtt.Client()
+		self.client = client
+		self.client.on_connect = self.on_connect
+		self.client.on_message = self.on_message
+		self.client.on_disconnect = self.on_disconnect
+
+	@classmethod
+	def from_settings(cls, settings, controller):
+		och = OSPIControllerHealth.from_settings(settings, controller['name'])
+		opcs = OSPICheckStatus(controller['open_sprinkler_ip'], controller['md5_pass'], None, och, settings.get('query_timeout', QUERY_TIMEOUT))
+		return cls(opcs, controller.get('mqtt_broker', settings.get('mqtt_broker')), controller.get('mqtt_port', settings.get('mqtt_port', 1883)), controller.get('mqtt_topic', settings.get('mqtt_topic', "opensprinkler")), settings.get('mqtt_poll_interval', 60))
+
+	################################################################################
+	# PROPERTIES
+	################################################################################
+	@property
+	def following(self):
+		# The events are the whole story, connected, the controller's online and we've caught up since connecting
+		return self.connected and self.available != False and self.synced
+
+	################################################################################
+	# MQTT CALLBACKS
+	################################################################################
+	def on_connect(self, client, userdata, flags, rc):
+		log.debug("OSPIEventIngest:on_connect: connected to {0}:{1} rc {2}".format(self.broker, self.port, rc))
+		if rc != 0:
+			return
+		with self._lock:
+			self.connected = True
+			self.synced = False
+		client.subscribe("{0}/#".format(self.topic))
+
+	def on_disconnect(self, client, userdata, rc):
+		log.error("OSPIEventIngest:on_disconnect: lost the broker rc {0}, polling until it's back".format(rc))
+		with self._lock:
+			self.connected = False
+			self.available = None
+			self.synced = False
+
+	def on_message(self, client, userdata, message):
+		self.handle_event(message.topic, message.payload)
+
+	################################################################################
+	# FUNCTIONS
+	################################################################################
+	def handle_event(self, topic, payload):
+		my_parts = topic[len(self.topic) + 1:].split("/")
+		my_flow = my_parts[0] == "sensor" and my_parts[1:] == ["flow"]
+		try:
+			if my_parts[0] == "station" and len(my_parts) > 1:
+				my_sid = int(my_parts[1])
+				my_state = json.loads(payload).get("state", 0)
+			elif my_flow:
+				my_count = json.loads(payload).get("count")
+		except (ValueError, KeyError, AttributeError), e:
+			log.error("OSPIEventIngest:handle_event: skipping {0} {1}, received error {2}".format(topic, payload, e))
+			return
+
+		with self._lock:
+			self.last_event = time.time()
+			self.event_count += 1
+
+			if my_parts[0] == "station" and len(my_parts) > 1:
+				if my_sid >= len(self.station_states):
+					self.station_states.extend([0] * (my_sid + 1 - len(self.station_states)))
+				self.station_states[my_sid] = my_state
+				self.update_stations_running()
+			elif my_flow:
+				self.opcs.flow_value = my_count
+			elif my_parts[0] == "availability":
+				my_available = payload.strip() == "online"
+				if my_available and self.available == False:
+					# Back from offline, whatever happened meanwhile wasn't published
+					self.synced = False
+				self.available = my_available
+				log.debug("OSPIEventIngest:handle_event: controller is {0}".format(payload))
+			else:
+				return
+
+		log.debug("OSPIEventIngest:handle_event: {0} {1}".format(topic, payload))
+		self.notify(my_flow)
+
+	def update_stations_running(self):
+		# Same as check_stations_running, stations_running is None when nothing is on
+		my_running = None
+		for my_state in self.station_states:
+			if my_state != 0:
+				my_running = my_state
+		self.opcs.stations_running = my_running
+
+	def poll(self):
+		# No events to go on, ask the controller directly
+		with self._lock:
+			my_connected = self.connected
+		if not self.poller.poll():
+			raise IOError("{0} did not answer the poll, {1}".format(self.opcs.station_address, self.poller.error))
+		with self._lock:
+			self.poller.update(self.opcs)
+			self.station_states[:] = self.poller.station_states
+			# Caught up, as long as we were connected before the poll went out
+			self.synced = my_connected and self.connected
+		self.last_poll = time.time()
+		self.poll_count += 1
+		log.debug("OSPIEventIngest:poll: not following events, polled stations {0} flow {1}".format(self.opcs.stations_running, self.opcs.flow_value))
+		self.notify(True)
+
+	def notify(self, flow=False):
+		# flow when there's a new flow value, a poll or a flow event
+		for my_listener in self.listeners:
+			my_listener(self)
+		if flow:
+			for my_listener in self.flow_listeners:
+				my_listener(self)
+
+	def run(self, duration=None):
+		"""run - follow the events, for duration seconds or until stop()"""
+		self.client.connect_async(self.broker, self.port)
+		self.client.loop_start()
+		self._running = True
+		my_end = None if duration == None else time.time() + duration
+		try:
+			while self._running and (my_end == None or time.time() < my_end):
+				if not self.following and (self.last_poll == None or (time.time() - self.last_poll) >= self.poll_interval):
+					try:
+						self.poll()
+					except Exception, e:
+						log.error("OSPIEventIngest:run: poll failed, received error {0}".format(e))
+						self.last_poll = time.time()
+				time.sleep(0.1)
+		finally:
+			self.client.loop_stop()
+			self.client.disconnect()
+
+	def stop(self):
+		self._running = False
+
+################################################################################
+# RUN AS SCRIPT
+################################################################################
+
+if __name__ == "__main__":
+	ors = OSPIReadSettings()
+	my_settings = ors.add_settings()
+	my_controller = ors.return_controllers()[0]
+	OSPIRequestScheduler.configure(my_settings)
+	OSPICassette.from_settings(my_settings)
+	oei = OSPIEventIngest.from_settings(my_settings, my_controller)
+	olsw = OSPILiveState.from_settings(my_settings, True)
+	oei.listeners.append(olsw.publisher(my_controller['name']))
+	oei.flow_listeners.append(flow_recorder(my_settings, my_controller['name']))
+	oei.run()
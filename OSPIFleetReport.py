@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPIFleetReport.py
+
+	DESCRIPTION:
+	The day's watering report for every controller, and one for the
+	whole fleet, as html, plain text, csv and json files. The controllers
+	are rendered by a pool of processes, one per core, straight from the
+	log archive and the station names in the snapshots, so nothing is
+	asked of the controllers again.
+
+	NOTES:
+	"report_dir" : "/home/pi/ospi_reports"
+	"report_formats" : ["html", "txt", "csv", "json"]
+	"report_processes" : null (one per core)
+
+	<report_dir>/<YYYY-MM-DD>/<controller>.html .txt .csv .json
+	                          <controller>.totals
+	                          fleet.html .txt .csv .json
+
+	Every file is written next to where it goes and renamed into place,
+	so a reader never sees half a report. OSPIGetLogData writes the
+	reports once the day's logs are archived, when "report_dir" is set.
+
+	The fleet report has every configured controller, not just the ones
+	this run rendered. Each OSPIShard worker renders its own controllers,
+	then rebuilds the fleet report from every controller's .totals file
+	while it holds fleet.lock, so the last worker done has everyone in
+	it. A controller that's down shows its last error, one nobody has
+	reported on yet shows "no report".
+
+	python OSPIFleetReport.py [YYYY-MM-DD] (yesterday when it's not given)
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import os, sys, logging, time, calendar, json, csv, StringIO, multiprocessing, fcntl
+from OSPILogArchive import OSPILogArchive, fsync_path
+from OSPILogDecoder import OSPILogDecoder
+from OSPISnapshotCache import OSPISnapshotCache
+from OSPIControllerHealth import OSPIControllerHealth
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospifleetreport')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospifleetreport.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CONSTANTS
+################################################################################
+REPORT_FORMATS = ["html", "txt", "csv", "json"]
+REPORT_TOTALS = ("controller", "runs", "zones", "seconds", "error")
+
+REPORT_HTML = u"""\
+		<html>
+			<head></head>
+			<body>
+				<h3>{0}</h3>
+{1}
+			</body>
+		</html>
+"""
+
+REPORT_TABLE = u"""\
+				<table border="0" width="350">
+					<tr>
+{0}
+					</tr>
+{1}
+				</table>
+"""
+
+################################################################################
+# FUNCTIONS
+################################################################################
+
+def write_atomic(path, text):
+	"""write_atomic - write text to path through a temporary file and a rename"""
+	my_tmp_path = "{0}.tmp-{1}".format(path, os.getpid())
+	my_file = open(my_tmp_path, 'wb')
+	try:
+		if isinstance(text, unicode):
+			text = text.encode('utf-8')
+		my_file.write(text)
+		my_file.flush()
+		os.fsync(my_file.fileno())
+	finally:
+		my_file.close()
+	os.rename(my_tmp_path, path)
+
+def html_table(headings, rows):
+	my_headings = u"\n".join(u"\t\t\t\t\t\t<th align=\"left\">{0}</th>".format(my_heading) for my_heading in headings)
+	my_rows = u"\n".join(u"\t\t\t\t\t<tr>{0}</tr>".format(u"".join(u"<td>{0}</td>".format(my_value) for my_value in my_row)) for my_row in rows)
+	return REPORT_TABLE.format(my_headings, my_rows)
+
+def text_table(headings, rows):
+	my_rows = [[unicode(my_value) for my_value in my_row] for my_row in [headings] + list(rows)]
+	my_widths = [max(len(my_row[my_count]) for my_row in my_rows) for my_count in xrange(len(headings))]
+	return u"\n".join(u"  ".join(my_value.ljust(my_width) for my_value, my_width in zip(my_row, my_widths)).rstrip() for my_row in my_rows)
+
+def csv_table(headings, rows):
+	my_file = StringIO.StringIO()
+	my_writer = csv.writer(my_file)
+	for my_row in [headings] + list(rows):
+		my_writer.writerow([my_value.encode('utf-8') if isinstance(my_value, unicode) else my_value for my_value in my_row])
+	return my_file.getvalue()
+
+def render(path, formats, title, tables, rows, data):
+	"""render - write the tables ([(headings, rows)]) as html and text, rows (headings, rows) as csv and data as json"""
+	my_paths = []
+	for my_format in formats:
+		if my_format == "html":
+			my_text = REPORT_HTML.format(title, u"\n".join(html_table(my_headings, my_rows) for my_headings, my_rows in tables))
+		elif my_format == "txt":
+			my_text = u"{0}\n\n{1}\n".format(title, u"\n\n".join(text_table(my_headings, my_rows) for my_headings, my_rows in tables))
+		elif my_format == "csv":
+			my_text = csv_table(*rows)
+		else:
+			my_text = json.dumps(data, indent=1, sort_keys=True)
+		my_path = "{0}.{1}".format(path, my_format)
+		write_atomic(my_path, my_text)
+		my_paths.append(my_path)
+	return my_paths
+
+def report_controller(task):
+	"""report_controller - one controller's day, in a pool process, returns its totals for the fleet report"""
+	my_settings, my_controller, my_day, my_path, my_formats = task
+	try:
+		# The names of the zones are in the snapshot the log pull kept
+		my_snapshot = OSPISnapshotCache.from_settings(my_settings, my_controller).load(None)
+		my_station_names = my_snapshot[0].get("snames") if my_snapshot else []
+
+		oldc = OSPILogDecoder(my_station_names)
+		oldc.decode(load_day(OSPILogArchive.from_settings(my_settings), my_controller, my_day))
+		my_rows = oldc.rows()
+		my_zones = {}
+		for (my_run_day, my_sid), (my_runs, my_total) in oldc.summarize().iteritems():
+			my_zones[my_sid] = (my_runs, my_total)
+		my_zone_rows = [(my_sid, (my_station_names[my_sid] if 0 <= my_sid < len(my_station_names) else "Unknown"), my_zones[my_sid][0], oldc.duration_label(my_zones[my_sid][1])) for my_sid in sorted(my_zones)]
+		my_total = sum(my_seconds for my_runs, my_seconds in my_zones.itervalues())
+
+		my_data = {
+			"controller": my_controller,
+			"date": time.strftime('%Y-%m-%d', time.gmtime(my_day * 86400)),
+			"runs": [{"time": my_time, "duration": int(my_dur), "sid": int(my_sid), "zone": my_zone} for (my_date, my_time, my_label, my_zone), my_dur, my_sid in zip(my_rows, oldc.column("dur"), oldc.column("sid"))],
+			"zones": [{"sid": my_sid, "name": my_name, "runs": my_runs, "seconds": my_zones[my_sid][1]} for my_sid, my_name, my_runs, my_label in my_zone_rows],
+			"total_seconds": my_total,
+		}
+		my_tables = [
+			(["Time", "Duration", "Zone"], [my_row[1:] for my_row in my_rows]),
+			(["Station", "Name", "Runs", "Total"], my_zone_rows),
+		]
+		# The csv is for spreadsheets, seconds rather than labels
+		my_csv = (["date", "time", "sid", "zone", "seconds"], [(my_data["date"], my_run["time"], my_run["sid"], my_run["zone"], my_run["duration"]) for my_run in my_data["runs"]])
+		my_paths = render(my_path, my_formats, u"{0} {1}".format(my_controller, my_data["date"]), my_tables, my_csv, my_data)
+		my_totals = {"controller": my_controller, "runs": oldc.count, "zones": len(my_zones), "seconds": my_total, "paths": my_paths, "error": None}
+	except Exception, e:
+		log.error("OSPIFleetReport:report_controller: {0} failed, received error {1}".format(my_controller, e))
+		my_totals = {"controller": my_controller, "runs": 0, "zones": 0, "seconds": 0, "paths": [], "error": str(e)}
+
+	# For the fleet report, whichever worker builds it
+	try:
+		write_atomic("{0}.totals".format(my_path), json.dumps(dict((my_key, my_totals[my_key]) for my_key in REPORT_TOTALS)))
+	except (IOError, OSError), e:
+		log.error("OSPIFleetReport:report_controller: {0} totals not written, received error {1}".format(my_controller, e))
+	return my_totals
+
+def load_day(archive, controller, day):
+	"""load_day - the archived [pid, sid, dur, end] runs that ended on day (a epoch day number)"""
+	my_month = time.strftime('%Y-%m', time.gmtime(day * 86400))
+	my_start = day * 86400
+	my_day_runs = []
+	for my_month, my_runs in archive.load(controller, "runs", my_month, my_month):
+		if numpy != None:
+			my_end = numpy.asarray(my_runs["end"])
+			my_mask = (my_end >= my_start) & (my_end < my_start + 86400)
+			my_day_runs.extend(numpy.column_stack([numpy.asarray(my_runs[my_column])[my_mask] for my_column in ("pid", "sid", "dur", "end")]).tolist())
+		else:
+			my_day_runs.extend(list(my_run) for my_run in zip(my_runs["pid"], my_runs["sid"], my_runs["dur"], my_runs["end"]) if my_start <= my_run[3] < my_start + 86400)
+	return my_day_runs
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPIFleetReport(object):
+	"""OSPIFleetReport - renders the day's reports for the fleet across a process pool"""
+
+	def __init__(self, settings, report_dir, formats=None, processes=None):
+		self.settings = settings
+		self.report_dir = report_dir
+		self.formats = formats or REPORT_FORMATS
+		self.processes = processes or multiprocessing.cpu_count()
+		self.elapsed = None
+
+	@classmethod
+	def from_settings(cls, settings):
+		"""from_settings - None when there's no "report_dir\""""
+		my_report_dir = settings.get('report_dir')
+		if not my_report_dir:
+			return None
+		return cls(settings, my_report_dir, settings.get('report_formats'), settings.get('report_processes'))
+
+	################################################################################
+	# FUNCTIONS
+	################################################################################
+	@staticmethod
+	def yesterday():
+		return (int(time.time()) // 86400) - 1
+
+	def day_path(self, day):
+		return os.path.join(self.report_dir, time.strftime('%Y-%m-%d', time.gmtime(day * 86400)))
+
+	def controller_path(self, directory, controller):
+		return os.path.join(directory, os.path.basename(OSPILogArchive.from_settings(self.settings).controller_path(controller)))
+
+	def generate(self, controllers, day=None, fleet=None):
+		"""generate - controllers' reports for day (yesterday by default), and the fleet report for fleet (every controller configured, controllers when it's None), returns the controller totals"""
+		if day == None:
+			day = self.yesterday()
+		my_start = time.time()
+		my_dir = self.day_path(day)
+		if not os.path.isdir(my_dir):
+			os.makedirs(my_dir)
+
+		my_tasks = [(self.settings, my_controller['name'], day, self.controller_path(my_dir, my_controller['name']), self.formats) for my_controller in controllers]
+		if self.processes > 1 and len(my_tasks) > 1:
+			my_pool = multiprocessing.Pool(min(self.processes, len(my_tasks)))
+			try:
+				my_totals = my_pool.map(report_controller, my_tasks, max(1, len(my_tasks) // (self.processes * 4)))
+			finally:
+				my_pool.close()
+				my_pool.join()
+		else:
+			my_totals = [report_controller(my_task) for my_task in my_tasks]
+
+		self.report_fleet(my_dir, day, my_totals, fleet if fleet != None else controllers)
+		fsync_path(my_dir)
+		self.elapsed = time.time() - my_start
+		log.debug("OSPIFleetReport:generate: {0} controllers in {1:.2f}s on {2} processes".format(len(my_totals), self.elapsed, self.processes))
+		return my_totals
+
+	def fleet_totals(self, path, totals, fleet):
+		# Ours from this run, everyone else's from their .totals files
+		my_ours = dict((my_total["controller"], my_total) for my_total in totals)
+		my_totals = []
+		for my_controller in fleet:
+			my_name = my_controller['name']
+			my_total = my_ours.get(my_name)
+			if my_total == None:
+				my_totals_path = "{0}.totals".format(self.controller_path(path, my_name))
+				if os.path.exists(my_totals_path):
+					my_file = open(my_totals_path, 'r')
+					my_total = json.load(my_file)
+					my_file.close()
+			if my_total == None:
+				och = OSPIControllerHealth.from_settings(self.settings, my_name)
+				my_error = "not answering: {0}".format(och.state["last_error"]) if och.dead else "no report"
+				my_total = {"controller": my_name, "runs": 0, "zones": 0, "seconds": 0, "error": my_error}
+			my_totals.append(my_total)
+		return my_totals
+
+	def report_fleet(self, path, day, totals, fleet):
+		# One worker at a time, so the last one done sees every other worker's controllers
+		my_lock = open(os.path.join(path, "fleet.lock"), 'a')
+		try:
+			fcntl.flock(my_lock.fileno(), fcntl.LOCK_EX)
+			return self.render_fleet(path, day, self.fleet_totals(path, totals, fleet))
+		finally:
+			my_lock.close()
+
+	def render_fleet(self, path, day, totals):
+		my_date = time.strftime('%Y-%m-%d', time.gmtime(day * 86400))
+		my_label = OSPILogDecoder([]).duration_label
+		my_rows = [(my_total["controller"], my_total["runs"], my_total["zones"], my_label(my_total["seconds"]), my_total["error"] or "") for my_total in sorted(totals, key=lambda my_total: my_total["controller"])]
+		my_data = {
+			"date": my_date,
+			"controllers": [dict((my_key, my_total[my_key]) for my_key in ("controller", "runs", "zones", "seconds", "error")) for my_total in totals],
+			"runs": sum(my_total["runs"] for my_total in totals),
+			"seconds": sum(my_total["seconds"] for my_total in totals),
+		}
+		my_csv = (["date", "controller", "runs", "zones", "seconds", "error"], [(my_date, my_total["controller"], my_total["runs"], my_total["zones"], my_total["seconds"], my_total["error"] or "") for my_total in sorted(totals, key=lambda my_total: my_total["controller"])])
+		return render(os.path.join(path, "fleet"), self.formats, u"Fleet {0}".format(my_date), [(["Controller", "Runs", "Zones", "Total", "Error"], my_rows)], my_csv, my_data)
+
+################################################################################
+# RUN AS SCRIPT
+################################################################################
+
+if __name__ == "__main__":
+	from OSPIUtility import OSPIReadSettings
+	ors = OSPIReadSettings()
+	my_settings = ors.add_settings()
+	my_settings.setdefault('report_dir', "/tmp/ospi_reports")
+	ofr = OSPIFleetReport.from_settings(my_settings)
+	my_day = None
+	if len(sys.argv) > 1:
+		my_day = calendar.timegm(time.strptime(sys.argv[1], '%Y-%m-%d')) // 86400
+	my_totals = ofr.generate(ors.return_controllers(), my_day)
+	print "{0} controllers, {1} runs, in {2:.2f}s on {3} processes, {4}".format(len(my_totals), sum(my_total["runs"] for my_total in my_totals), ofr.elapsed, ofr.processes, ofr.day_path(my_day if my_day != None else ofr.yesterday()))
+	for my_total in my_totals:
+		if my_total["error"]:
+			print "{0}: {1}".format(my_total["controller"], my_total["error"])
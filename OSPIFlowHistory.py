@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPIFlowHistory.py
+
+	DESCRIPTION:
+	Keep the flow readings (flcrt) instead of throwing them away, the
+	way rrdtool does. Each series is one fixed size file with a ring
+	for each tier. Raw readings are kept for a few hours, then min, avg
+	and max for each minute, hour and day for longer and longer. The
+	file never grows, and a year of days is a few blocks.
+
+	NOTES:
+	tier    step    rows    kept
+	raw     5s      2880    4 hours
+	minute  60s     2880    2 days
+	hour    3600s   2160    90 days
+	day     86400s  1830    5 years
+
+	"flow_history_dir" : "/home/pi/ospi_flow"
+	"flow_tiers" : [[5, 2880], [60, 2880], [3600, 2160], [86400, 1830]]
+
+	header  8s magic, H version, H tier count
+	tier    I step, I rows per block, H columns, 2x pad, I blocks
+	state   I current block, q bucket, q min, q max, q sum, I count,
+	        3i last row
+	block   q start time, H rows, 2x pad, 3i first row, then an int16
+	        delta from the row before for every other row and column
+
+	The values are stored as value * 10. A row the poller missed is a
+	delta of -32768. When a delta doesn't fit in a int16, or there's a
+	gap longer than the block, the next block in the ring is started.
+	The raw tier has one column (the bucket's average), the others have
+	min, avg and max.
+
+	A series is a controller, or "<controller>.zone<sid>" for the flow
+	while that station was running. There's one writer, the poller.
+
+	python OSPIFlowHistory.py <series> [tier] [days]
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import os, sys, logging, struct, mmap, re, time
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospiflowhistory')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospiflowhistory.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CONSTANTS
+################################################################################
+FLOW_MAGIC = "OSPIFLOW"
+FLOW_VERSION = 1
+FLOW_HEADER = struct.Struct('<8sHH')
+FLOW_TIER = struct.Struct('<IIH2xI')
+FLOW_STATE = struct.Struct('<IqqqqI3i')
+FLOW_BLOCK = struct.Struct('<qH2x3i')
+
+FLOW_TIERS = [[5, 2880], [60, 2880], [3600, 2160], [86400, 1830]]
+FLOW_TIER_NAMES = {5: "raw", 60: "minute", 3600: "hour", 86400: "day"}
+FLOW_BLOCK_ROWS = 64
+FLOW_SCALE = 10
+FLOW_UNKNOWN = -32768
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPIFlowHistory(object):
+	"""OSPIFlowHistory - fixed size, tiered and delta encoded flow history for one series"""
+
+	def __init__(self, path, tiers=None, block_rows=FLOW_BLOCK_ROWS):
+		self.path = path
+		self.bytes_read = 0
+		if not os.path.exists(path):
+			self.create(tiers or FLOW_TIERS, block_rows)
+
+		my_file = open(path, 'r+b')
+		try:
+			self._map = mmap.mmap(my_file.fileno(), 0)
+		finally:
+			my_file.close()
+
+		my_magic, my_version, my_tier_count = FLOW_HEADER.unpack_from(self._map, 0)
+		if my_magic != FLOW_MAGIC or my_version != FLOW_VERSION:
+			raise ValueError("{0} is not a flow history file we know".format(path))
+		self.tiers = self.layout([FLOW_TIER.unpack_from(self._map, FLOW_HEADER.size + (my_count * FLOW_TIER.size)) for my_count in xrange(my_tier_count)])
+
+	@classmethod
+	def from_settings(cls, settings, series):
+		my_dir = settings.get('flow_history_dir', "/tmp")
+		if not os.path.isdir(my_dir):
+			os.makedirs(my_dir)
+		return cls(cls.path_for(settings, series), settings.get('flow_tiers'))
+
+	@staticmethod
+	def path_for(settings, series):
+		my_key = re.sub(r'[^A-Za-z0-9.\-]+', '_', series)
+		return os.path.join(settings.get('flow_history_dir', "/tmp"), "ospi_flow_{0}.rrd".format(my_key))
+
+	################################################################################
+	# FUNCTIONS
+	################################################################################
+	@staticmethod
+	def layout(descriptors):
+		# Where each tier's state and blocks are in the file
+		my_tiers = []
+		my_offset = FLOW_HEADER.size + (len(descriptors) * (FLOW_TIER.size + FLOW_STATE.size))
+		for my_count, (my_step, my_block_rows, my_columns, my_blocks) in enumerate(descriptors):
+			my_block_size = FLOW_BLOCK.size + ((my_block_rows - 1) * my_columns * 2)
+			my_tiers.append({
+				"name": FLOW_TIER_NAMES.get(my_step, "{0}s".format(my_step)),
+				"step": my_step,
+				"block_rows": my_block_rows,
+				"columns": my_columns,
+				"blocks": my_blocks,
+				"block_size": my_block_size,
+				"state_offset": FLOW_HEADER.size + (len(descriptors) * FLOW_TIER.size) + (my_count * FLOW_STATE.size),
+				"blocks_offset": my_offset,
+				"delta": struct.Struct('<{0}h'.format(my_columns)),
+			})
+			my_offset += my_blocks * my_block_size
+		return my_tiers
+
+	def create(self, tiers, block_rows):
+		# The first tier is the raw readings, one column, the rest are min/avg/max
+		my_descriptors = []
+		for my_count, (my_step, my_rows) in enumerate(tiers):
+			my_blocks = max(2, -(-my_rows // (block_rows - 1)))
+			my_descriptors.append((my_step, block_rows, 1 if my_count == 0 else 3, my_blocks))
+		my_tiers = self.layout(my_descriptors)
+		my_size = my_tiers[-1]["blocks_offset"] + (my_tiers[-1]["blocks"] * my_tiers[-1]["block_size"])
+
+		my_tmp_path = "{0}.{1}".format(self.path, os.getpid())
+		my_file = open(my_tmp_path, 'wb')
+		my_file.write(FLOW_HEADER.pack(FLOW_MAGIC, FLOW_VERSION, len(my_descriptors)))
+		for my_step, my_block_rows, my_columns, my_blocks in my_descriptors:
+			my_file.write(FLOW_TIER.pack(my_step, my_block_rows, my_columns, my_blocks))
+		for my_descriptor in my_descriptors:
+			my_file.write(FLOW_STATE.pack(0, -1, 0, 0, 0, 0, 0, 0, 0))
+		my_file.write("\0" * (my_size - my_file.tell()))
+		my_file.close()
+		os.rename(my_tmp_path, self.path)
+		log.debug("OSPIFlowHistory:create: created {0}, {1} bytes".format(self.path, my_size))
+
+	def block_offset(self, tier, block):
+		return tier["blocks_offset"] + (block * tier["block_size"])
+
+	def record(self, timestamp, value):
+		"""record - add one flow reading to every tier"""
+		if value == None:
+			return
+		my_value = int(round(value * FLOW_SCALE))
+		my_timestamp = int(timestamp)
+		for my_tier in self.tiers:
+			my_state = FLOW_STATE.unpack_from(self._map, my_tier["state_offset"])
+			my_bucket = my_state[1]
+			my_new_bucket = my_timestamp - (my_timestamp % my_tier["step"])
+			if my_bucket != -1 and my_new_bucket < my_bucket:
+				continue
+
+			# A new bucket, the last one's row goes in the ring
+			if my_bucket != -1 and my_new_bucket > my_bucket:
+				my_min, my_max, my_sum, my_count = my_state[2:6]
+				my_avg = int(round(my_sum / float(my_count)))
+				self.append_row(my_tier, my_bucket, [my_avg] if my_tier["columns"] == 1 else [my_min, my_avg, my_max])
+				my_state = FLOW_STATE.unpack_from(self._map, my_tier["state_offset"])
+				my_bucket = -1
+
+			my_state = list(my_state)
+			if my_bucket == -1:
+				my_state[2:6] = [my_value, my_value, 0, 0]
+			my_state[1] = my_new_bucket
+			my_state[2] = min(my_state[2], my_value)
+			my_state[3] = max(my_state[3], my_value)
+			my_state[4] += my_value
+			my_state[5] += 1
+			FLOW_STATE.pack_into(self._map, my_tier["state_offset"], *my_state)
+
+	def append_row(self, tier, timestamp, values):
+		my_state = FLOW_STATE.unpack_from(self._map, tier["state_offset"])
+		my_block = my_state[0]
+		my_last = list(my_state[6:6 + tier["columns"]])
+		my_offset = self.block_offset(tier, my_block)
+		my_start, my_rows = FLOW_BLOCK.unpack_from(self._map, my_offset)[:2]
+
+		if my_rows > 0:
+			my_row = (timestamp - my_start) // tier["step"]
+			if my_row < my_rows:
+				return
+			my_deltas = [my_new - my_old for my_new, my_old in zip(values, my_last)]
+			if my_row < tier["block_rows"] and all(-32767 <= my_delta <= 32767 for my_delta in my_deltas):
+				# Rows the poller missed, then the new row
+				for my_missed in xrange(my_rows, my_row):
+					tier["delta"].pack_into(self._map, my_offset + FLOW_BLOCK.size + ((my_missed - 1) * tier["columns"] * 2), *([FLOW_UNKNOWN] * tier["columns"]))
+				tier["delta"].pack_into(self._map, my_offset + FLOW_BLOCK.size + ((my_row - 1) * tier["columns"] * 2), *my_deltas)
+				my_header = list(FLOW_BLOCK.unpack_from(self._map, my_offset))
+				my_header[1] = my_row + 1
+				FLOW_BLOCK.pack_into(self._map, my_offset, *my_header)
+				self.write_last(tier, my_block, values)
+				return
+			my_block = (my_block + 1) % tier["blocks"]
+			my_offset = self.block_offset(tier, my_block)
+
+		FLOW_BLOCK.pack_into(self._map, my_offset, timestamp, 1, *(values + [0] * (3 - tier["columns"])))
+		self.write_last(tier, my_block, values)
+
+	def write_last(self, tier, block, values):
+		my_state = list(FLOW_STATE.unpack_from(self._map, tier["state_offset"]))
+		my_state[0] = block
+		my_state[6:6 + tier["columns"]] = values
+		FLOW_STATE.pack_into(self._map, tier["state_offset"], *my_state)
+
+	def tier(self, name):
+		for my_tier in self.tiers:
+			if my_tier["name"] == name or my_tier["step"] == name:
+				return my_tier
+		raise KeyError("no {0} tier in {1}".format(name, self.path))
+
+	def read(self, tier_name, start=None, end=None):
+		"""read - {"ts", "value"} for the raw tier, {"ts", "min", "avg", "max"} for the rest, between start and end
+
+		Only the blocks in the time range are read. Missing rows are NaN
+		with numpy, None without.
+		"""
+		my_tier = self.tier(tier_name)
+		my_step = my_tier["step"]
+		my_blocks = []
+		for my_block in xrange(my_tier["blocks"]):
+			my_offset = self.block_offset(my_tier, my_block)
+			my_start, my_rows = FLOW_BLOCK.unpack_from(self._map, my_offset)[:2]
+			self.bytes_read += FLOW_BLOCK.size
+			if my_rows == 0:
+				continue
+			my_end = my_start + ((my_rows - 1) * my_step)
+			if (start != None and my_end < start) or (end != None and my_start > end):
+				continue
+			my_blocks.append((my_start, my_rows, my_offset))
+
+		my_names = ["value"] if my_tier["columns"] == 1 else ["min", "avg", "max"]
+		my_times = []
+		my_columns = [[] for my_name in my_names]
+		for my_start, my_rows, my_offset in sorted(my_blocks):
+			my_times_block, my_values_block = self.decode_block(my_tier, my_offset, my_start, my_rows)
+			my_times.append(my_times_block)
+			for my_count in xrange(len(my_names)):
+				my_columns[my_count].append(my_values_block[my_count])
+
+		if numpy != None:
+			my_ts = numpy.concatenate(my_times) if my_times else numpy.zeros(0, dtype='<i8')
+			my_keep = numpy.ones(len(my_ts), dtype=bool)
+			if start != None:
+				my_keep &= my_ts >= start
+			if end != None:
+				my_keep &= my_ts <= end
+			my_read = {"ts": my_ts[my_keep]}
+			for my_count, my_name in enumerate(my_names):
+				my_read[my_name] = (numpy.concatenate(my_columns[my_count]) if my_columns[my_count] else numpy.zeros(0))[my_keep]
+			return my_read
+
+		my_ts = [my_time for my_block_times in my_times for my_time in my_block_times]
+		my_keep = [(start == None or my_time >= start) and (end == None or my_time <= end) for my_time in my_ts]
+		my_read = {"ts": [my_time for my_time, my_in in zip(my_ts, my_keep) if my_in]}
+		for my_count, my_name in enumerate(my_names):
+			my_values = [my_value for my_block_values in my_columns[my_count] for my_value in my_block_values]
+			my_read[my_name] = [my_value for my_value, my_in in zip(my_values, my_keep) if my_in]
+		return my_read
+
+	def decode_block(self, tier, offset, start, rows):
+		my_columns = tier["columns"]
+		my_first = FLOW_BLOCK.unpack_from(self._map, offset)[2:2 + my_columns]
+		my_delta_offset = offset + FLOW_BLOCK.size
+		self.bytes_read += (rows - 1) * my_columns * 2
+
+		if numpy != None:
+			my_deltas = numpy.frombuffer(self._map, dtype='<i2', count=(rows - 1) * my_columns, offset=my_delta_offset).reshape(rows - 1, my_columns).astype('<i8')
+			my_missing = numpy.concatenate(([False], my_deltas[:, 0] == FLOW_UNKNOWN))
+			my_deltas[my_deltas == FLOW_UNKNOWN] = 0
+			my_values = numpy.cumsum(numpy.vstack((numpy.asarray(my_first, dtype='<i8').reshape(1, my_columns), my_deltas)), axis=0) / float(FLOW_SCALE)
+			my_values[my_missing] = numpy.nan
+			my_times = start + (numpy.arange(rows, dtype='<i8') * tier["step"])
+			return my_times, [my_values[:, my_count] for my_count in xrange(my_columns)]
+
+		my_deltas = struct.unpack_from('<{0}h'.format((rows - 1) * my_columns), self._map, my_delta_offset)
+		my_last = list(my_first)
+		my_values = [[my_value / float(FLOW_SCALE)] for my_value in my_first]
+		for my_row in xrange(rows - 1):
+			my_row_deltas = my_deltas[my_row * my_columns:(my_row + 1) * my_columns]
+			for my_count in xrange(my_columns):
+				if my_row_deltas[0] == FLOW_UNKNOWN:
+					my_values[my_count].append(None)
+					continue
+				my_last[my_count] += my_row_deltas[my_count]
+				my_values[my_count].append(my_last[my_count] / float(FLOW_SCALE))
+		return [start + (my_row * tier["step"]) for my_row in xrange(rows)], my_values
+
+	def close(self):
+		self._map.flush()
+		self._map.close()
+
+def flow_recorder(settings, controller):
+	"""flow_recorder - a OSPIEventIngest flow listener that keeps the flow for the controller, and for each running station"""
+	my_histories = {}
+	def record_ingest(ingest):
+		my_flow = ingest.opcs.flow_value
+		if my_flow == None:
+			return
+		my_series = [controller] + ["{0}.zone{1}".format(controller, my_sid) for my_sid, my_state in enumerate(ingest.station_states) if my_state]
+		my_now = time.time()
+		for my_name in my_series:
+			ofh = my_histories.get(my_name)
+			if ofh == None:
+				ofh = OSPIFlowHistory.from_settings(settings, my_name)
+				my_histories[my_name] = ofh
+			ofh.record(my_now, my_flow)
+	return record_ingest
+
+################################################################################
+# RUN AS SCRIPT
+################################################################################
+
+if __name__ == "__main__":
+	from OSPIUtility import OSPIReadSettings
+	my_settings = OSPIReadSettings().add_settings()
+	ofh = OSPIFlowHistory.from_settings(my_settings, sys.argv[1])
+	my_tier = sys.argv[2] if len(sys.argv) > 2 else "day"
+	my_days = float(sys.argv[3]) if len(sys.argv) > 3 else 365
+	my_read = ofh.read(my_tier, time.time() - (my_days * 86400))
+	for my_count, my_time in enumerate(my_read["ts"]):
+		my_values = [my_read[my_name][my_count] for my_name in ("value", "min", "avg", "max") if my_name in my_read]
+		print "{0} {1}".format(time.strftime('%m/%d/%Y %H:%M:%S', time.localtime(my_time)), " ".join(str(my_value) for my_value in my_values))
+	print "{0} rows, {1} bytes read".format(len(my_read["ts"]), ofh.bytes_read)
@@ -36,6 +36,17 @@
 ################################################################################
 import OSPIUtility, logging, time
 from OSPIUtility import *
+from OSPILogRetention import OSPILogRetention
+from OSPISnapshotCache import OSPISnapshotCache
+from OSPISingleFlight import OSPISingleFlight
+from OSPIPipeline import OSPIPipeline
+from OSPILogDecoder import OSPILogDecoder
+from OSPIControllerHealth import OSPIControllerHealth
+from OSPIRequestScheduler import OSPIRequestScheduler
+from OSPICassette import OSPICassette
+from OSPIFleetReport import OSPIFleetReport
+from OSPIResponseCache import OSPIResponseCache
+from OSPIJobScheduler import OSPIJobScheduler
 
 ################################################################################
 # LOGGING
@@ -55,94 +66,170 @@ log.addHandler(logger1)
 
 def main():
 
-	my_run = 0
-	my_date = None
-
-	# Check stations and return content
 	ors = OSPIReadSettings()
 	my_settings = ors.add_settings()
-	my_ospi_ip = my_settings['open_sprinkler_ip']
-	my_ospi_pass = my_settings['md5_pass']
-	my_ospi_email = my_settings['email_login_user']
-	my_ospi_email_pass = my_settings['email_passwd']
-	my_ospi_email_from = my_settings['email_from']
-	my_ospi_email_to = my_settings['email_to']
-	opcs = OSPICheckStatus(my_ospi_ip,my_ospi_pass)
-	cno = CreateNotificationObject()
-	cno.create_header()
-
-	# Stations names is a dict
-	opcs.return_station_names()
+	OSPIRequestScheduler.configure(my_settings)
+	OSPIResponseCache.configure(my_settings)
+	OSPIJobScheduler.configure(my_settings)
+	OSPICassette.from_settings(my_settings)
+	run_logs(my_settings, ors.return_controllers())
+
+def run_logs(settings, controllers, fleet=None):
+	"""run_logs - the daily log report for each of controllers (a OSPIShard worker passes just its own, and every controller as fleet), returns the names of the ones that went through"""
+	if fleet == None:
+		fleet = controllers
+
+	# Every controller goes through fetch, decode, archive, render and deliver,
+	# and all the stages run at the same time
+	my_workers = settings.get('pipeline_workers', {})
+	osf = OSPISingleFlight.from_settings(settings)
+
+	opl = OSPIPipeline(settings.get('pipeline_queue_size', 4))
+	opl.add_stage("fetch", lambda my_context: fetch_logs(settings, osf, my_context), my_workers.get("fetch", 4))
+	opl.add_stage("decode", decode_logs, my_workers.get("decode", 1))
+	opl.add_stage("archive", archive_logs, my_workers.get("archive", 1))
+	opl.add_stage("render", render_logs, my_workers.get("render", 1))
+	opl.add_stage("deliver", lambda my_context: deliver_logs(settings, my_context), my_workers.get("deliver", 1))
+
+	# Controllers that are known to be down are skipped until they're due a probe, and reported on their own,
+	# and each controller goes in at its own spot in the schedule window
+	my_live, my_dead = OSPIControllerHealth.split_fleet(settings, controllers)
+	ojs = OSPIJobScheduler.from_settings(settings)
+	my_contexts = [{"controller": my_controller, "fleet": len(fleet) > 1, "done": False} for my_controller in my_live]
+	my_report = opl.run(ojs.stagger(my_contexts, lambda my_context: my_context["controller"]['name'], "log"))
+	for my_stage in my_report:
+		log.debug("OSPIGetLogInfo:run_logs: {stage} {items} items, {errors} errors, {busy}s busy, {throughput} items/s".format(**my_stage))
+	if my_dead:
+		report_dead_controllers(settings, my_dead)
+
+	# The report files come from the archive, so they wait until every controller's logs are in it
+	ofr = OSPIFleetReport.from_settings(settings)
+	if ofr:
+		ofr.generate(my_live, None, fleet)
+	log.debug("OSPIGetLogInfo:run_logs: response cache {0}".format(OSPIResponseCache.shared().report()))
+	return [my_context["controller"]['name'] for my_context in my_contexts if my_context["done"]]
+
+def fetch_logs(settings, single_flight, context):
+	"""fetch_logs - station names and the runs still on the controller"""
+	my_controller = context["controller"]
+	my_controller_name = my_controller['name']
+	och = OSPIControllerHealth.from_settings(settings, my_controller_name)
+	opcs = OSPICheckStatus(my_controller['open_sprinkler_ip'],my_controller['md5_pass'],single_flight,och,settings.get('query_timeout', QUERY_TIMEOUT))
+
+	# Stations names is a dict, from the snapshot when a run in the last "snapshot_max_age" seconds saved one
+	ossc = OSPISnapshotCache.from_settings(settings, my_controller_name)
+	ossc.warm_start(opcs)
 	my_station_names = opcs.station_names
-	my_stations_list = my_station_names.get("snames")
-
-	# First pass over the list for each run
-	opcs.return_log_data()
+	if not my_station_names:
+		log.error("OSPIGetLogInfo: {0} NO STATION NAMES, SKIPPING".format(my_controller_name))
+		return None
+
+	# First pass over the list for each run, everything still on the controller
+	olr = OSPILogRetention.from_settings(settings, my_controller_name)
+	olr.set_controller_clock(opcs.controller_values)
+	with OSPIJobScheduler.slot("controller", my_controller_name):
+		opcs.return_log_data(olr.history_days())
 	my_return = opcs.program_data
 
 	if not my_return:
-		log.debug("OSPIGetLogInfo: NO LOG DATA TO PARSE, QUITTING")
-		sys.exit(0)
-
-	for run in my_return:
-		my_run += 1
-		my_tmp_date = my_date
-
-		# The date for the run
-		my_run_time = run[3]
-		log.debug("OSPIGetLogInfo: my_run_time {0}".format(my_run_time))
-		my_date = time.strftime('%m/%d/%Y', time.gmtime(my_run_time))
-		log.debug("OSPIGetLogInfo: my_date {0}".format(my_date))
-		# See if we need a new date section
-		if my_date != my_tmp_date:
-			# See if we already had a previous section
-			if my_tmp_date != None:
-				# Close the section
-				cno.conjure_context("</table>")
-			
-			my_tmp_date = my_date # Set new tmp date
-			cno.create_table(my_date)
-
-		# The zone start time
-		my_time = time.strftime('%H:%M', time.gmtime(my_run_time))
-		log.debug("OSPIGetLogInfo: my_time {0}".format(my_time))
-
-		# Get the station id and name
-		my_raw_zone = run[1]
-		my_named_zone = my_stations_list[my_raw_zone]
-		my_zone = "Zone {0} {1}".format(my_raw_zone, my_named_zone)
-		log.debug("OSPIGetLogInfo:main: Adding zone information {0}".format(my_zone))
-
-		# Get the run time in minutes, if it's zero seconds, don't add it to the report
-		my_run_return = run[2]
-		my_min, my_sec = divmod(my_run_return, 60)
-		if my_sec != 0:
-			my_run_time = "{0}m:{1}s".format(my_min, my_sec)
-		else:
-			my_run_time = "{0}m".format(my_min)
+		log.debug("OSPIGetLogInfo: {0} NO LOG DATA TO PARSE, SKIPPING".format(my_controller_name))
+		context["done"] = opcs.program_data != None
+		return None
+
+	context["opcs"] = opcs
+	context["retention"] = olr
+	context["stations"] = my_station_names.get("snames")
+	context["runs"] = my_return
+	return context
+
+def decode_logs(context):
+	"""decode_logs - turn the runs into columns and the report rows (date, start time, duration, zone)"""
+	oldc = OSPILogDecoder(context["stations"])
+	oldc.decode(context["runs"])
+	context["decoder"] = oldc
+	context["rows"] = oldc.rows()
+	log.debug("OSPIGetLogInfo:decode_logs: {0} decoded {1} runs".format(context["controller"]['name'], oldc.count))
+	return context
+
+def archive_logs(context):
+	"""archive_logs - keep a columnar copy of the runs, then trim the days that are safely in the archive off the controller"""
+	olr = context["retention"]
+	olr.archive_and_acknowledge(context["runs"])
+	with OSPIJobScheduler.slot("controller", context["controller"]['name']):
+		olr.trim(context["opcs"])
+	return context
+
+def render_logs(context):
+	"""render_logs - the html report, a table for each day that has runs not reported yet"""
+	oldc = context["decoder"]
+	my_new = oldc.first_after(context["retention"].reported_until())
+	if my_new >= oldc.count:
+		log.debug("OSPIGetLogInfo:render_logs: {0} NO NEW RUNS SINCE THE LAST REPORT, SKIPPING".format(context["controller"]['name']))
+		context["done"] = True
+		return None
 
-		my_add_to_body = """
+	cno = CreateNotificationObject()
+	cno.create_header()
+	my_rows = context["rows"]
+	for my_day, my_first, my_last in oldc.group_by_day():
+		# A table for each day, the rows are already in end time order
+		if my_last <= my_new:
+			continue
+		my_first = max(my_first, my_new)
+		cno.create_table(my_rows[my_first][0])
+		for my_row_date, my_time, my_run_time, my_zone in my_rows[my_first:my_last]:
+			my_add_to_body = """
 				<tr>
 					<td>{0}</td>
 					<td>{1}</td>
 					<td>{2}</td>
 				</tr>
 				""".format(my_time,my_run_time,my_zone)
-		cno.conjure_context(my_add_to_body)
-		log.debug("OSPIGetLogInfo:main: created html_report {0}".format(my_add_to_body))
+			cno.conjure_context(my_add_to_body)
+		cno.conjure_context("</table>")
 
-	# Make sure the table is closed
-	cno.conjure_context("</table>")
-
-	# Delete logs (since the log function isn't great right now anyway)
-	opcs.remove_logs()
+	context["body"] = cno.conjure_finished_html()
+	context["reported_until"] = int(oldc.column("end")[-1])
+	return context
 
-	# Send a EMAIL every day with the log
-	osem = OSPIEmail(my_ospi_email,my_ospi_email_pass,my_ospi_email_from,my_ospi_email_to)
+def deliver_logs(settings, context):
+	"""deliver_logs - send a EMAIL every day with the log"""
+	osem = OSPIEmail(settings['email_login_user'],settings['email_passwd'],settings['email_from'],settings['email_to'])
 
 	my_subject = "Daily watering report"
-	my_body = cno.conjure_finished_html()
-	osem.send_email_message(my_subject,my_body)
+	if context["fleet"]:
+		my_subject = "{0} - {1}".format(my_subject, context["controller"]['name'])
+	osem.send_email_message(my_subject,context["body"])
+	context["retention"].mark_reported(context["reported_until"])
+	context["done"] = True
+	return context
+
+def report_dead_controllers(settings, dead):
+	"""report_dead_controllers - one EMAIL listing the controllers that were skipped"""
+	cno = CreateNotificationObject()
+	cno.create_header()
+	cno.conjure_context("""
+				<table border="0" width="350">
+					<tr>
+						<th align="left">Not answering</th>
+						<th align="left">Health</th>
+						<th align="left">Last error</th>
+					</tr>
+		""")
+	for my_controller, och in dead:
+		my_summary = och.summary()
+		my_add_to_body = """
+				<tr>
+					<td>{0}</td>
+					<td>score {1}</td>
+					<td>{2}</td>
+				</tr>
+				""".format(my_controller['name'],my_summary["score"],my_summary["last_error"])
+		cno.conjure_context(my_add_to_body)
+	cno.conjure_context("</table>")
+
+	osem = OSPIEmail(settings['email_login_user'],settings['email_passwd'],settings['email_from'],settings['email_to'])
+	osem.send_email_message("Controllers not answering",cno.conjure_finished_html())
 
 class CreateNotificationObject(object):
 
@@ -189,4 +276,5 @@ class CreateNotificationObject(object):
 		my_final = "{0}{1}{2}".format(self.html_header,self.html_body,self.html_footer)
 		return my_final
 
-main()
+if __name__ == "__main__":
+	main()
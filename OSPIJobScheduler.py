@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPIJobScheduler.py
+
+	DESCRIPTION:
+	Spread the fleet's jobs (log pulls, weather adjustments) over a
+	window instead of firing them all at the same cron minute, and cap
+	how many calls use each outside service at once.
+
+	NOTES:
+	Each job's start offset is a hash of the controller and job type, so
+	the same job lands at the same spot in the window every run, and the
+	fleet ends up evenly spread across it. A run with one job starts it
+	straight away.
+
+	"schedule_window" : 600 (seconds)
+	"schedule_limits" : {"controller": 1, "weather": 2, "smtp": 1, "uplink": 4}
+	"schedule_lock_dir" : "/tmp"
+
+	"controller" is the limit for each controller, a job holds its own
+	controller's slot while it runs. The other services are held only
+	around the call that uses them:
+
+	with OSPIJobScheduler.slot("smtp"):
+		server.sendmail(...)
+
+	The weather service and smtp go out over the uplink, so their slots
+	take a uplink slot too, always in name order so two calls can't
+	deadlock.
+
+	The limits hold across every process on the box, OSPIGetLogData.py,
+	OSPIAdjustProgramData.py and each OSPIShard.py worker run their jobs
+	through here. Each slot is a flock'd file (OSPISlotLock),
+	/tmp/ospi_slot_<service>[_<controller>].<n>.lock
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import os, re, logging, time, threading, hashlib, contextlib
+from OSPISlotLock import OSPISlotLock
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospijobscheduler')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospijobscheduler.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CONSTANTS
+################################################################################
+# The services a service's calls go through as well
+SERVICE_ROUTES = {
+	"weather": ["uplink"],
+	"smtp": ["uplink"],
+}
+
+DEFAULT_LIMITS = {"controller": 1, "weather": 2, "smtp": 1, "uplink": 4}
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPIJob(object):
+	"""OSPIJob - one job for one controller"""
+
+	def __init__(self, controller, job_type, call):
+		self.controller = controller
+		self.job_type = job_type
+		self.call = call
+		self.offset = None
+		self.started = None
+		self.finished = None
+		self.result = None
+		self.error = None
+
+class OSPIJobScheduler(object):
+	"""OSPIJobScheduler - runs the fleet's jobs spread over a window, with a cap per service"""
+
+	limits = dict(DEFAULT_LIMITS)
+	lock_dir = "/tmp"
+	_slots = {}
+	_slots_lock = threading.Lock()
+
+	def __init__(self, window=600):
+		self.window = window
+		self.jobs = []
+
+	@classmethod
+	def configure(cls, settings):
+		# Sets the limits, the slots start again
+		my_limits = dict(DEFAULT_LIMITS)
+		my_limits.update(settings.get('schedule_limits') or {})
+		with cls._slots_lock:
+			cls.limits = my_limits
+			cls.lock_dir = settings.get('schedule_lock_dir', "/tmp")
+			for my_slots in cls._slots.values():
+				my_slots.close()
+			cls._slots = {}
+
+	@classmethod
+	def from_settings(cls, settings):
+		return cls(settings.get('schedule_window', 600))
+
+	@classmethod
+	def slots_for(cls, service, key=None):
+		"""slots_for - the OSPISlotLock every process shares for service (and key)"""
+		with cls._slots_lock:
+			my_slots = cls._slots.get((service, key))
+			if my_slots == None:
+				my_name = service if key == None else "{0}_{1}".format(service, key)
+				my_path = os.path.join(cls.lock_dir, "ospi_slot_{0}".format(re.sub(r'[^A-Za-z0-9.\-]+', '_', my_name)))
+				my_slots = OSPISlotLock(my_path, max(1, cls.limits.get(service, 1)))
+				cls._slots[(service, key)] = my_slots
+			return my_slots
+
+	@classmethod
+	@contextlib.contextmanager
+	def slot(cls, service, key=None):
+		"""slot - hold a slot on service (key is the controller for "controller") for the length of a with"""
+		my_taken = []
+		try:
+			for my_service in sorted([service] + SERVICE_ROUTES.get(service, [])):
+				my_slots = cls.slots_for(my_service, key if my_service == service else None)
+				my_taken.append((my_slots, my_slots.acquire()))
+			yield
+		finally:
+			for my_slots, my_index in reversed(my_taken):
+				my_slots.release(my_index)
+
+	################################################################################
+	# FUNCTIONS
+	################################################################################
+	def offset_for(self, controller, job_type, count=2):
+		# Where in the window the job starts, the same every run. Nothing to spread out with one job
+		if count <= 1:
+			return 0.0
+		my_hash = hashlib.md5("{0}:{1}".format(controller, job_type)).hexdigest()
+		return (int(my_hash[:8], 16) / float(0xffffffff)) * self.window
+
+	def add_job(self, controller, job_type, call):
+		my_job = OSPIJob(controller, job_type, call)
+		my_job.offset = self.offset_for(controller, job_type)
+		self.jobs.append(my_job)
+		return my_job
+
+	def plan(self):
+		if len(self.jobs) == 1:
+			self.jobs[0].offset = 0.0
+		return sorted(self.jobs, key=lambda my_job: my_job.offset)
+
+	def load_profile(self, bucket=60):
+		# How many jobs start in each bucket of the window
+		my_profile = [0] * (int(self.window // bucket) + 1)
+		for my_job in self.jobs:
+			my_profile[int(my_job.offset // bucket)] += 1
+		return my_profile
+
+	def stagger(self, items, controller_of, job_type):
+		"""stagger - yields each of items at its controller's offset in the window, to feed a OSPIPipeline"""
+		my_items = list(items)
+		my_planned = sorted((self.offset_for(controller_of(my_item), job_type, len(my_items)), my_count, my_item) for my_count, my_item in enumerate(my_items))
+		my_start = time.time()
+		for my_offset, my_count, my_item in my_planned:
+			my_wait = (my_start + my_offset) - time.time()
+			if my_wait > 0:
+				time.sleep(my_wait)
+			log.debug("OSPIJobScheduler:stagger: starting {0} {1} at offset {2:.1f}".format(controller_of(my_item), job_type, my_offset))
+			yield my_item
+
+	def run_job(self, job):
+		try:
+			with self.slot("controller", job.controller):
+				job.started = time.time()
+				log.debug("OSPIJobScheduler:run_job: starting {0} {1} at offset {2:.1f}".format(job.controller, job.job_type, job.offset))
+				job.result = job.call()
+		except Exception, e:
+			job.error = e
+			log.error("OSPIJobScheduler:run_job: {0} {1} failed, received error {2}".format(job.controller, job.job_type, e))
+		finally:
+			job.finished = time.time()
+
+	def run(self):
+		"""run - start every job at its offset from now, and wait for them all to finish, returns the jobs that raised"""
+		my_start = time.time()
+		my_threads = []
+		for my_job in self.plan():
+			my_wait = (my_start + my_job.offset) - time.time()
+			if my_wait > 0:
+				time.sleep(my_wait)
+			my_thread = threading.Thread(target=self.run_job, args=(my_job,))
+			my_thread.daemon = True
+			my_thread.start()
+			my_threads.append(my_thread)
+		for my_thread in my_threads:
+			my_thread.join()
+
+		my_failed = [my_job for my_job in self.jobs if my_job.error != None]
+		log.debug("OSPIJobScheduler:run: {0} jobs in {1:.1f} seconds, {2} failed".format(len(self.jobs), time.time() - my_start, len(my_failed)))
+		return my_failed
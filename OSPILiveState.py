@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPILiveState.py
+
+	DESCRIPTION:
+	The latest state of every controller (which stations are on, the flow
+	value and when it was last updated), kept in a memory mapped file by
+	the long running poller. Anything on the Pi can read it in a few
+	microseconds, without going to the controller.
+
+	NOTES:
+	/dev/shm/ospi_live_state (or "live_state_path")
+
+	header  8s magic, H version, H slot size, I slot count
+	slot    Q sequence, 48s controller name, 32s station bitmask
+	        (256 stations), H station count, 6x pad, d flow value
+	        (NaN when unknown), d updated time
+
+	A writer (the poller, each OSPIShard worker) makes the slot's
+	sequence odd while it's writing and even again when it's done, so a
+	reader just reads the slot again if the sequence was odd or moved
+	under it. No locks for readers and no HTTP. Writers take a flock on
+	<path>.lock for the length of a write, so two of them never pick the
+	same free slot for different controllers.
+
+	A writer that died half way through leaves the sequence odd (and the
+	kernel lets go of its lock), the next writer makes it even again when
+	it opens the file. Until then a
+	reader gives up after a few tries (a couple of milliseconds) and gets
+	None, same as a controller that isn't published or a file that isn't
+	there yet.
+
+	python OSPILiveState.py [controller]
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import os, sys, logging, struct, mmap, time, math, errno, fcntl
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospilivestate')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospilivestate.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CONSTANTS
+################################################################################
+LIVE_MAGIC = "OSPILIVE"
+LIVE_VERSION = 1
+LIVE_HEADER = struct.Struct('<8sHHI')
+LIVE_SEQUENCE = struct.Struct('<Q')
+LIVE_BODY = struct.Struct('<48s32sH6xdd')
+LIVE_SLOT_SIZE = LIVE_SEQUENCE.size + LIVE_BODY.size
+LIVE_MAX_STATIONS = 256
+
+# How many times a reader tries a slot that's being written, and how long it waits between
+LIVE_READ_TRIES = 20
+LIVE_READ_PAUSE = 0.00005
+
+if os.path.isdir("/dev/shm"):
+	LIVE_STATE_PATH = "/dev/shm/ospi_live_state"
+else:
+	LIVE_STATE_PATH = "/tmp/ospi_live_state"
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPILiveState(object):
+	"""OSPILiveState - fixed layout shared memory of every controller's latest state"""
+
+	def __init__(self, path=LIVE_STATE_PATH, slots=256, writer=False):
+		self.path = path
+		self.writer = writer
+		self.slots = 0
+		self._slot_index = {}
+		self._map = None
+		self._lock_file = None
+
+		if writer and not os.path.exists(path):
+			self.create(slots)
+
+		# A reader that starts before the poller has made the file opens it on the first read after
+		if writer or os.path.exists(path):
+			self.open_map()
+		if writer:
+			self._lock_file = open("{0}.lock".format(path), 'a')
+			fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+			try:
+				self.finish_writes()
+			finally:
+				fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+	@classmethod
+	def from_settings(cls, settings, writer=False):
+		return cls(settings.get('live_state_path', LIVE_STATE_PATH), settings.get('live_state_slots', 256), writer)
+
+	################################################################################
+	# FUNCTIONS
+	################################################################################
+	def create(self, slots):
+		my_tmp_path = "{0}.{1}".format(self.path, os.getpid())
+		my_file = open(my_tmp_path, 'wb')
+		my_file.write(LIVE_HEADER.pack(LIVE_MAGIC, LIVE_VERSION, LIVE_SLOT_SIZE, slots))
+		my_file.write("\0" * (slots * LIVE_SLOT_SIZE))
+		my_file.close()
+		# A link rather than a rename, when another writer got there first we use its file
+		try:
+			os.link(my_tmp_path, self.path)
+			log.debug("OSPILiveState:create: created {0} with {1} slots".format(self.path, slots))
+		except OSError, e:
+			if e.errno != errno.EEXIST:
+				raise
+		finally:
+			os.remove(my_tmp_path)
+
+	def open_map(self):
+		my_file = open(self.path, 'r+b' if self.writer else 'rb')
+		try:
+			my_map = mmap.mmap(my_file.fileno(), 0, access=mmap.ACCESS_WRITE if self.writer else mmap.ACCESS_READ)
+		finally:
+			my_file.close()
+
+		my_magic, my_version, my_slot_size, my_slots = LIVE_HEADER.unpack_from(my_map, 0)
+		if my_magic != LIVE_MAGIC or my_version != LIVE_VERSION or my_slot_size != LIVE_SLOT_SIZE:
+			my_map.close()
+			raise ValueError("{0} is not a live state file we know".format(self.path))
+		self._map = my_map
+		self.slots = my_slots
+
+	def readable(self):
+		if self._map == None and os.path.exists(self.path):
+			self.open_map()
+		return self._map != None
+
+	def finish_writes(self):
+		# A writer that died in the middle of publish left the sequence odd, make it even again.
+		# Called with the lock, so no live writer is in the middle of one
+		for my_slot in xrange(self.slots):
+			my_offset = self.slot_offset(my_slot)
+			my_sequence = LIVE_SEQUENCE.unpack_from(self._map, my_offset)[0]
+			if my_sequence & 1:
+				LIVE_SEQUENCE.pack_into(self._map, my_offset, my_sequence + 1)
+				log.error("OSPILiveState:finish_writes: slot {0} was left half written, it's readable again".format(my_slot))
+
+	def slot_offset(self, slot):
+		return LIVE_HEADER.size + (slot * LIVE_SLOT_SIZE)
+
+	def find_slot(self, controller):
+		# The slot index is only a hint, the name in the slot is checked every time
+		my_name = controller.encode('utf-8')[:48]
+		my_slot = self._slot_index.get(my_name)
+		if my_slot != None and self._map[self.slot_offset(my_slot) + LIVE_SEQUENCE.size:self.slot_offset(my_slot) + LIVE_SEQUENCE.size + 48].rstrip("\0") == my_name:
+			return my_slot
+
+		my_empty = None
+		for my_slot in xrange(self.slots):
+			my_offset = self.slot_offset(my_slot) + LIVE_SEQUENCE.size
+			my_slot_name = self._map[my_offset:my_offset + 48].rstrip("\0")
+			if my_slot_name == my_name:
+				self._slot_index[my_name] = my_slot
+				return my_slot
+			if my_slot_name == "" and my_empty == None:
+				my_empty = my_slot
+				if not self.writer:
+					break
+		if not self.writer:
+			return None
+		if my_empty == None:
+			raise ValueError("OSPILiveState: no free slot for {0}, raise live_state_slots".format(controller))
+		self._slot_index[my_name] = my_empty
+		return my_empty
+
+	def publish(self, controller, station_states, flow_value, updated=None):
+		"""publish - write the controller's latest state (writer only)"""
+		fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+		try:
+			self.write_slot(controller, station_states, flow_value, updated)
+		finally:
+			fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+	def write_slot(self, controller, station_states, flow_value, updated):
+		my_slot = self.find_slot(controller)
+		my_offset = self.slot_offset(my_slot)
+
+		my_bitmask = 0
+		for my_count, my_state in enumerate(station_states[:LIVE_MAX_STATIONS]):
+			if my_state:
+				my_bitmask |= 1 << my_count
+		my_bits = "".join(chr((my_bitmask >> (my_byte * 8)) & 0xff) for my_byte in xrange(LIVE_MAX_STATIONS // 8))
+		my_flow = float('nan') if flow_value == None else float(flow_value)
+		my_body = LIVE_BODY.pack(controller.encode('utf-8')[:48], my_bits, min(len(station_states), LIVE_MAX_STATIONS), my_flow, updated or time.time())
+
+		# Odd sequence while we write, even again when we're done
+		my_sequence = LIVE_SEQUENCE.unpack_from(self._map, my_offset)[0]
+		LIVE_SEQUENCE.pack_into(self._map, my_offset, my_sequence + 1)
+		self._map[my_offset + LIVE_SEQUENCE.size:my_offset + LIVE_SLOT_SIZE] = my_body
+		LIVE_SEQUENCE.pack_into(self._map, my_offset, my_sequence + 2)
+
+	def publisher(self, controller):
+		"""publisher - a OSPIEventIngest listener that publishes every change"""
+		def publish_ingest(ingest):
+			self.publish(controller, ingest.station_states, ingest.opcs.flow_value)
+		return publish_ingest
+
+	def read(self, controller):
+		"""read - returns {"stations", "flow_value", "updated", "running"} or None when the controller isn't published (or the slot's stuck mid write)"""
+		if not self.readable():
+			return None
+		my_slot = self.find_slot(controller)
+		if my_slot == None:
+			return None
+		my_offset = self.slot_offset(my_slot)
+
+		for my_try in xrange(LIVE_READ_TRIES):
+			my_before = LIVE_SEQUENCE.unpack_from(self._map, my_offset)[0]
+			if not my_before & 1:
+				my_name, my_bits, my_count, my_flow, my_updated = LIVE_BODY.unpack_from(self._map, my_offset + LIVE_SEQUENCE.size)
+				if LIVE_SEQUENCE.unpack_from(self._map, my_offset)[0] == my_before:
+					break
+			# The writer's in the middle of it, give it a moment
+			time.sleep(LIVE_READ_PAUSE)
+		else:
+			log.error("OSPILiveState:read: {0} was being written for all of {1} tries, giving up".format(controller, LIVE_READ_TRIES))
+			return None
+
+		my_stations = [(ord(my_bits[my_station // 8]) >> (my_station % 8)) & 1 for my_station in xrange(my_count)]
+		return {
+			"stations": my_stations,
+			"running": any(my_stations),
+			"flow_value": None if math.isnan(my_flow) else my_flow,
+			"updated": my_updated,
+		}
+
+	def controllers(self):
+		my_names = []
+		if not self.readable():
+			return my_names
+		for my_slot in xrange(self.slots):
+			my_offset = self.slot_offset(my_slot) + LIVE_SEQUENCE.size
+			my_name = self._map[my_offset:my_offset + 48].rstrip("\0")
+			if my_name == "":
+				break
+			my_names.append(my_name.decode('utf-8'))
+		return my_names
+
+	def close(self):
+		if self._map != None:
+			self._map.close()
+			self._map = None
+		if self._lock_file != None:
+			self._lock_file.close()
+			self._lock_file = None
+
+################################################################################
+# RUN AS SCRIPT
+################################################################################
+
+if __name__ == "__main__":
+	from OSPIUtility import OSPIReadSettings
+	olsr = OSPILiveState.from_settings(OSPIReadSettings().add_settings())
+	for my_controller in sys.argv[1:] or olsr.controllers():
+		my_state = olsr.read(my_controller)
+		if my_state == None:
+			print "{0}: not published".format(my_controller)
+			continue
+		my_running = [str(my_station + 1) for my_station, my_on in enumerate(my_state["stations"]) if my_on]
+		print "{0}: stations running {1}, flow {2}, updated {3:.0f}s ago".format(my_controller, ", ".join(my_running) or "none", my_state["flow_value"], time.time() - my_state["updated"])
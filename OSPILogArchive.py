@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPILogArchive.py
+
+	DESCRIPTION:
+	A local archive of the run records (/jl) and flow samples, written in
+	a compact columnar format, partitioned by controller and month, so a
+	year of data can be loaded for analysis without going back to the
+	controller or parsing the html reports.
+
+	NOTES:
+	<archive_dir>/<controller>/<YYYY-MM> -> <YYYY-MM>.v<ms>-<pid>/runs.pid.npy
+	                                                             runs.sid.npy
+	                                    runs.dur.npy
+	                                    runs.end.npy
+	                                    flow.ts.npy
+	                                    flow.value.npy
+
+	Each column is a little endian int64 .npy file, which numpy can load
+	with mmap_mode='r'. We write the .npy files ourselves when numpy isn't
+	installed (the Pi doesn't always have it). With "archive_format" set to
+	"parquet" and pyarrow installed, each partition is a runs.parquet and
+	flow.parquet instead.
+
+	A partition is rewritten into a new version directory, and the
+	<YYYY-MM> symlink is swapped over to it with a rename, which is
+	atomic, so a reader always finds a whole partition, old or new. The
+	version before is kept until the next write, for a reader that was
+	part way through opening it. A partition from before the symlinks is
+	moved into a version directory on its next write, the one time a
+	reader can briefly miss it.
+
+	A writer holds a flock on <archive_dir>/<controller>/<YYYY-MM>.lock
+	from reading the partition to pruning the old versions, so two runs
+	archiving the same month (overlapping cron runs, a shard worker) take
+	turns, neither loses the other's rows and neither prunes a version
+	the other is building from.
+
+	load() hands back each partition's columns on their own, memory
+	mapped, joining them would copy every one.
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import os, logging, struct, time, re, shutil, ast, fcntl, contextlib
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+try:
+	import pyarrow, pyarrow.parquet
+except ImportError:
+	pyarrow = None
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospilogarchive')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospilogarchive.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CONSTANTS
+################################################################################
+RUN_COLUMNS = ["pid", "sid", "dur", "end"]
+FLOW_COLUMNS = ["ts", "value"]
+NPY_MAGIC = "\x93NUMPY\x01\x00"
+
+################################################################################
+# FUNCTIONS
+################################################################################
+
+def write_column(path, values):
+	"""write_column - write a list of ints as a little endian int64 .npy file"""
+	if numpy != None:
+		numpy.save(path, numpy.asarray(values, dtype='<i8'))
+		return
+
+	my_header = "{{'descr': '<i8', 'fortran_order': False, 'shape': ({0},), }}".format(len(values))
+	# The header is padded with spaces and a newline so the data starts on a 16 byte boundary
+	my_padding = 16 - ((len(NPY_MAGIC) + 2 + len(my_header) + 1) % 16)
+	my_header = my_header + (" " * my_padding) + "\n"
+	my_file = open(path, 'wb')
+	my_file.write(NPY_MAGIC)
+	my_file.write(struct.pack('<H', len(my_header)))
+	my_file.write(my_header)
+	my_file.write(struct.pack('<{0}q'.format(len(values)), *values))
+	my_file.close()
+
+def read_column(path, mmap=True):
+	"""read_column - read an int64 .npy column, memory mapped when numpy is around"""
+	if numpy != None:
+		return numpy.load(path, mmap_mode='r' if mmap else None)
+
+	my_file = open(path, 'rb')
+	my_file.read(len(NPY_MAGIC))
+	my_header_size = struct.unpack('<H', my_file.read(2))[0]
+	my_header = ast.literal_eval(my_file.read(my_header_size))
+	my_count = my_header['shape'][0]
+	my_values = list(struct.unpack('<{0}q'.format(my_count), my_file.read(my_count * 8)))
+	my_file.close()
+	return my_values
+
+def fsync_path(path):
+	my_fd = os.open(path, os.O_RDONLY)
+	try:
+		os.fsync(my_fd)
+	finally:
+		os.close(my_fd)
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPILogArchive(object):
+	"""OSPILogArchive - columnar archive of run records and flow samples"""
+
+	def __init__(self, archive_dir, archive_format="npy"):
+		self.archive_dir = archive_dir
+		self.archive_format = archive_format
+		if archive_format == "parquet" and pyarrow == None:
+			log.error("OSPILogArchive: pyarrow is not installed, archiving as npy instead")
+			self.archive_format = "npy"
+
+	@classmethod
+	def from_settings(cls, settings):
+		my_default_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'archive')
+		return cls(settings.get('archive_dir', my_default_dir), settings.get('archive_format', "npy"))
+
+	################################################################################
+	# FUNCTIONS
+	################################################################################
+	def controller_path(self, controller):
+		return os.path.join(self.archive_dir, re.sub(r'[^A-Za-z0-9.\-]+', '_', controller))
+
+	def partition_path(self, controller, month):
+		return os.path.join(self.controller_path(controller), month)
+
+	def list_partitions(self, controller):
+		my_path = self.controller_path(controller)
+		if not os.path.isdir(my_path):
+			return []
+		return sorted(my_month for my_month in os.listdir(my_path) if re.match(r'^\d{4}-\d{2}$', my_month))
+
+	def list_versions(self, controller, month):
+		my_path = self.controller_path(controller)
+		if not os.path.isdir(my_path):
+			return []
+		return sorted(my_name for my_name in os.listdir(my_path) if my_name.startswith("{0}.v".format(month)))
+
+	def read_table(self, controller, month, table, columns, mmap=True):
+		my_path = self.partition_path(controller, month)
+		if os.path.exists(os.path.join(my_path, "{0}.parquet".format(table))):
+			my_table = pyarrow.parquet.read_table(os.path.join(my_path, "{0}.parquet".format(table)), memory_map=mmap)
+			return dict((my_column, my_table.column(my_column).to_pylist()) for my_column in columns)
+		if not os.path.exists(os.path.join(my_path, "{0}.{1}.npy".format(table, columns[0]))):
+			return None
+		return dict((my_column, read_column(os.path.join(my_path, "{0}.{1}.npy".format(table, my_column)), mmap)) for my_column in columns)
+
+	@contextlib.contextmanager
+	def partition_lock(self, controller, month):
+		"""partition_lock - every other writer of the partition kept out for the length of a with"""
+		if not os.path.isdir(self.controller_path(controller)):
+			os.makedirs(self.controller_path(controller))
+		# A flock is on the open file, so threads with their own open take turns too
+		my_lock_file = open("{0}.lock".format(self.partition_path(controller, month)), 'a')
+		try:
+			fcntl.flock(my_lock_file.fileno(), fcntl.LOCK_EX)
+			yield
+		finally:
+			my_lock_file.close()
+
+	def write_partition(self, controller, month, tables):
+		with self.partition_lock(controller, month):
+			self.swap_partition(controller, month, tables)
+
+	def swap_partition(self, controller, month, tables):
+		# Write the whole partition as a new version, then point the symlink at it. Called with the partition lock
+		my_path = self.partition_path(controller, month)
+		my_version = "{0}.v{1:013d}-{2}".format(month, int(time.time() * 1000), os.getpid())
+		my_tmp_path = os.path.join(self.controller_path(controller), my_version)
+		if os.path.exists(my_tmp_path):
+			shutil.rmtree(my_tmp_path)
+		os.makedirs(my_tmp_path)
+
+		for my_table, my_columns in tables.iteritems():
+			if self.archive_format == "parquet":
+				my_file = os.path.join(my_tmp_path, "{0}.parquet".format(my_table))
+				pyarrow.parquet.write_table(pyarrow.table(my_columns), my_file)
+				fsync_path(my_file)
+				continue
+			for my_column, my_values in my_columns.iteritems():
+				my_file = os.path.join(my_tmp_path, "{0}.{1}.npy".format(my_table, my_column))
+				write_column(my_file, my_values)
+				fsync_path(my_file)
+
+		# A partition from before the symlinks becomes a version of its own first
+		if os.path.isdir(my_path) and not os.path.islink(my_path):
+			os.rename(my_path, "{0}.v{1:013d}-{2}".format(my_path, 0, os.getpid()))
+
+		my_link_path = "{0}.link-{1}".format(my_path, os.getpid())
+		if os.path.lexists(my_link_path):
+			os.remove(my_link_path)
+		os.symlink(my_version, my_link_path)
+		os.rename(my_link_path, my_path)
+		fsync_path(self.controller_path(controller))
+
+		# Keep the version that was just replaced, a reader may still be opening it
+		for my_old_version in self.list_versions(controller, month)[:-2]:
+			shutil.rmtree(os.path.join(self.controller_path(controller), my_old_version))
+		log.debug("OSPILogArchive:write_partition: wrote {0} as {1}".format(my_path, my_version))
+
+	def merge_partition(self, controller, month, table, columns, key_columns, new_rows):
+		# Existing rows plus the new ones, without duplicates and in time order
+		with self.partition_lock(controller, month):
+			return self.merge_locked(controller, month, table, columns, key_columns, new_rows)
+
+	def merge_locked(self, controller, month, table, columns, key_columns, new_rows):
+		my_tables = {}
+		for my_table, my_table_columns in (("runs", RUN_COLUMNS), ("flow", FLOW_COLUMNS)):
+			my_existing = self.read_table(controller, month, my_table, my_table_columns, False)
+			if my_existing != None:
+				my_tables[my_table] = dict((my_column, [int(my_value) for my_value in my_existing[my_column]]) for my_column in my_table_columns)
+
+		my_rows = set()
+		if table in my_tables:
+			my_rows.update(zip(*[my_tables[table][my_column] for my_column in columns]))
+		my_before = len(my_rows)
+		my_rows.update(tuple(int(my_value) for my_value in my_row) for my_row in new_rows)
+
+		my_key_index = [columns.index(my_column) for my_column in key_columns]
+		my_sorted = sorted(my_rows, key=lambda my_row: [my_row[my_index] for my_index in my_key_index])
+		my_tables[table] = dict((my_column, [my_row[my_count] for my_row in my_sorted]) for my_count, my_column in enumerate(columns))
+
+		self.swap_partition(controller, month, my_tables)
+		return len(my_rows) - my_before
+
+	def split_by_month(self, rows, time_index):
+		my_months = {}
+		for my_row in rows:
+			my_month = time.strftime('%Y-%m', time.gmtime(my_row[time_index]))
+			my_months.setdefault(my_month, []).append(my_row)
+		return my_months
+
+	def archive_runs(self, controller, runs):
+		"""archive_runs - archive /jl run records, returns the set of days (epoch day numbers) now on disk"""
+		my_days = set()
+		for my_month, my_rows in self.split_by_month(runs, 3).iteritems():
+			my_added = self.merge_partition(controller, my_month, "runs", RUN_COLUMNS, ["end", "sid"], [my_row[:4] for my_row in my_rows])
+			my_days.update(int(my_row[3]) // 86400 for my_row in my_rows)
+			log.debug("OSPILogArchive:archive_runs: {0} {1} added {2} of {3} runs".format(controller, my_month, my_added, len(my_rows)))
+		return my_days
+
+	def archive_flow(self, controller, samples):
+		"""archive_flow - archive (timestamp, flow value) samples"""
+		for my_month, my_rows in self.split_by_month(samples, 0).iteritems():
+			my_added = self.merge_partition(controller, my_month, "flow", FLOW_COLUMNS, ["ts"], my_rows)
+			log.debug("OSPILogArchive:archive_flow: {0} {1} added {2} of {3} samples".format(controller, my_month, my_added, len(my_rows)))
+
+	def load(self, controller, table="runs", first_month=None, last_month=None):
+		"""load - [(month, columns)] for the months asked for, each partition's columns memory mapped and left where they are"""
+		my_columns = RUN_COLUMNS if table == "runs" else FLOW_COLUMNS
+		my_parts = []
+		for my_month in self.list_partitions(controller):
+			if (first_month and my_month < first_month) or (last_month and my_month > last_month):
+				continue
+			my_part = self.read_table(controller, my_month, table, my_columns)
+			if my_part != None:
+				my_parts.append((my_month, my_part))
+		log.debug("OSPILogArchive:load: {0} {1} loaded {2} partitions".format(controller, table, len(my_parts)))
+		return my_parts
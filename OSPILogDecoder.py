@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPILogDecoder.py
+
+	DESCRIPTION:
+	Decode a /jl payload into columns of pid, sid, dur and end, and work
+	out the day buckets, start times, minutes/seconds and station names
+	for all of the records at once instead of one run at a time.
+
+	NOTES:
+	[pid, sid, dur, end] is a numpy structured array, or array('l')
+	columns when numpy isn't installed. The records are put in end
+	time order.
+
+	Dates, times and durations repeat a lot in a log (there are only
+	1440 minutes in a day), so their labels are formatted once and
+	memoized instead of going through time.strftime for every record.
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import logging, time, array, bisect
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospilogdecoder')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospilogdecoder.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CONSTANTS
+################################################################################
+LOG_FIELDS = ["pid", "sid", "dur", "end"]
+
+if numpy != None:
+	LOG_DTYPE = numpy.dtype([("pid", "<i4"), ("sid", "<i4"), ("dur", "<i4"), ("end", "<i8")])
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPILogDecoder(object):
+	"""OSPILogDecoder - columnar /jl records and the values the reports are built from"""
+
+	def __init__(self, station_names):
+		self.station_names = list(station_names or [])
+		self.records = None
+		self.count = 0
+		self._date_labels = {}
+		self._time_labels = {}
+		self._duration_labels = {}
+
+	################################################################################
+	# FUNCTIONS
+	################################################################################
+	def decode(self, runs):
+		"""decode - turn the list of [pid, sid, dur, end] runs into columns, in end time order"""
+		self.count = len(runs)
+		if numpy != None:
+			my_records = numpy.empty(self.count, dtype=LOG_DTYPE)
+			if self.count:
+				my_raw = numpy.asarray([my_run[:4] for my_run in runs], dtype=numpy.int64)
+				for my_count, my_field in enumerate(LOG_FIELDS):
+					my_records[my_field] = my_raw[:, my_count]
+				my_records = my_records[numpy.argsort(my_records["end"], kind="mergesort")]
+			self.records = my_records
+		else:
+			my_sorted = sorted(runs, key=lambda my_run: my_run[3])
+			self.records = {}
+			for my_count, my_field in enumerate(LOG_FIELDS):
+				self.records[my_field] = array.array('l', (my_run[my_count] for my_run in my_sorted))
+		log.debug("OSPILogDecoder:decode: decoded {0} records".format(self.count))
+		return self.records
+
+	def column(self, field):
+		return self.records[field]
+
+	def days(self):
+		# Day bucket (epoch day) of every record
+		if numpy != None:
+			return self.records["end"] // 86400
+		return array.array('l', (my_end // 86400 for my_end in self.records["end"]))
+
+	def minutes_of_day(self):
+		if numpy != None:
+			return (self.records["end"] % 86400) // 60
+		return array.array('l', ((my_end % 86400) // 60 for my_end in self.records["end"]))
+
+	def duration_parts(self):
+		# (minutes, seconds) columns of every run's duration
+		if numpy != None:
+			return numpy.divmod(self.records["dur"], 60)
+		return (array.array('l', (my_dur // 60 for my_dur in self.records["dur"])), array.array('l', (my_dur % 60 for my_dur in self.records["dur"])))
+
+	def names(self):
+		# Station name of every record, "Unknown" for a station we don't have a name for
+		my_names = self.station_names + ["Unknown"]
+		if numpy != None:
+			my_sids = numpy.clip(self.records["sid"], 0, len(my_names) - 1)
+			my_sids[self.records["sid"] < 0] = len(my_names) - 1
+			return numpy.asarray(my_names, dtype=object)[my_sids]
+		return [my_names[my_sid] if 0 <= my_sid < len(self.station_names) else "Unknown" for my_sid in self.records["sid"]]
+
+	def date_label(self, day):
+		my_label = self._date_labels.get(day)
+		if my_label == None:
+			my_label = time.strftime('%m/%d/%Y', time.gmtime(day * 86400))
+			self._date_labels[day] = my_label
+		return my_label
+
+	def time_label(self, minute):
+		my_label = self._time_labels.get(minute)
+		if my_label == None:
+			my_label = "{0:02d}:{1:02d}".format(minute // 60, minute % 60)
+			self._time_labels[minute] = my_label
+		return my_label
+
+	def duration_label(self, duration):
+		# The run time in minutes, the seconds are only added when there are some
+		my_label = self._duration_labels.get(duration)
+		if my_label == None:
+			my_min, my_sec = divmod(duration, 60)
+			if my_sec != 0:
+				my_label = "{0}m:{1}s".format(my_min, my_sec)
+			else:
+				my_label = "{0}m".format(my_min)
+			self._duration_labels[duration] = my_label
+		return my_label
+
+	def first_after(self, end):
+		# Index of the first record that ended after end
+		if numpy != None:
+			return int(numpy.searchsorted(self.records["end"], end, side="right"))
+		return bisect.bisect_right(self.records["end"], end)
+
+	def group_by_day(self):
+		"""group_by_day - (day, first index, last index + 1) for each day in the log"""
+		my_days = self.days()
+		if self.count == 0:
+			return []
+		if numpy != None:
+			my_starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(my_days)) + 1))
+			my_ends = numpy.concatenate((my_starts[1:], [self.count]))
+			return [(int(my_days[my_start]), int(my_start), int(my_end)) for my_start, my_end in zip(my_starts, my_ends)]
+
+		my_groups = []
+		my_start = 0
+		for my_count in xrange(1, self.count + 1):
+			if my_count == self.count or my_days[my_count] != my_days[my_start]:
+				my_groups.append((my_days[my_start], my_start, my_count))
+				my_start = my_count
+		return my_groups
+
+	def summarize(self):
+		"""summarize - {(day, sid): (runs, total seconds)} for the whole log"""
+		if self.count == 0:
+			return {}
+		my_days = self.days()
+		if numpy != None:
+			my_sid_span = int(self.records["sid"].max()) + 1
+			my_keys = (my_days * my_sid_span) + self.records["sid"]
+			my_unique, my_inverse = numpy.unique(my_keys, return_inverse=True)
+			my_runs = numpy.bincount(my_inverse)
+			my_totals = numpy.bincount(my_inverse, weights=self.records["dur"])
+			return dict(((int(my_key // my_sid_span), int(my_key % my_sid_span)), (int(my_run), int(my_total))) for my_key, my_run, my_total in zip(my_unique, my_runs, my_totals))
+
+		my_summary = {}
+		for my_day, my_sid, my_dur in zip(my_days, self.records["sid"], self.records["dur"]):
+			my_runs, my_total = my_summary.get((my_day, my_sid), (0, 0))
+			my_summary[(my_day, my_sid)] = (my_runs + 1, my_total + my_dur)
+		return my_summary
+
+	def rows(self):
+		"""rows - (date, time, duration, zone) labels for every record, the way the report shows them"""
+		my_days = self.days()
+		my_minutes = self.minutes_of_day()
+		my_names = self.names()
+		my_zone_labels = {}
+		my_rows = []
+		for my_day, my_minute, my_dur, my_sid, my_name in zip(my_days, my_minutes, self.records["dur"], self.records["sid"], my_names):
+			my_zone = my_zone_labels.get(my_sid)
+			if my_zone == None:
+				my_zone = u"Zone {0} {1}".format(my_sid, my_name)
+				my_zone_labels[my_sid] = my_zone
+			my_rows.append((self.date_label(int(my_day)), self.time_label(int(my_minute)), self.duration_label(int(my_dur)), my_zone))
+		return my_rows
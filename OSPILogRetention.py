@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPILogRetention.py
+
+	DESCRIPTION:
+	Trim the controller's logs one day at a time, and only the days that
+	are already in the local archive. A few days are kept on the device
+	so /jl stays small and fast, and no record is deleted before we
+	have it on disk.
+
+	NOTES:
+	dl?day=<n> deletes one day of logs, n is the epoch day (time / 86400)
+	jl?hist=<n> returns the last n days of logs
+
+	The controller keeps its clock (and the log times) in local time,
+	written as if it were UTC, so its days start at local midnight. Today
+	is worked out the same way, from the controller's "devt" in /jc when
+	set_controller_clock has it, and the Pi's local time otherwise, so
+	the day numbers match the archived runs and dl?day.
+
+	The ledger sits next to the archive partitions.
+	<archive_dir>/<controller>/retention.json
+	{"acked": [days archived but still on the controller], "last_trim": day,
+	 "reported_until": end time of the last run in a daily report}
+
+	/jl is asked for more than a day, so reported_until keeps a run out
+	of the next report once it's been in one.
+
+	Every write re-reads the ledger under a flock on retention.json.lock
+	and merges into it, like OSPIControllerHealth.update, so overlapping
+	runs (cron and a shard worker) don't write over each other's acked
+	days or report marks.
+
+	"log_keep_days" is how many days (today included) stay on the device.
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import os, logging, json, time, calendar, fcntl, contextlib
+from OSPILogArchive import OSPILogArchive, fsync_path
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospilogretention')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospilogretention.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CONSTANTS
+################################################################################
+# The first run picks up whatever older logs are still sitting on the controller
+INITIAL_HISTORY_DAYS = 30
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPILogRetention(object):
+	"""OSPILogRetention - deletes archived days from the controller, keeping a rolling window"""
+
+	def __init__(self, archive, controller, keep_days=3):
+		self.archive = archive
+		self.controller = controller
+		self.keep_days = max(1, keep_days)
+		# The controller's clock less ours, None until set_controller_clock
+		self.clock_offset = None
+		self.ledger = self.read_ledger()
+
+	@classmethod
+	def from_settings(cls, settings, controller):
+		return cls(OSPILogArchive.from_settings(settings), controller, settings.get('log_keep_days', 3))
+
+	################################################################################
+	# PROPERTIES
+	################################################################################
+	@property
+	def ledger_path(self):
+		return os.path.join(self.archive.controller_path(self.controller), "retention.json")
+
+	################################################################################
+	# FUNCTIONS
+	################################################################################
+	def set_controller_clock(self, controller_values):
+		# "devt" in /jc is the controller's local time as epoch, the basis of the log times
+		if isinstance(controller_values, dict) and controller_values.get("devt"):
+			self.clock_offset = controller_values["devt"] - time.time()
+
+	def now(self):
+		if self.clock_offset != None:
+			return int(time.time() + self.clock_offset)
+		return calendar.timegm(time.localtime())
+
+	def today(self):
+		return self.now() // 86400
+
+	def read_ledger(self):
+		if not os.path.exists(self.ledger_path):
+			return {"acked": [], "last_trim": None}
+		my_file = open(self.ledger_path, 'r')
+		my_ledger = json.load(my_file)
+		my_file.close()
+		return my_ledger
+
+	def write_ledger(self):
+		my_path = self.ledger_path
+		if not os.path.isdir(os.path.dirname(my_path)):
+			os.makedirs(os.path.dirname(my_path))
+		my_tmp_path = "{0}.{1}".format(my_path, os.getpid())
+		my_file = open(my_tmp_path, 'w')
+		json.dump(self.ledger, my_file)
+		my_file.flush()
+		os.fsync(my_file.fileno())
+		my_file.close()
+		os.rename(my_tmp_path, my_path)
+		fsync_path(os.path.dirname(my_path))
+
+	@contextlib.contextmanager
+	def update(self):
+		"""update - the ledger read again, written back when the block ends, with every other writer locked out"""
+		if not os.path.isdir(os.path.dirname(self.ledger_path)):
+			os.makedirs(os.path.dirname(self.ledger_path))
+		my_lock_file = open("{0}.lock".format(self.ledger_path), 'a')
+		try:
+			fcntl.flock(my_lock_file.fileno(), fcntl.LOCK_EX)
+			self.ledger = self.read_ledger()
+			yield self.ledger
+			self.write_ledger()
+		finally:
+			my_lock_file.close()
+
+	def history_days(self):
+		# Enough history to cover the window, plus any days since the last trim
+		my_last_trim = self.ledger.get("last_trim")
+		if my_last_trim == None:
+			return max(self.keep_days, INITIAL_HISTORY_DAYS)
+		return max(self.keep_days, self.today() - my_last_trim + 1)
+
+	def reported_until(self):
+		# The first report has yesterday and today, what hist=1 used to send
+		my_reported_until = self.ledger.get("reported_until")
+		if my_reported_until == None:
+			return ((self.today() - 1) * 86400) - 1
+		return my_reported_until
+
+	def mark_reported(self, end):
+		"""mark_reported - runs that ended at or before end have been sent"""
+		with self.update() as my_ledger:
+			# Another run may have reported further already
+			my_ledger["reported_until"] = max(end, my_ledger.get("reported_until"))
+		log.debug("OSPILogRetention:mark_reported: {0} reported until {1}".format(self.controller, end))
+
+	def acknowledge(self, days):
+		"""acknowledge - days that OSPILogArchive has written and synced to disk"""
+		with self.update() as my_ledger:
+			my_acked = set(my_ledger["acked"])
+			my_acked.update(days)
+			my_ledger["acked"] = sorted(my_acked)
+		log.debug("OSPILogRetention:acknowledge: {0} acked days {1}".format(self.controller, self.ledger["acked"]))
+
+	def archive_and_acknowledge(self, runs):
+		self.acknowledge(self.archive.archive_runs(self.controller, runs))
+
+	def trim(self, opcs):
+		"""trim - delete acknowledged days that have fallen out of the window, returns the days deleted"""
+		my_first_kept = self.today() - self.keep_days + 1
+		my_trimmed = []
+		for my_day in list(self.ledger["acked"]):
+			if my_day >= my_first_kept:
+				continue
+			# {"result": 1} is the only answer that means the day's gone, 2 is a bad password
+			my_result = opcs.remove_log_day(my_day)
+			if not isinstance(my_result, dict) or my_result.get("result") != 1:
+				log.error("OSPILogRetention:trim: {0} could not delete day {1} ({2}), trying again next run".format(self.controller, my_day, my_result))
+				continue
+			my_trimmed.append(my_day)
+
+		# Not held over the deletes, a day deleted twice by overlapping runs is still gone
+		with self.update() as my_ledger:
+			my_ledger["acked"] = [my_day for my_day in my_ledger["acked"] if my_day not in my_trimmed]
+			my_ledger["last_trim"] = max(self.today(), my_ledger.get("last_trim"))
+		log.debug("OSPILogRetention:trim: {0} deleted days {1}, keeping from day {2}".format(self.controller, my_trimmed, my_first_kept))
+		return my_trimmed
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPIPipeline.py
+
+	DESCRIPTION:
+	A small staged pipeline. Each stage runs in its own worker threads
+	and the stages are joined by bounded queues, so the network, the
+	disk and the cpu are all kept busy at once. A full queue makes the
+	stage in front of it wait (backpressure).
+
+	NOTES:
+	A stage is a call that takes a item and returns the item for the next
+	stage, or None to drop it. A item that raises is logged and dropped,
+	so one bad controller doesn't stop the rest of the fleet.
+
+	Every stage counts its items, errors and busy time, see report().
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import logging, time, threading, Queue
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospipipeline')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospipipeline.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CONSTANTS
+################################################################################
+# Put on a queue once per worker when the stage in front of it is finished
+END_OF_STREAM = object()
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPIPipelineStage(object):
+	"""OSPIPipelineStage - one stage, its workers and its counters"""
+
+	def __init__(self, name, call, workers=1):
+		self.name = name
+		self.call = call
+		self.workers = workers
+		self.items = 0
+		self.errors = 0
+		self.busy = 0.0
+		self.started = None
+		self.finished = None
+		self._lock = threading.Lock()
+		self._running_workers = 0
+
+	@property
+	def throughput(self):
+		# Items per second of wall clock while the stage was running
+		if self.started == None or self.finished == None or self.finished <= self.started:
+			return 0.0
+		return self.items / (self.finished - self.started)
+
+	def work(self, in_queue, out_queue, next_workers):
+		while True:
+			my_item = in_queue.get()
+			if my_item is END_OF_STREAM:
+				break
+
+			my_start = time.time()
+			try:
+				my_result = self.call(my_item)
+			except Exception, e:
+				my_result = None
+				with self._lock:
+					self.errors += 1
+				log.error("OSPIPipelineStage:work: {0} failed, received error {1}".format(self.name, e))
+			with self._lock:
+				self.items += 1
+				self.busy += time.time() - my_start
+
+			if my_result != None and out_queue != None:
+				out_queue.put(my_result)
+
+		# The last worker out tells every worker of the next stage we're done
+		with self._lock:
+			self._running_workers -= 1
+			my_last = self._running_workers == 0
+			if my_last:
+				self.finished = time.time()
+		if my_last and out_queue != None:
+			for my_count in xrange(next_workers):
+				out_queue.put(END_OF_STREAM)
+
+class OSPIPipeline(object):
+	"""OSPIPipeline - stages joined by bounded queues"""
+
+	def __init__(self, queue_size=4):
+		self.queue_size = queue_size
+		self.stages = []
+
+	def add_stage(self, name, call, workers=1):
+		self.stages.append(OSPIPipelineStage(name, call, max(1, workers)))
+
+	def run(self, items):
+		"""run - push items through every stage, returns the stage report"""
+		my_queues = [Queue.Queue(self.queue_size) for my_stage in self.stages]
+		my_threads = []
+		for my_count, my_stage in enumerate(self.stages):
+			my_out_queue = my_queues[my_count + 1] if my_count + 1 < len(self.stages) else None
+			my_next_workers = self.stages[my_count + 1].workers if my_out_queue != None else 0
+			my_stage._running_workers = my_stage.workers
+			my_stage.started = time.time()
+			for my_worker in xrange(my_stage.workers):
+				my_thread = threading.Thread(target=my_stage.work, args=(my_queues[my_count], my_out_queue, my_next_workers))
+				my_thread.daemon = True
+				my_thread.start()
+				my_threads.append(my_thread)
+
+		# Feeding waits whenever the first stage falls behind
+		for my_item in items:
+			my_queues[0].put(my_item)
+		for my_count in xrange(self.stages[0].workers):
+			my_queues[0].put(END_OF_STREAM)
+
+		for my_thread in my_threads:
+			my_thread.join()
+
+		my_report = self.report()
+		for my_line in my_report:
+			log.debug("OSPIPipeline:run: {0}".format(my_line))
+		return my_report
+
+	def report(self):
+		my_report = []
+		for my_stage in self.stages:
+			my_report.append({
+				"stage": my_stage.name,
+				"items": my_stage.items,
+				"errors": my_stage.errors,
+				"busy": round(my_stage.busy, 3),
+				"throughput": round(my_stage.throughput, 3),
+			})
+		return my_report
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPIPollBenchmark.py
+
+	DESCRIPTION:
+	Times OSPIPoller's poll and counts what it leaves behind, against a
+	controller answered from memory (no network), so the numbers are
+	only the poll's own work. Exits 1 when a poll is slower than the
+	limit or the poll is leaving objects behind, run it after changing
+	OSPIPoller.
+
+	NOTES:
+	python OSPIPollBenchmark.py [polls] [max microseconds per poll] [max objects per 1000 polls]
+
+	The defaults are 20000 polls, 200us and 0 objects. A Pi is about ten
+	times slower than a desktop, give it a bigger limit.
+
+	The objects left behind are counted with tracemalloc when the python
+	has it (memory blocks), and with the garbage collector otherwise
+	(lists, dicts and the like). OSPICheckStatus's check_stations_running
+	and check_flow_control_running are timed on the same answers (through
+	a OSPITransport, so no network either) to compare.
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import sys, gc, json, timeit
+from OSPIPoller import OSPIPoller
+from OSPIUtility import OSPICheckStatus, OSPITransport
+
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
+################################################################################
+# CONSTANTS
+################################################################################
+BENCHMARK_POLLS = 20000
+BENCHMARK_MAX_US = 200.0
+BENCHMARK_MAX_OBJECTS = 0
+BENCHMARK_STATIONS = 16
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPIFakeController(object):
+	"""OSPIFakeController - a socket that answers /js and /jc from memory"""
+
+	def __init__(self, poller, stations=BENCHMARK_STATIONS):
+		my_states = [0] * stations
+		my_states[stations // 2] = 1
+		self.js_body = json.dumps({"sn": my_states, "nstations": stations}, separators=(',', ':'))
+		self.jc_body = json.dumps({"devt": 1497900000, "nbrd": 2, "en": 1, "rd": 0, "rs": 0, "rdst": 0, "loc": "", "wtdata": {}, "wterr": 0, "sbits": [0, 0, 0], "ps": [[0, 0, 0]] * stations, "lrun": [0, 0, 0, 0], "flcrt": 1234, "flwrt": 30}, separators=(',', ':'))
+		self._answers = {poller._js_request: self.answer(self.js_body), poller._jc_request: self.answer(self.jc_body)}
+		self._answer = None
+
+	@staticmethod
+	def answer(body):
+		return bytearray("HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: {0}\r\nConnection: keep-alive\r\n\r\n{1}".format(len(body), body))
+
+	def sendall(self, data):
+		self._answer = self._answers[data]
+
+	def recv_into(self, buffer, nbytes=0):
+		buffer[0:len(self._answer)] = self._answer
+		return len(self._answer)
+
+	def setsockopt(self, *args):
+		pass
+
+	def close(self):
+		pass
+
+
+class OSPIMemoryTransport(object):
+	"""OSPIMemoryTransport - answers OSPIQuery with a OSPIFakeController's bodies"""
+
+	def __init__(self, ofc):
+		self.ofc = ofc
+
+	def exchange(self, url, call):
+		if "/js?" in url:
+			return 200, self.ofc.js_body
+		return 200, self.ofc.jc_body
+
+
+class OSPIBenchmarkPoller(OSPIPoller):
+	"""OSPIBenchmarkPoller - OSPIPoller on a OSPIFakeController"""
+
+	def connect(self):
+		self._socket = OSPIFakeController(self)
+
+################################################################################
+# FUNCTIONS
+################################################################################
+
+def time_per_call(call, count):
+	# Best of 5, in microseconds
+	return min(timeit.repeat(call, number=count, repeat=5)) * 1000000.0 / count
+
+def objects_left(call, count):
+	"""objects_left - what count calls leave behind, (objects, how they were counted)"""
+	call()
+	gc.collect()
+	if tracemalloc != None:
+		tracemalloc.start()
+		my_before = tracemalloc.take_snapshot()
+		for my_count in xrange(count):
+			call()
+		gc.collect()
+		my_after = tracemalloc.take_snapshot()
+		tracemalloc.stop()
+		my_left = sum(my_stat.count_diff for my_stat in my_after.compare_to(my_before, 'filename') if "tracemalloc" not in str(my_stat.traceback))
+		return my_left, "memory blocks"
+	my_before = len(gc.get_objects())
+	for my_count in xrange(count):
+		call()
+	gc.collect()
+	# - 1 for my_before
+	return len(gc.get_objects()) - my_before - 1, "objects"
+
+################################################################################
+# RUN AS SCRIPT
+################################################################################
+
+if __name__ == "__main__":
+	my_polls = int(sys.argv[1]) if len(sys.argv) > 1 else BENCHMARK_POLLS
+	my_max_us = float(sys.argv[2]) if len(sys.argv) > 2 else BENCHMARK_MAX_US
+	my_max_objects = int(sys.argv[3]) if len(sys.argv) > 3 else BENCHMARK_MAX_OBJECTS
+
+	# No rate limit, we want the poll not the scheduler's waits
+	opp = OSPIBenchmarkPoller("http://127.0.0.1:8080", "a6d82bced638de3def1e9bbb4983225c")
+	opp.scheduler.rate = 0
+	if not opp.poll() or opp.flow_value != 1234 or opp.stations_running != 1 or len(opp.station_states) != BENCHMARK_STATIONS:
+		print "FAIL the poll decoded stations {0} flow {1}".format(opp.station_states, opp.flow_value)
+		sys.exit(1)
+	ofc = opp._socket
+
+	my_fake_us = time_per_call(lambda: (ofc.sendall(opp._js_request), ofc.recv_into(opp._buffer), ofc.sendall(opp._jc_request), ofc.recv_into(opp._buffer)), my_polls)
+	my_poll_us = time_per_call(opp.poll, my_polls) - my_fake_us
+	my_left, my_counted = objects_left(opp.poll, my_polls)
+	my_left_per_1000 = my_left * 1000.0 / my_polls
+
+	opcs = OSPICheckStatus(opp.station_address, "a6d82bced638de3def1e9bbb4983225c")
+	OSPITransport.install(OSPIMemoryTransport(ofc))
+	try:
+		my_check_us = time_per_call(lambda: (opcs.check_stations_running(), opcs.check_flow_control_running()), my_polls // 10)
+	finally:
+		OSPITransport.install(None)
+
+	print "{0} polls of {1} stations".format(my_polls, BENCHMARK_STATIONS)
+	print "poll:        {0:.1f}us (the fake controller's {1:.1f}us taken off)".format(my_poll_us, my_fake_us)
+	print "check:       {0:.1f}us (OSPICheckStatus, {1:.1f} times the poll)".format(my_check_us, my_check_us / my_poll_us)
+	print "left behind: {0} {1}, {2:.2f} per 1000 polls".format(my_left, my_counted, my_left_per_1000)
+
+	my_failed = False
+	if my_poll_us > my_max_us:
+		print "FAIL a poll takes {0:.1f}us, the limit is {1:.1f}us".format(my_poll_us, my_max_us)
+		my_failed = True
+	if my_left_per_1000 > my_max_objects:
+		print "FAIL the poll leaves {0:.2f} {1} per 1000 polls, the limit is {2}".format(my_left_per_1000, my_counted, my_max_objects)
+		my_failed = True
+	sys.exit(1 if my_failed else 0)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPIPoller.py
+
+	DESCRIPTION:
+	The /js and /jc poll, made for a loop that polls all day. The
+	requests are built once, the answers are read into the same buffer
+	every time, and only "sn" and "flcrt" are picked out of the JSON, so
+	a poll makes next to no garbage.
+
+	NOTES:
+	opp = OSPIPoller(ip, passwd)
+	if opp.poll():
+		opp.station_states, opp.stations_running, opp.flow_value
+
+	station_states is the same list every poll, it's updated in place.
+	stations_running means the same as on OSPICheckStatus, the last
+	station that's on (None when nothing is).
+
+	The connection is kept between polls. The poll waits its turn in
+	OSPIRequestScheduler like any other status query, and goes through
+	OSPITransport when one's installed (a cassette).
+
+	python OSPIPollBenchmark.py checks it hasn't got slower or started
+	leaking.
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import logging, socket, urlparse
+from OSPIUtility import OSPITransport, QUERY_TIMEOUT
+from OSPIRequestScheduler import OSPIRequestScheduler, PRIORITY_CRITICAL
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospipoller')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospipoller.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CONSTANTS
+################################################################################
+POLL_HEADER_END = b"\r\n\r\n"
+POLL_CONTENT_LENGTH = (b"Content-Length:", b"content-length:", b"Content-length:")
+POLL_SN = b'"sn":'
+POLL_FLCRT = b'"flcrt":'
+POLL_BUFFER_SIZE = 4096
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPIPoller(object):
+	"""OSPIPoller - station and flow status with prebuilt requests and a reused buffer"""
+
+	def __init__(self, station_address, passwd, timeout=QUERY_TIMEOUT, health=None, buffer_size=POLL_BUFFER_SIZE):
+		my_url = urlparse.urlsplit(station_address)
+		self.station_address = station_address.rstrip("/")
+		self.host = my_url.hostname
+		self.port = my_url.port or 80
+		self.timeout = timeout
+		self.health = health
+		self.scheduler = OSPIRequestScheduler.for_controller(station_address)
+		self.station_states = []
+		self.stations_running = None
+		self.flow_value = None
+		self.error = None
+		self.poll_count = 0
+		self._failing = False
+		self._socket = None
+		self._buffer = bytearray(buffer_size)
+
+		my_base = my_url.path.rstrip("/")
+		my_host = my_url.netloc
+		self._js_path = "/js?pw={0}".format(passwd)
+		self._jc_path = "/jc?pw={0}".format(passwd)
+		self._js_request = self.build_request(my_base + self._js_path, my_host)
+		self._jc_request = self.build_request(my_base + self._jc_path, my_host)
+
+	@staticmethod
+	def build_request(path, host):
+		return "GET {0} HTTP/1.1\r\nHost: {1}\r\nConnection: keep-alive\r\n\r\n".format(path, host).encode('ascii')
+
+	################################################################################
+	# FUNCTIONS
+	################################################################################
+	def connect(self):
+		self._socket = socket.create_connection((self.host, self.port), self.timeout)
+		self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+	def close(self):
+		if self._socket != None:
+			self._socket.close()
+			self._socket = None
+
+	def poll(self):
+		"""poll - /js then /jc, returns True when both answered"""
+		if self.health and not self.health.allow():
+			return False
+		my_ticket = self.scheduler.acquire(PRIORITY_CRITICAL)
+		try:
+			my_start, my_end = self.query(self._js_request, self._js_path)
+			my_polled = self.decode_stations(my_start, my_end)
+			my_start, my_end = self.query(self._jc_request, self._jc_path)
+			my_polled = self.decode_flow(my_start, my_end) and my_polled
+		except (socket.error, ValueError), e:
+			self.close()
+			self.error = e
+			self._failing = True
+			log.error("OSPIPoller:poll: {0} did not answer, received error {1}".format(self.host, e))
+			if self.health:
+				self.health.record_failure(e)
+			return False
+		finally:
+			self.scheduler.release(my_ticket)
+
+		self.poll_count += 1
+		# The health file is only written when the controller comes back
+		if self._failing:
+			self._failing = False
+			if self.health:
+				self.health.record_success(0.0)
+		return my_polled
+
+	def query(self, request, path):
+		# (body start, body end) in the buffer
+		if OSPITransport.installed != None:
+			my_status, my_body = OSPITransport.exchange(self.station_address + path, lambda: self.send_and_copy(request))
+			self._buffer[0:len(my_body)] = my_body
+			return 0, len(my_body)
+		return self.exchange(request)
+
+	def send_and_copy(self, request):
+		my_start, my_end = self.exchange(request)
+		return 200, bytes(self._buffer[my_start:my_end])
+
+	def exchange(self, request):
+		for my_attempt in xrange(2):
+			if self._socket == None:
+				self.connect()
+			try:
+				self._socket.sendall(request)
+				return self.receive()
+			except socket.timeout:
+				self.close()
+				raise
+			except socket.error:
+				# The controller closed the kept connection, try once more on a new one
+				self.close()
+				if my_attempt:
+					raise
+
+	def receive(self):
+		my_buffer = self._buffer
+		my_length = self._socket.recv_into(my_buffer)
+		if my_length == 0:
+			raise socket.error("connection closed")
+		my_header_end = -1
+		my_body_length = -1
+		while True:
+			if my_header_end < 0:
+				my_header_end = my_buffer.find(POLL_HEADER_END, 0, my_length)
+				if my_header_end >= 0:
+					my_header_end += 4
+					my_body_length = self.content_length(my_header_end)
+			if my_header_end >= 0 and my_body_length >= 0 and my_length >= my_header_end + my_body_length:
+				break
+			if my_length == len(my_buffer):
+				my_buffer.extend(bytearray(len(my_buffer)))
+			my_read = self._socket.recv_into(memoryview(my_buffer)[my_length:])
+			if my_read == 0:
+				# No length, the controller closes the connection at the end of the body
+				if my_header_end >= 0 and my_body_length < 0:
+					self.close()
+					break
+				raise socket.error("connection closed in the middle of a answer")
+			my_length += my_read
+
+		# "HTTP/1.1 200"
+		if my_buffer[9] != 50 or my_buffer[10] != 48 or my_buffer[11] != 48:
+			raise ValueError("controller answered HTTP {0}".format(bytes(my_buffer[9:12])))
+		if my_body_length < 0:
+			return my_header_end, my_length
+		return my_header_end, my_header_end + my_body_length
+
+	def content_length(self, header_end):
+		my_buffer = self._buffer
+		for my_name in POLL_CONTENT_LENGTH:
+			my_pos = my_buffer.find(my_name, 0, header_end)
+			if my_pos >= 0:
+				return self.read_int(my_pos + len(my_name), header_end)
+		return -1
+
+	def read_int(self, position, end):
+		my_buffer = self._buffer
+		while position < end and my_buffer[position] == 32:
+			position += 1
+		my_value = 0
+		while position < end and 48 <= my_buffer[position] <= 57:
+			my_value = (my_value * 10) + my_buffer[position] - 48
+			position += 1
+		return my_value
+
+	def decode_stations(self, start, end):
+		# "sn":[0,1,0,...] straight into station_states
+		my_buffer = self._buffer
+		my_position = my_buffer.find(POLL_SN, start, end)
+		if my_position < 0:
+			return False
+		my_position = my_buffer.find(b"[", my_position + 5, end)
+		my_close = my_buffer.find(b"]", my_position, end)
+		if my_position < 0 or my_close < 0:
+			return False
+		my_states = self.station_states
+		my_count = 0
+		my_running = None
+		my_value = None
+		# Up to and including the "]", which ends the last number
+		for my_byte in my_buffer[my_position:my_close + 1]:
+			if 48 <= my_byte <= 57:
+				my_value = my_byte - 48 if my_value == None else (my_value * 10) + my_byte - 48
+			elif my_value != None:
+				if my_count < len(my_states):
+					my_states[my_count] = my_value
+				else:
+					my_states.append(my_value)
+				if my_value != 0:
+					my_running = my_value
+				my_count += 1
+				my_value = None
+		del my_states[my_count:]
+		self.stations_running = my_running
+		return True
+
+	def decode_flow(self, start, end):
+		my_position = self._buffer.find(POLL_FLCRT, start, end)
+		if my_position < 0:
+			return False
+		self.flow_value = self.read_int(my_position + 8, end)
+		return True
+
+	def update(self, opcs):
+		"""update - copy the poll onto a OSPICheckStatus"""
+		opcs.stations_running = self.stations_running
+		opcs.flow_value = self.flow_value
+		opcs.station_states = list(self.station_states)
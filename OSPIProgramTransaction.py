@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPIProgramTransaction.py
+
+	DESCRIPTION:
+	Change several programs on a controller as one step. The programs
+	are read (/jp) before anything is written, every changed program is
+	written (/cp), and the programs are read back once to check them.
+	If a write failed or the read back doesn't match, every program we
+	touched is put back the way it was.
+
+	NOTES:
+	cp?pid=<n>&v=[flag,days0,days1,[start times],[durations]]&name=<name>
+	changes program n, the controller answers {"result": 1}
+
+	Newer firmware has a date range after the name,
+	[flag, days0, days1, [start times], [durations], name, [endr, from, to]],
+	it goes back as &endr=<0|1>&from=<n>&to=<n>. Anything else after the
+	name is left the way the controller has it.
+
+	opt = OSPIProgramTransaction(ip, passwd)
+	my_program_data = opt.begin()
+	... change my_program_data
+	opt.update(my_program_data)
+	opt.commit()
+
+	Only the programs that changed are written, and all the queries go
+	over one kept connection (OSPIConnection).
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import logging, json, copy
+from urllib import quote
+from OSPIUtility import OSPIConnection, QUERY_TIMEOUT
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospiprogramtransaction')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospiprogramtransaction.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CONSTANTS
+################################################################################
+# The query parameters for the date range after the name
+PROGRAM_DATERANGE = ("endr", "from", "to")
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPIProgramTransaction(object):
+	"""OSPIProgramTransaction - all of the program changes go in, or none of them do"""
+
+	def __init__(self, station_address, passwd, connection=None, health=None, timeout=QUERY_TIMEOUT):
+		self.station_address = station_address
+		self.passwd = passwd
+		self.connection = connection or OSPIConnection(station_address, timeout, health)
+		self.snapshot = None
+		self.verified = None
+		self.writes = {}
+		self.error = None
+
+	@classmethod
+	def from_settings(cls, settings, controller, health=None):
+		return cls(controller['open_sprinkler_ip'], controller['md5_pass'], None, health, settings.get('query_timeout', QUERY_TIMEOUT))
+
+	################################################################################
+	# FUNCTIONS
+	################################################################################
+	def read_programs(self):
+		return self.connection.query("/jp?pw={0}".format(self.passwd))
+
+	def begin(self):
+		"""begin - read the programs to roll back to, returns a copy to change (None when the controller didn't answer)"""
+		self.snapshot = self.read_programs()
+		self.verified = None
+		self.writes = {}
+		if not self.snapshot or "pd" not in self.snapshot:
+			self.error = "could not read the programs"
+			log.error("OSPIProgramTransaction:begin: {0} {1}".format(self.station_address, self.error))
+			return None
+		return copy.deepcopy(self.snapshot)
+
+	def update(self, program_data):
+		"""update - stage every program that's different from the snapshot"""
+		for my_pid, my_program in enumerate(program_data.get("pd")):
+			if my_pid >= len(self.snapshot["pd"]) or my_program != self.snapshot["pd"][my_pid]:
+				self.writes[my_pid] = copy.deepcopy(my_program)
+		log.debug("OSPIProgramTransaction:update: {0} programs staged {1}".format(self.station_address, sorted(self.writes)))
+		return sorted(self.writes)
+
+	def write_program(self, pid, program):
+		# The program is [flag, days0, days1, [start times], [durations], name, ...]
+		my_value = json.dumps(program[:5], separators=(',', ':'))
+		my_name = program[5]
+		if isinstance(my_name, unicode):
+			my_name = my_name.encode('utf-8')
+		my_query = "/cp?pw={0}&pid={1}&v={2}&name={3}".format(self.passwd, pid, quote(my_value), quote(my_name))
+		for my_extra in program[6:]:
+			if isinstance(my_extra, list) and len(my_extra) == len(PROGRAM_DATERANGE):
+				my_query += "".join("&{0}={1}".format(my_key, int(my_value)) for my_key, my_value in zip(PROGRAM_DATERANGE, my_extra))
+			else:
+				log.debug("OSPIProgramTransaction:write_program: {0} program {1} leaving {2} as it is".format(self.station_address, pid, my_extra))
+		my_return = self.connection.query(my_query)
+		if not my_return or my_return.get("result") != 1:
+			log.error("OSPIProgramTransaction:write_program: {0} program {1} was not written, received {2}".format(self.station_address, pid, my_return or self.connection.error))
+			return False
+		return True
+
+	def verify(self, programs):
+		"""verify - one read back, True when every program in programs matches"""
+		my_read_back = self.read_programs()
+		if not my_read_back or "pd" not in my_read_back:
+			return False, None
+		for my_pid, my_program in programs.iteritems():
+			if my_pid >= len(my_read_back["pd"]) or my_read_back["pd"][my_pid] != my_program:
+				log.error("OSPIProgramTransaction:verify: {0} program {1} reads back {2}, expected {3}".format(self.station_address, my_pid, my_read_back["pd"][my_pid] if my_pid < len(my_read_back["pd"]) else None, my_program))
+				return False, my_read_back
+		return True, my_read_back
+
+	def commit(self):
+		"""commit - write the staged programs and check them, returns True when they're all in, False when it was rolled back"""
+		if not self.writes:
+			self.verified = self.snapshot
+			return True
+
+		my_written = []
+		for my_pid in sorted(self.writes):
+			if not self.write_program(my_pid, self.writes[my_pid]):
+				self.error = "program {0} was not written".format(my_pid)
+				break
+			my_written.append(my_pid)
+
+		if self.error == None:
+			my_verified, my_read_back = self.verify(self.writes)
+			if my_verified:
+				self.verified = my_read_back
+				log.debug("OSPIProgramTransaction:commit: {0} committed programs {1} in {2} requests".format(self.station_address, my_written, self.connection.request_count))
+				self.connection.close()
+				return True
+			self.error = "the programs did not read back"
+
+		# A failed write may still have gone in, so everything we sent goes back
+		my_sent = my_written + [my_pid for my_pid in sorted(self.writes) if my_pid not in my_written][:1]
+		self.rollback(my_sent)
+		self.connection.close()
+		return False
+
+	def rollback(self, pids):
+		"""rollback - put the snapshot back for pids, returns True when it reads back"""
+		my_restore = dict((my_pid, self.snapshot["pd"][my_pid]) for my_pid in pids if my_pid < len(self.snapshot["pd"]))
+		log.error("OSPIProgramTransaction:rollback: {0} {1}, restoring programs {2}".format(self.station_address, self.error, sorted(my_restore)))
+		for my_pid in sorted(my_restore):
+			self.write_program(my_pid, my_restore[my_pid])
+		my_verified, my_read_back = self.verify(my_restore)
+		if not my_verified:
+			log.error("OSPIProgramTransaction:rollback: {0} programs {1} could not be restored, check the controller".format(self.station_address, sorted(my_restore)))
+		return my_verified
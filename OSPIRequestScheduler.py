@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPIRequestScheduler.py
+
+	DESCRIPTION:
+	The controller's web server doesn't cope with many requests at once,
+	so every query to a controller waits its turn here. The status polls
+	go first, program reads and writes next, and the big log pulls and
+	deletes last. Each controller has a limit on requests in flight and
+	on requests per second.
+
+	NOTES:
+	critical  js, jc       (station and flow status)
+	normal    jp, jn, jo, cp
+	bulk      jl, dl
+
+	"controller_max_in_flight" : 1
+	"controller_rate_limit" : 10 (requests per second)
+	"controller_rate_burst" : 5
+
+	"request_lock_dir" : "/tmp"
+	"request_aging" : 10 (seconds waited to move up a priority)
+
+	With more than one request in flight allowed, bulk requests leave
+	one slot free so a status poll never waits behind a log pull. A
+	request moves up one priority for every "request_aging" seconds it
+	has waited, so a steady stream of polls can't hold a log pull back
+	for ever.
+
+	The cron scripts, the poller and the shard workers all talk to the
+	same controllers. Requests wait in order in each process, and then
+	take one of the controller's in flight slots, which every process
+	shares (OSPISlotLock, a flock'd file per slot, let go of by the
+	kernel when a process dies).
+	/tmp/ospi_requests_<host_port>.<n>.lock
+	The token bucket is 16 bytes (tokens, last refill) in a memory mapped
+	file next to them, updated under a flock on it, and only when there's
+	a rate limit.
+	/tmp/ospi_requests_<host_port>.bucket
+	A null "request_lock_dir" keeps it all in the process.
+
+	There's one scheduler per controller in each process, OSPIQuery and
+	OSPIConnection go through it.
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import os, re, logging, struct, mmap, time, threading, bisect, itertools, urlparse, fcntl
+from OSPISlotLock import OSPISlotLock
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospirequestscheduler')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospirequestscheduler.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CONSTANTS
+################################################################################
+PRIORITY_CRITICAL = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+REQUEST_PRIORITIES = {
+	"js": PRIORITY_CRITICAL,
+	"jc": PRIORITY_CRITICAL,
+	"jp": PRIORITY_NORMAL,
+	"jn": PRIORITY_NORMAL,
+	"jo": PRIORITY_NORMAL,
+	"cp": PRIORITY_NORMAL,
+	"jl": PRIORITY_BULK,
+	"dl": PRIORITY_BULK,
+}
+
+# tokens, last refill
+BUCKET = struct.Struct('<dd')
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPIRequestScheduler(object):
+	"""OSPIRequestScheduler - priority queue, in flight limit and token bucket for one controller"""
+
+	max_in_flight_default = 1
+	rate_default = 10.0
+	burst_default = 5
+	lock_dir_default = "/tmp"
+	aging_default = 10.0
+	_schedulers = {}
+	_schedulers_lock = threading.Lock()
+
+	def __init__(self, max_in_flight=1, rate=10.0, burst=5, path=None, aging=10.0):
+		self.max_in_flight = max(1, max_in_flight)
+		self.rate = rate
+		self.burst = max(1, burst)
+		self.path = path
+		self.aging = aging
+		self.tokens = float(self.burst)
+		self.in_flight = 0
+		self.bulk_in_flight = 0
+		self.counts = [0, 0, 0]
+		self.waited = [0.0, 0.0, 0.0]
+		self._last_refill = time.time()
+		self._waiting = []
+		self._sequence = itertools.count()
+		self._condition = threading.Condition()
+		self._bucket_lock = threading.Lock()
+		self._bucket_file = None
+		self._bucket = None
+		# Shared with the other processes, without a path the slots are just the counts above
+		self.slots = OSPISlotLock(path, self.max_in_flight) if path != None else None
+
+	@classmethod
+	def configure(cls, settings):
+		# Sets the limits for the schedulers made after this
+		cls.max_in_flight_default = settings.get('controller_max_in_flight', 1)
+		cls.rate_default = settings.get('controller_rate_limit', 10.0)
+		cls.burst_default = settings.get('controller_rate_burst', 5)
+		cls.lock_dir_default = settings.get('request_lock_dir', "/tmp")
+		cls.aging_default = settings.get('request_aging', 10.0)
+
+	@classmethod
+	def for_controller(cls, address):
+		"""for_controller - the one scheduler for the controller at address (a url or host:port)"""
+		my_key = urlparse.urlsplit(address).netloc or address
+		with cls._schedulers_lock:
+			my_scheduler = cls._schedulers.get(my_key)
+			if my_scheduler == None:
+				my_path = None
+				if cls.lock_dir_default:
+					my_path = os.path.join(cls.lock_dir_default, "ospi_requests_{0}".format(re.sub(r'[^A-Za-z0-9.\-]+', '_', my_key)))
+				my_scheduler = cls(cls.max_in_flight_default, cls.rate_default, cls.burst_default, my_path, cls.aging_default)
+				cls._schedulers[my_key] = my_scheduler
+			return my_scheduler
+
+	################################################################################
+	# FUNCTIONS
+	################################################################################
+	@staticmethod
+	def priority_for(path):
+		# "/js?pw=..." or "http://host:port/js?pw=..."
+		my_command = urlparse.urlsplit(path).path.rstrip("/").split("/")[-1]
+		return REQUEST_PRIORITIES.get(my_command, PRIORITY_NORMAL)
+
+	def slot_free(self, priority):
+		if self.in_flight >= self.max_in_flight:
+			return False
+		# Bulk keeps one slot free for everything else
+		if priority == PRIORITY_BULK and self.max_in_flight > 1 and self.bulk_in_flight >= self.max_in_flight - 1:
+			return False
+		return True
+
+	def slots_for(self, priority):
+		# Bulk never takes the last slot, everything else tries it first so bulk's are left to bulk
+		if priority == PRIORITY_BULK and self.max_in_flight > 1:
+			return range(self.max_in_flight - 1)
+		return range(self.max_in_flight - 1, -1, -1)
+
+	def queue_order(self, priority, since):
+		# Moving up one priority every aging seconds keeps everyone waiting in the
+		# same order, a ticket's place only depends on its priority and when it came
+		if self.aging > 0:
+			return (priority * self.aging) + since
+		return priority
+
+	def next_ticket(self):
+		# The first ticket in line that has a slot to go to, None when none has
+		for my_ticket in self._waiting:
+			if self.slot_free(my_ticket[2]):
+				return my_ticket
+		return None
+
+	def bucket(self):
+		# The shared bucket, made the first time there's a rate limit to keep
+		if self._bucket == None:
+			my_path = "{0}.bucket".format(self.path)
+			if not os.path.isdir(os.path.dirname(my_path)):
+				os.makedirs(os.path.dirname(my_path))
+			self._bucket_file = open(my_path, 'a+b')
+			fcntl.flock(self._bucket_file.fileno(), fcntl.LOCK_EX)
+			try:
+				if os.fstat(self._bucket_file.fileno()).st_size < BUCKET.size:
+					self._bucket_file.truncate(BUCKET.size)
+				self._bucket = mmap.mmap(self._bucket_file.fileno(), BUCKET.size)
+				my_tokens, my_refill = BUCKET.unpack_from(self._bucket, 0)
+				if my_refill == 0:
+					BUCKET.pack_into(self._bucket, 0, float(self.burst), time.time())
+			finally:
+				fcntl.flock(self._bucket_file.fileno(), fcntl.LOCK_UN)
+		return self._bucket
+
+	def take_token(self):
+		# 0 when a token was taken, or the seconds until there'll be one
+		with self._bucket_lock:
+			my_now = time.time()
+			if self.path == None:
+				self.tokens = min(float(self.burst), self.tokens + ((my_now - self._last_refill) * self.rate))
+				self._last_refill = my_now
+				if self.tokens >= 1.0:
+					self.tokens -= 1.0
+					return 0
+				return (1.0 - self.tokens) / self.rate
+
+			my_bucket = self.bucket()
+			fcntl.flock(self._bucket_file.fileno(), fcntl.LOCK_EX)
+			try:
+				my_tokens, my_refill = BUCKET.unpack_from(my_bucket, 0)
+				my_tokens = min(float(self.burst), my_tokens + (max(0.0, my_now - my_refill) * self.rate))
+				my_wait = 0
+				if my_tokens >= 1.0:
+					my_tokens -= 1.0
+				else:
+					my_wait = (1.0 - my_tokens) / self.rate
+				BUCKET.pack_into(my_bucket, 0, my_tokens, my_now)
+				return my_wait
+			finally:
+				fcntl.flock(self._bucket_file.fileno(), fcntl.LOCK_UN)
+
+	def acquire(self, priority):
+		"""acquire - wait for priority's turn, returns the ticket to release"""
+		my_start = time.time()
+		with self._condition:
+			my_ticket = (self.queue_order(priority, my_start), next(self._sequence), priority)
+			bisect.insort(self._waiting, my_ticket)
+			while self.next_ticket() != my_ticket:
+				self._condition.wait()
+			self._waiting.remove(my_ticket)
+			self.in_flight += 1
+			if priority == PRIORITY_BULK:
+				self.bulk_in_flight += 1
+			# The next ticket in line may be able to go too
+			self._condition.notify_all()
+
+		try:
+			if self.rate > 0:
+				my_wait = self.take_token()
+				while my_wait > 0:
+					time.sleep(my_wait)
+					my_wait = self.take_token()
+			my_slot = None
+			if self.slots != None:
+				my_slot = self.slots.acquire(self.slots_for(priority))
+		except:
+			self.release((priority, None))
+			raise
+
+		self.counts[priority] += 1
+		self.waited[priority] += time.time() - my_start
+		return (priority, my_slot)
+
+	def release(self, ticket):
+		my_priority, my_slot = ticket
+		if my_slot != None:
+			self.slots.release(my_slot)
+		with self._condition:
+			self.in_flight -= 1
+			if my_priority == PRIORITY_BULK:
+				self.bulk_in_flight -= 1
+			self._condition.notify_all()
+
+	def run(self, path, call):
+		"""run - call() once it's path's turn on the controller"""
+		my_ticket = self.acquire(self.priority_for(path))
+		try:
+			return call()
+		finally:
+			self.release(my_ticket)
+
+	def report(self):
+		my_report = {}
+		for my_name, my_priority in (("critical", PRIORITY_CRITICAL), ("normal", PRIORITY_NORMAL), ("bulk", PRIORITY_BULK)):
+			my_count = self.counts[my_priority]
+			my_report[my_name] = {"requests": my_count, "average_wait": round(self.waited[my_priority] / my_count, 4) if my_count else 0.0}
+		return my_report
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPIResponseCache.py
+
+	DESCRIPTION:
+	Most of the time the controller answers /js, /jp and /jn with
+	exactly the same bytes as last time. The answers are hashed as they
+	come in, and the decoded JSON is kept by hash, so a answer that
+	hasn't changed isn't decoded again. Whatever's worked out from a
+	answer (the default zone times, the running station)
+	is kept by the same hash, and isn't worked out again either.
+
+	/jc has the controller's clock in it, it's different every time.
+
+	It's only worth it in a process that asks the same controllers again
+	and again, the OSPIShard.py workers. A cron run asks each controller
+	once and the cache is gone when it exits, so it stays off there.
+
+	NOTES:
+	"response_cache_entries" : 256 (0 turns it off)
+
+	OSPIResponseCache.configure(my_settings, True) in a long running
+	process turns it on, configure(my_settings) (or nothing) leaves it off.
+
+	orc = OSPIResponseCache.shared()
+	my_value = orc.decode(my_body)
+	my_zone_times = orc.derive("zone_times", my_value, work_out_zone_times)
+
+	work_out_zone_times gets my_value. When the result depends on
+	something besides the answer, pass it as key (it has to hash).
+
+	The decoded answers are shared by everyone who gets the same bytes,
+	don't change one. Take a copy.deepcopy first, like
+	OSPIProgramTransaction.begin does. What derive works out is copied on
+	the way out (a list or dict one level deep), so that's the caller's
+	own.
+
+	derive works on the objects decode handed out, anything else (a copy,
+	a snapshot) is just worked out every time. Hashes and results are
+	kept in one LRU, the least recently used go first.
+
+	report() has the hits and misses of each kind, "json" is the
+	decoding.
+
+	There's one shared cache in each process, OSPIQuery and
+	OSPIConnection decode through it.
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import logging, json, hashlib, threading, copy
+from collections import OrderedDict
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospiresponsecache')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospiresponsecache.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CONSTANTS
+################################################################################
+RESPONSE_CACHE_ENTRIES = 256
+RESPONSE_KIND_JSON = "json"
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPIResponseCache(object):
+	"""OSPIResponseCache - decoded answers and what's worked out from them, by the hash of the answer"""
+
+	# Off until a long running process turns it on
+	max_entries_default = 0
+	_shared = None
+	_shared_lock = threading.Lock()
+
+	def __init__(self, max_entries=RESPONSE_CACHE_ENTRIES):
+		self.max_entries = max_entries
+		self.counts = {}
+		# (kind, hash, key) -> value, least recently used first
+		self._entries = OrderedDict()
+		# id of a decoded answer in _entries -> the hash of its bytes
+		self._digests = {}
+		self._lock = threading.Lock()
+
+	@classmethod
+	def configure(cls, settings, long_running=False):
+		# Sets the size of the shared cache, it starts again empty
+		if long_running:
+			cls.max_entries_default = settings.get('response_cache_entries', RESPONSE_CACHE_ENTRIES)
+		else:
+			cls.max_entries_default = 0
+		with cls._shared_lock:
+			cls._shared = None
+
+	@classmethod
+	def shared(cls):
+		"""shared - the one cache in this process"""
+		with cls._shared_lock:
+			if cls._shared == None:
+				cls._shared = cls(cls.max_entries_default)
+			return cls._shared
+
+	################################################################################
+	# FUNCTIONS
+	################################################################################
+	@staticmethod
+	def digest(body):
+		# A cassette hands back the body as unicode
+		if isinstance(body, unicode):
+			body = body.encode('utf-8')
+		return hashlib.sha1(body).digest()
+
+	def decode(self, body):
+		"""decode - json.loads(body), the same object as last time when the bytes haven't changed"""
+		if self.max_entries <= 0:
+			return json.loads(body)
+		return self.lookup(RESPONSE_KIND_JSON, self.digest(body), lambda: json.loads(body))
+
+	def derive(self, kind, decoded, call, key=None):
+		"""derive - call(decoded), worked out once for each answer decode handed out (and key, for anything else call depends on)"""
+		with self._lock:
+			my_digest = self._digests.get(id(decoded))
+		if my_digest == None or self.max_entries <= 0:
+			return call(decoded)
+		my_value = self.lookup(kind, my_digest, lambda: call(decoded), key)
+		# The kept one is shared, the caller gets its own
+		if isinstance(my_value, (dict, list)):
+			return copy.copy(my_value)
+		return my_value
+
+	def lookup(self, kind, digest, call, key=None):
+		my_key = (kind, digest, key)
+		with self._lock:
+			my_counts = self.counts.setdefault(kind, [0, 0])
+			if my_key in self._entries:
+				my_value = self._entries.pop(my_key)
+				self._entries[my_key] = my_value
+				my_counts[0] += 1
+				return my_value
+			my_counts[1] += 1
+
+		# Worked out outside the lock, two threads missing together both do the work
+		my_value = call()
+		with self._lock:
+			if my_key in self._entries:
+				return self._entries[my_key]
+			self._entries[my_key] = my_value
+			# Only lists and dicts, a number or null can be the same object for different bytes
+			if kind == RESPONSE_KIND_JSON and isinstance(my_value, (dict, list)):
+				self._digests[id(my_value)] = digest
+			while len(self._entries) > self.max_entries:
+				(my_kind, my_digest, my_extra), my_old = self._entries.popitem(last=False)
+				if my_kind == RESPONSE_KIND_JSON and self._digests.get(id(my_old)) == my_digest:
+					del self._digests[id(my_old)]
+		return my_value
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self._digests.clear()
+
+	def report(self):
+		my_report = {}
+		with self._lock:
+			for my_kind, (my_hits, my_misses) in self.counts.iteritems():
+				my_total = my_hits + my_misses
+				my_report[my_kind] = {"hits": my_hits, "misses": my_misses, "hit_rate": round(float(my_hits) / my_total, 4) if my_total else 0.0}
+		return my_report
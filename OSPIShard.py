@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPIShard.py
+
+	DESCRIPTION:
+	Split the fleet between worker processes. Each controller belongs to
+	one worker, picked by a consistent hash of the controller's name, so
+	when a worker joins or goes away only its share of the controllers
+	moves. Who owns what is kept in a SQLite lease table every worker
+	shares, a worker that stops renewing its leases loses them.
+
+	NOTES:
+	"shard_db" : "/tmp/ospi_shard.db"
+	"shard_lease" : 60 (seconds a worker and its leases last without a heartbeat)
+	"shard_replicas" : 64 (points on the ring for each worker)
+	"shard_poll_interval" : 60
+	"shard_job_interval" : 86400 (how often logs and adjust run for a controller)
+	"shard_retry_interval" : 900 (how soon a controller the job failed for is tried again)
+
+	python OSPIShard.py <worker> [poll] [logs] [adjust]
+	python OSPIShard.py status
+
+	Start as many workers as there are cores, on as many boxes as share
+	the "shard_db" file (it needs a filesystem where file locks work,
+	not NFS). Each one polls, pulls the logs and adjusts only its own
+	controllers. The last run of logs and adjust is in the table too, so
+	a controller that moves to another worker isn't run twice in a day.
+	Only the controllers a job went through for are marked as run, the
+	rest are tried again after "shard_retry_interval".
+
+	The polls run on a thread of their own, so a log pull spread over
+	"schedule_window" doesn't hold them up, and publish to the live state
+	(OSPILiveState) as well as the flow history. A worker rebalances a
+	third of the way through each lease, not every time round, and
+	checks which of its controllers are due with one read of the table,
+	so the workers hardly ever wait on each other for the file.
+
+	A controller only changes hands once the old owner lets it go (on
+	its next rebalance) or its lease runs out, so two workers never own
+	it at once.
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import os, sys, logging, time, socket, threading, sqlite3, hashlib, bisect, signal
+from OSPIUtility import OSPICheckStatus, OSPIReadSettings, QUERY_TIMEOUT
+from OSPIControllerHealth import OSPIControllerHealth
+from OSPIRequestScheduler import OSPIRequestScheduler
+from OSPIResponseCache import OSPIResponseCache
+from OSPIJobScheduler import OSPIJobScheduler
+from OSPICassette import OSPICassette
+from OSPIPoller import OSPIPoller
+from OSPIFlowHistory import flow_recorder
+from OSPILiveState import OSPILiveState
+from OSPIGetLogData import run_logs
+from OSPIAdjustProgramData import run_adjustments
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospishard')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospishard.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CONSTANTS
+################################################################################
+SHARD_TABLES = [
+	"CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, host TEXT, pid INTEGER, heartbeat REAL)",
+	"CREATE TABLE IF NOT EXISTS leases (controller TEXT PRIMARY KEY, worker TEXT, expires REAL)",
+	"CREATE TABLE IF NOT EXISTS jobs (controller TEXT, job TEXT, last_run REAL, PRIMARY KEY (controller, job))",
+]
+
+# A worker that's been quiet this many leases is forgotten
+SHARD_FORGET = 10
+
+SHARD_JOBS = ["poll", "logs", "adjust"]
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPIHashRing(object):
+	"""OSPIHashRing - consistent hash of controller names onto workers"""
+
+	def __init__(self, workers, replicas=64):
+		self.workers = sorted(workers)
+		my_points = sorted((self.position("{0}#{1}".format(my_worker, my_count)), my_worker) for my_worker in self.workers for my_count in xrange(replicas))
+		self._positions = [my_position for my_position, my_worker in my_points]
+		self._owners = [my_worker for my_position, my_worker in my_points]
+
+	@staticmethod
+	def position(key):
+		if isinstance(key, unicode):
+			key = key.encode('utf-8')
+		return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+	def owner(self, key):
+		"""owner - the worker for key, None when there are no workers"""
+		if not self._positions:
+			return None
+		return self._owners[bisect.bisect(self._positions, self.position(key)) % len(self._positions)]
+
+	def shares(self, keys):
+		my_shares = dict((my_worker, 0) for my_worker in self.workers)
+		for my_key in keys:
+			my_shares[self.owner(my_key)] += 1
+		return my_shares
+
+class OSPIShard(object):
+	"""OSPIShard - one worker's membership and controller leases in the shared table"""
+
+	def __init__(self, path, worker, lease_seconds=60, replicas=64):
+		self.path = path
+		self.worker = worker
+		self.lease_seconds = lease_seconds
+		self.replicas = replicas
+		self.host = socket.gethostname()
+		self.pid = os.getpid()
+		self.ring = None
+		self.owned = set()
+		self._stop = threading.Event()
+		self._thread = None
+		my_db = self.connect()
+		try:
+			for my_table in SHARD_TABLES:
+				my_db.execute(my_table)
+		finally:
+			my_db.close()
+
+	@classmethod
+	def from_settings(cls, settings, worker=None):
+		"""from_settings - the shard for worker (host.pid when it's not given), None without a "shard_db\""""
+		my_path = settings.get('shard_db')
+		if not my_path:
+			return None
+		if worker == None:
+			worker = "{0}.{1}".format(socket.gethostname(), os.getpid())
+		return cls(my_path, worker, settings.get('shard_lease', 60), settings.get('shard_replicas', 64))
+
+	################################################################################
+	# FUNCTIONS
+	################################################################################
+	def connect(self):
+		# A connection per call, so the heartbeat thread and other processes don't share one
+		return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+	def transaction(self, call):
+		"""transaction - call(db, now) with the table locked against the other workers"""
+		my_db = self.connect()
+		try:
+			my_db.execute("BEGIN IMMEDIATE")
+			try:
+				my_return = call(my_db, time.time())
+			except:
+				my_db.execute("ROLLBACK")
+				raise
+			my_db.execute("COMMIT")
+			return my_return
+		finally:
+			my_db.close()
+
+	def heartbeat(self):
+		"""heartbeat - we're still here, and still own what we own"""
+		def renew(my_db, my_now):
+			my_db.execute("INSERT OR REPLACE INTO workers (worker, host, pid, heartbeat) VALUES (?, ?, ?, ?)", (self.worker, self.host, self.pid, my_now))
+			my_db.execute("UPDATE leases SET expires = ? WHERE worker = ?", (my_now + self.lease_seconds, self.worker))
+		self.transaction(renew)
+
+	def rebalance(self, controllers):
+		"""rebalance - take the controllers the ring gives us, let go of the rest, returns the names we own"""
+		def balance(my_db, my_now):
+			my_db.execute("INSERT OR REPLACE INTO workers (worker, host, pid, heartbeat) VALUES (?, ?, ?, ?)", (self.worker, self.host, self.pid, my_now))
+			my_db.execute("DELETE FROM workers WHERE heartbeat < ?", (my_now - (SHARD_FORGET * self.lease_seconds),))
+			my_live = [my_row[0] for my_row in my_db.execute("SELECT worker FROM workers WHERE heartbeat >= ?", (my_now - self.lease_seconds,))]
+			my_ring = OSPIHashRing(my_live, self.replicas)
+			my_owned = set()
+			for my_controller in controllers:
+				my_lease = my_db.execute("SELECT worker, expires FROM leases WHERE controller = ?", (my_controller,)).fetchone()
+				if my_ring.owner(my_controller) == self.worker:
+					if my_lease == None:
+						my_db.execute("INSERT INTO leases (controller, worker, expires) VALUES (?, ?, ?)", (my_controller, self.worker, my_now + self.lease_seconds))
+					elif my_lease[0] == self.worker or my_lease[1] < my_now:
+						my_db.execute("UPDATE leases SET worker = ?, expires = ? WHERE controller = ?", (self.worker, my_now + self.lease_seconds, my_controller))
+					else:
+						# The old owner lets go on its next rebalance, or its lease runs out
+						continue
+					my_owned.add(my_controller)
+				elif my_lease != None and my_lease[0] == self.worker:
+					my_db.execute("DELETE FROM leases WHERE controller = ?", (my_controller,))
+			return my_ring, my_owned
+
+		self.ring, my_owned = self.transaction(balance)
+		if my_owned != self.owned:
+			log.debug("OSPIShard:rebalance: {0} of {1} workers, took {2}, let go of {3}".format(self.worker, len(self.ring.workers), sorted(my_owned - self.owned), sorted(self.owned - my_owned)))
+		self.owned = my_owned
+		return sorted(my_owned)
+
+	def owns(self, controller):
+		"""owns - True while our lease on controller is good, check before doing anything to it"""
+		my_db = self.connect()
+		try:
+			my_lease = my_db.execute("SELECT worker, expires FROM leases WHERE controller = ?", (controller,)).fetchone()
+		finally:
+			my_db.close()
+		return my_lease != None and my_lease[0] == self.worker and my_lease[1] >= time.time()
+
+	def due(self, controller, job, interval):
+		my_db = self.connect()
+		try:
+			my_run = my_db.execute("SELECT last_run FROM jobs WHERE controller = ? AND job = ?", (controller, job)).fetchone()
+		finally:
+			my_db.close()
+		return my_run == None or (time.time() - my_run[0]) >= interval
+
+	def due_owned(self, controllers, jobs, interval):
+		"""due_owned - {job: names} of the controllers that are due each of jobs and that we hold a good lease on, in one read"""
+		my_db = self.connect()
+		try:
+			my_now = time.time()
+			my_leased = set(my_row[0] for my_row in my_db.execute("SELECT controller FROM leases WHERE worker = ? AND expires >= ?", (self.worker, my_now)))
+			my_runs = dict(((my_controller, my_job), my_last_run) for my_controller, my_job, my_last_run in my_db.execute("SELECT controller, job, last_run FROM jobs WHERE last_run > ?", (my_now - interval,)))
+		finally:
+			my_db.close()
+		return dict((my_job, set(my_controller for my_controller in controllers if my_controller in my_leased and (my_controller, my_job) not in my_runs)) for my_job in jobs)
+
+	def done(self, controller, job):
+		self.transaction(lambda my_db, my_now: my_db.execute("INSERT OR REPLACE INTO jobs (controller, job, last_run) VALUES (?, ?, ?)", (controller, job, my_now)))
+
+	def start(self):
+		"""start - heartbeat in the background, so a long log pull doesn't lose the leases"""
+		self.heartbeat()
+		self._stop.clear()
+		self._thread = threading.Thread(target=self.run_heartbeat, name="ospishard-heartbeat")
+		self._thread.daemon = True
+		self._thread.start()
+
+	def run_heartbeat(self):
+		while not self._stop.wait(self.lease_seconds / 3.0):
+			try:
+				self.heartbeat()
+			except sqlite3.Error, e:
+				log.error("OSPIShard:run_heartbeat: {0} could not renew, received error {1}".format(self.worker, e))
+
+	def stop(self):
+		"""stop - leave the fleet, the other workers take our controllers on their next rebalance"""
+		self._stop.set()
+		if self._thread != None:
+			self._thread.join()
+			self._thread = None
+		def leave(my_db, my_now):
+			my_db.execute("DELETE FROM leases WHERE worker = ?", (self.worker,))
+			my_db.execute("DELETE FROM workers WHERE worker = ?", (self.worker,))
+		self.transaction(leave)
+		self.owned = set()
+		log.debug("OSPIShard:stop: {0} left".format(self.worker))
+
+	def status(self):
+		"""status - [(worker, host, pid, seconds since the heartbeat, controllers owned)]"""
+		my_db = self.connect()
+		try:
+			my_now = time.time()
+			my_counts = dict(my_db.execute("SELECT worker, COUNT(*) FROM leases WHERE expires >= ? GROUP BY worker", (my_now,)).fetchall())
+			return [(my_worker, my_host, my_pid, round(my_now - my_heartbeat, 1), my_counts.get(my_worker, 0)) for my_worker, my_host, my_pid, my_heartbeat in my_db.execute("SELECT worker, host, pid, heartbeat FROM workers ORDER BY worker")]
+		finally:
+			my_db.close()
+
+class OSPIShardPoll(object):
+	"""OSPIShardPoll - polls one controller for a worker, and keeps its flow history"""
+
+	def __init__(self, settings, controller, live_state=None):
+		my_name = controller['name']
+		och = OSPIControllerHealth.from_settings(settings, my_name)
+		self.opcs = OSPICheckStatus(controller['open_sprinkler_ip'], controller['md5_pass'], None, och, settings.get('query_timeout', QUERY_TIMEOUT))
+		self.poller = OSPIPoller(self.opcs.station_address, self.opcs.passwd, self.opcs.timeout, och)
+		self.poll_interval = settings.get('shard_poll_interval', 60)
+		self.station_states = []
+		self.last_poll = None
+		# Looks enough like a OSPIEventIngest for its listeners
+		self.listeners = [flow_recorder(settings, my_name)]
+		if live_state != None:
+			self.listeners.append(live_state.publisher(my_name))
+
+	def poll(self):
+		if self.last_poll != None and (time.time() - self.last_poll) < self.poll_interval:
+			return
+		self.last_poll = time.time()
+		if not self.poller.poll():
+			return
+		self.poller.update(self.opcs)
+		self.station_states[:] = self.poller.station_states
+		for my_listener in self.listeners:
+			my_listener(self)
+
+	def close(self):
+		self.poller.close()
+
+################################################################################
+# FUNCTIONS
+################################################################################
+
+def run_polls(settings, osh, controllers, stop):
+	"""run_polls - poll the controllers osh owns until stop is set, on a thread of its own"""
+	olsw = OSPILiveState.from_settings(settings, True)
+	my_polls = {}
+	try:
+		while not stop.is_set():
+			# rebalance swaps osh.owned for a new set, it's never changed in place
+			my_owned = osh.owned
+			# The controllers that moved to another worker aren't polled here any more
+			for my_name in [my_name for my_name in my_polls if my_name not in my_owned]:
+				my_polls.pop(my_name).close()
+			for my_controller in controllers:
+				if my_controller['name'] not in my_owned:
+					continue
+				osp = my_polls.get(my_controller['name'])
+				if osp == None:
+					osp = OSPIShardPoll(settings, my_controller, olsw)
+					my_polls[my_controller['name']] = osp
+				try:
+					osp.poll()
+				except Exception, e:
+					log.error("OSPIShard:run_polls: {0} poll of {1} failed, received error {2}".format(osh.worker, my_controller['name'], e))
+			stop.wait(1)
+	finally:
+		for osp in my_polls.values():
+			osp.close()
+		olsw.close()
+
+def run_worker(settings, osh, controllers, jobs):
+	"""run_worker - poll, pull the logs and adjust the controllers osh owns, until we're stopped"""
+	my_job_interval = settings.get('shard_job_interval', 86400)
+	my_retry_interval = settings.get('shard_retry_interval', 900)
+	my_names = [my_controller['name'] for my_controller in controllers]
+	# The fleet report and the email subjects go by every controller, not just this worker's.
+	# Each returns the names of the controllers it went through for
+	my_batches = [my_batch for my_batch in (("logs", lambda my_settings, my_due: run_logs(my_settings, my_due, controllers)), ("adjust", lambda my_settings, my_due: run_adjustments(my_settings, my_due, controllers))) if my_batch[0] in jobs]
+	# (controller, job) -> when it failed here, so a failure isn't retried every second
+	my_failed = {}
+	my_stop = threading.Event()
+	my_poll_thread = None
+	osh.start()
+	try:
+		osh.rebalance(my_names)
+		my_rebalanced = time.time()
+		if "poll" in jobs:
+			my_poll_thread = threading.Thread(target=run_polls, args=(settings, osh, controllers, my_stop), name="ospishard-polls")
+			my_poll_thread.daemon = True
+			my_poll_thread.start()
+
+		while True:
+			if time.time() - my_rebalanced >= osh.lease_seconds / 3.0:
+				osh.rebalance(my_names)
+				my_rebalanced = time.time()
+
+			my_due_jobs = osh.due_owned(sorted(osh.owned), [my_job for my_job, my_run in my_batches], my_job_interval) if my_batches else {}
+			for my_job, my_run in my_batches:
+				my_due = [my_controller for my_controller in controllers if my_controller['name'] in my_due_jobs[my_job] and time.time() - my_failed.get((my_controller['name'], my_job), 0) >= my_retry_interval]
+				if not my_due:
+					continue
+				log.debug("OSPIShard:run_worker: {0} running {1} for {2}".format(osh.worker, my_job, ", ".join(my_controller['name'] for my_controller in my_due)))
+				try:
+					my_done = set(my_run(settings, my_due))
+				except Exception, e:
+					log.error("OSPIShard:run_worker: {0} {1} failed, received error {2}".format(osh.worker, my_job, e))
+					my_done = set()
+				for my_controller in my_due:
+					if my_controller['name'] in my_done:
+						my_failed.pop((my_controller['name'], my_job), None)
+						osh.done(my_controller['name'], my_job)
+					else:
+						log.error("OSPIShard:run_worker: {0} {1} did not go through for {2}, trying again in {3}s".format(osh.worker, my_job, my_controller['name'], my_retry_interval))
+						my_failed[(my_controller['name'], my_job)] = time.time()
+			time.sleep(1)
+	finally:
+		my_stop.set()
+		if my_poll_thread != None:
+			my_poll_thread.join()
+		osh.stop()
+
+################################################################################
+# RUN AS SCRIPT
+################################################################################
+
+if __name__ == "__main__":
+	ors = OSPIReadSettings()
+	my_settings = ors.add_settings()
+	my_controllers = ors.return_controllers()
+	my_settings.setdefault('shard_db', "/tmp/ospi_shard.db")
+
+	if len(sys.argv) < 2 or sys.argv[1] == "status":
+		osh = OSPIShard.from_settings(my_settings, "status")
+		for my_worker, my_host, my_pid, my_age, my_count in osh.status():
+			print "{0}: {1} pid {2}, heartbeat {3}s ago, {4} controllers".format(my_worker, my_host, my_pid, my_age, my_count)
+		sys.exit(0)
+
+	my_jobs = [my_job for my_job in sys.argv[2:] if my_job in SHARD_JOBS] or SHARD_JOBS
+	OSPIRequestScheduler.configure(my_settings)
+	# The workers ask the same controllers all day, the cron scripts leave it off
+	OSPIResponseCache.configure(my_settings, True)
+	OSPIJobScheduler.configure(my_settings)
+	OSPICassette.from_settings(my_settings)
+	osh = OSPIShard.from_settings(my_settings, sys.argv[1])
+
+	# Let go of the controllers on a kill too, not just ^C
+	signal.signal(signal.SIGTERM, lambda my_signal, my_frame: sys.exit(0))
+	try:
+		run_worker(my_settings, osh, my_controllers, my_jobs)
+	except KeyboardInterrupt:
+		pass
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPISingleFlight.py
+
+	DESCRIPTION:
+	Cross process single flight for controller calls. When the cron jobs
+	overlap, only one process makes a given call to the controller, and
+	the others wait for it and use its result instead of making their own.
+
+	NOTES:
+	Every call gets a lock file and a result file in "flight_lock_dir",
+	named by a md5 of the query so the password never ends up in a file
+	name.
+	/tmp/ospi_flight_<md5>.lock
+	/tmp/ospi_flight_<md5>.json
+
+	The lock is a flock, so the kernel lets go of it when a holder
+	crashes. A holder that hangs is waited on for "flight_lock_timeout"
+	seconds, then we go ahead and make the call ourselves. A result is
+	only reused when it finished while we waited on the lock, a call
+	nobody was making when we came along is made again.
+
+	The result files are 0600, they have the controller's answers in
+	them. Lock and result files older than "flight_reuse_window" seconds
+	are deleted (at most once a window, by a process that made a call).
+	A lock file is only deleted with its flock held, and a process that
+	gets a flock checks the file is still the one at the path, so a
+	deleted lock never lets two calls through.
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import os, logging, json, time, fcntl, hashlib, errno
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospisingleflight')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospisingleflight.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPISingleFlight(object):
+	"""OSPISingleFlight - one process makes the call, everybody else shares the result"""
+
+	def __init__(self, lock_dir="/tmp", lock_timeout=60, reuse_window=30):
+		self.lock_dir = lock_dir
+		self.lock_timeout = lock_timeout
+		self.reuse_window = reuse_window
+		self._last_cleanup = 0
+
+	@classmethod
+	def from_settings(cls, settings):
+		return cls(settings.get('flight_lock_dir', "/tmp"), settings.get('flight_lock_timeout', 60), settings.get('flight_reuse_window', 30))
+
+	################################################################################
+	# FUNCTIONS
+	################################################################################
+	def key_for(self, query):
+		return hashlib.md5(query).hexdigest()
+
+	def lock_path(self, key):
+		return os.path.join(self.lock_dir, "ospi_flight_{0}.lock".format(key))
+
+	def result_path(self, key):
+		return os.path.join(self.lock_dir, "ospi_flight_{0}.json".format(key))
+
+	def read_result(self, key, since):
+		# A result is shared when it's newer than since
+		try:
+			my_file = open(self.result_path(key), 'r')
+			my_result = json.load(my_file)
+			my_file.close()
+		except (IOError, ValueError):
+			return None
+		if my_result["time"] < since:
+			return None
+		return my_result
+
+	def write_result(self, key, value):
+		my_tmp_path = "{0}.{1}".format(self.result_path(key), os.getpid())
+		my_file = os.fdopen(os.open(my_tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'w')
+		json.dump({"time": time.time(), "value": value}, my_file)
+		my_file.close()
+		os.rename(my_tmp_path, self.result_path(key))
+
+	def open_lock(self, key):
+		return os.fdopen(os.open(self.lock_path(key), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0600), 'a')
+
+	def is_current(self, key, lock_file):
+		# cleanup may have deleted the file we locked, the lock only counts on the file at the path
+		try:
+			return os.fstat(lock_file.fileno()).st_ino == os.stat(self.lock_path(key)).st_ino
+		except OSError, e:
+			if e.errno != errno.ENOENT:
+				raise
+			return False
+
+	def acquire(self, key):
+		"""acquire - the locked lock file, or None when the holder kept it longer than lock_timeout"""
+		# Poll for the lock so a holder that hangs can't keep us here forever
+		my_deadline = time.time() + self.lock_timeout
+		my_wait = 0.05
+		my_lock_file = self.open_lock(key)
+		while True:
+			try:
+				fcntl.flock(my_lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+				if self.is_current(key, my_lock_file):
+					return my_lock_file
+				my_lock_file.close()
+				my_lock_file = self.open_lock(key)
+				continue
+			except IOError:
+				if time.time() >= my_deadline:
+					my_lock_file.close()
+					return None
+				time.sleep(my_wait)
+				my_wait = min(my_wait * 2, 1.0)
+
+	def cleanup(self):
+		"""cleanup - delete the lock and result files older than the reuse window"""
+		my_now = time.time()
+		if my_now - self._last_cleanup < self.reuse_window:
+			return
+		self._last_cleanup = my_now
+		for my_name in os.listdir(self.lock_dir):
+			if not my_name.startswith("ospi_flight_"):
+				continue
+			my_path = os.path.join(self.lock_dir, my_name)
+			try:
+				if os.path.getmtime(my_path) > my_now - self.reuse_window:
+					continue
+				if not my_name.endswith(".lock"):
+					os.remove(my_path)
+					continue
+				# Only with the flock, a held lock is somebody's call
+				my_lock_file = open(my_path, 'a')
+				try:
+					fcntl.flock(my_lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+					os.remove(my_path)
+				except IOError:
+					pass
+				finally:
+					my_lock_file.close()
+			except OSError, e:
+				# Another process cleaned it up first
+				if e.errno != errno.ENOENT:
+					raise
+
+	def run(self, query, call):
+		"""run - make call() for query, unless another process made it (or is making it) already"""
+		my_key = self.key_for(query)
+		my_start = time.time()
+
+		if not os.path.isdir(self.lock_dir):
+			os.makedirs(self.lock_dir)
+		my_lock_file = self.acquire(my_key)
+		if my_lock_file == None:
+			log.error("OSPISingleFlight:run: {0} lock held longer than {1} seconds, calling anyway".format(my_key, self.lock_timeout))
+			return call()
+		try:
+			# Whoever held the lock may have just finished the same call, anything older isn't ours to use
+			my_result = self.read_result(my_key, my_start)
+			if my_result != None:
+				log.debug("OSPISingleFlight:run: {0} waited for and reused result".format(my_key))
+				return my_result["value"]
+
+			my_value = call()
+			if my_value != None:
+				self.write_result(my_key, my_value)
+			self.cleanup()
+			return my_value
+		finally:
+			my_lock_file.close()
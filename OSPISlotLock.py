@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPISlotLock.py
+
+	DESCRIPTION:
+	A fixed number of slots shared by every process on the box, for the
+	limits that have to hold across the cron scripts, the poller and the
+	shard workers. Each slot is a file with a flock on it, so taking one
+	is a couple of system calls, a waiter sleeps in the kernel rather than
+	polling, and a process that dies lets go of its slots with it.
+
+	NOTES:
+	<path>.0.lock, <path>.1.lock ... one file per slot
+
+	osl = OSPISlotLock("/tmp/ospi_requests_10.0.0.1_8080", 2)
+	with osl.slot():
+		...
+
+	The files are opened once and kept. A flock belongs to the open file,
+	not the thread, so the threads of a process keep out of each other's
+	slots here, and only then go to the kernel.
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import os, logging, errno, threading, fcntl, contextlib
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospislotlock')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospislotlock.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPISlotLock(object):
+	"""OSPISlotLock - count slots shared between processes, a flock'd file each"""
+
+	def __init__(self, path, count=1):
+		self.path = path
+		self.count = max(1, count)
+		self._files = {}
+		self._held = set()
+		self._condition = threading.Condition()
+
+	################################################################################
+	# FUNCTIONS
+	################################################################################
+	def slot_path(self, index):
+		return "{0}.{1}.lock".format(self.path, index)
+
+	def slot_file(self, index):
+		my_file = self._files.get(index)
+		if my_file == None:
+			if not os.path.isdir(os.path.dirname(self.slot_path(index))):
+				os.makedirs(os.path.dirname(self.slot_path(index)))
+			my_file = open(self.slot_path(index), 'a')
+			self._files[index] = my_file
+		return my_file
+
+	def acquire(self, slots=None):
+		"""acquire - take one of slots (all of them when None, tried in that order), returns its index"""
+		if slots == None:
+			slots = range(self.count)
+		with self._condition:
+			while True:
+				my_free = [my_index for my_index in slots if my_index not in self._held]
+				if my_free:
+					break
+				self._condition.wait()
+			for my_index in my_free:
+				try:
+					fcntl.flock(self.slot_file(my_index).fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+				except IOError, e:
+					if e.errno not in (errno.EAGAIN, errno.EACCES):
+						raise
+					continue
+				self._held.add(my_index)
+				return my_index
+			# Other processes have every one we could take, wait on the first
+			my_index = my_free[0]
+			my_file = self.slot_file(my_index)
+			self._held.add(my_index)
+
+		try:
+			fcntl.flock(my_file.fileno(), fcntl.LOCK_EX)
+		except:
+			with self._condition:
+				self._held.discard(my_index)
+				self._condition.notify_all()
+			raise
+		return my_index
+
+	def release(self, index):
+		with self._condition:
+			fcntl.flock(self._files[index].fileno(), fcntl.LOCK_UN)
+			self._held.discard(index)
+			self._condition.notify_all()
+
+	@contextlib.contextmanager
+	def slot(self, slots=None):
+		"""slot - hold a slot for the length of a with"""
+		my_index = self.acquire(slots)
+		try:
+			yield my_index
+		finally:
+			self.release(my_index)
+
+	def close(self):
+		with self._condition:
+			for my_file in self._files.values():
+				my_file.close()
+			self._files = {}
+			self._held = set()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPISnapshotCache.py
+
+	DESCRIPTION:
+	A local binary snapshot of the station names (/jn), program table
+	(/jp) and controller options (/jo), so a cron run can start warm
+	and skip those fetches. They only change maybe once a season.
+
+	NOTES:
+	The snapshot is a fixed layout little endian file that is read
+	through mmap, nothing gets parsed from JSON on a warm run.
+
+	header    8s magic, H version, H station name size, d saved time,
+	          16s fingerprint, then 3 x (I offset, I length, I count)
+	names     count x station name size bytes, NUL padded utf-8
+	programs  count x fixed program records
+	          I flag, B days0, B days1, B start count, x pad,
+	          4 x i start times, H station count, H max stations,
+	          max stations x H durations, 32s name
+	values    count x (16s key, B type, x pad, H size, size bytes)
+	          for every other key in /jn /jp and /jo, type 0 is a
+	          int64, anything else is stored as JSON text
+
+	The fingerprint is a md5 of the /jc fields in "snapshot_validate_keys",
+	so checking the snapshot is one small /jc call, and a warm start
+	serves /jn and /jp from the snapshot. The firmware has nothing cheap
+	that changes when a station is renamed or a program edited in the
+	app, so a snapshot is only good for "snapshot_max_age" seconds (an
+	hour), that's how long such an edit can go unseen. A caller that has
+	just read /jp anyway (OSPIAdjustProgramData) passes it in, and a
+	snapshot whose programs don't match it is refetched. Anything that
+	writes programs saves a new snapshot or calls invalidate().
+
+	/jo isn't fetched, the options are only kept when a caller has them.
+
+	A program is [flag, days0, days1, [starts], [durations], name], newer
+	firmware adds more after the name (the date range), those are kept
+	as JSON in "jp.pd_extra".
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import os, logging, struct, time, json, mmap, hashlib, re
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospisnapshotcache')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospisnapshotcache.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CONSTANTS
+################################################################################
+SNAPSHOT_MAGIC = "OSPISNAP"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<8sHHd16sIIIIIIIII')
+PROGRAM_HEADER = struct.Struct('<IBBBx4iHH')
+PROGRAM_NAME = struct.Struct('<32s')
+VALUE_HEADER = struct.Struct('<16sBxH')
+STATION_NAME_SIZE = 32
+VALUE_INT = 0
+VALUE_JSON = 1
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPISnapshotCache(object):
+	"""OSPISnapshotCache - memory mapped snapshot of names, programs and options for one controller"""
+
+	def __init__(self, cache_dir, controller, validate_keys=None, max_age=3600):
+		self.cache_dir = cache_dir
+		self.controller = controller
+		self.validate_keys = validate_keys or ["nbrd"]
+		self.max_age = max_age
+
+	@classmethod
+	def from_settings(cls, settings, controller):
+		return cls(settings.get('snapshot_dir', "/tmp"), controller, settings.get('snapshot_validate_keys'), settings.get('snapshot_max_age', 3600))
+
+	################################################################################
+	# PROPERTIES
+	################################################################################
+	@property
+	def path(self):
+		my_key = re.sub(r'[^A-Za-z0-9.\-]+', '_', self.controller)
+		return os.path.join(self.cache_dir, "ospi_snapshot_{0}.bin".format(my_key))
+
+	################################################################################
+	# FUNCTIONS
+	################################################################################
+	def fingerprint(self, controller_values):
+		my_values = [controller_values.get(my_key) for my_key in self.validate_keys]
+		return hashlib.md5(json.dumps(my_values, sort_keys=True)).digest()
+
+	def invalidate(self):
+		if os.path.exists(self.path):
+			os.remove(self.path)
+			log.debug("OSPISnapshotCache:invalidate: removed {0}".format(self.path))
+
+	def pack_values(self, values, prefix):
+		my_records = []
+		for my_key, my_value in sorted(values.iteritems()):
+			my_key = "{0}{1}".format(prefix, my_key).encode('utf-8')
+			if isinstance(my_value, (int, long)) and not isinstance(my_value, bool):
+				my_payload = struct.pack('<q', my_value)
+				my_type = VALUE_INT
+			else:
+				my_payload = json.dumps(my_value).encode('utf-8')
+				my_type = VALUE_JSON
+			my_records.append(VALUE_HEADER.pack(my_key, my_type, len(my_payload)) + my_payload)
+		return my_records
+
+	def save(self, fingerprint, station_names, program_data, controller_options):
+		# Station names
+		my_names = [my_name.encode('utf-8')[:STATION_NAME_SIZE] for my_name in station_names.get("snames", [])]
+		my_names_block = "".join(struct.pack('<{0}s'.format(STATION_NAME_SIZE), my_name) for my_name in my_names)
+
+		# Programs, every record is padded to the most stations any program has
+		my_programs = program_data.get("pd", [])
+		my_max_stations = max([len(my_program[4]) for my_program in my_programs] or [0])
+		my_program_records = []
+		for my_program in my_programs:
+			my_starts = (list(my_program[3]) + [0, 0, 0, 0])[:4]
+			my_durations = list(my_program[4]) + ([0] * (my_max_stations - len(my_program[4])))
+			my_record = PROGRAM_HEADER.pack(my_program[0], my_program[1], my_program[2], len(my_program[3]), my_starts[0], my_starts[1], my_starts[2], my_starts[3], len(my_program[4]), my_max_stations)
+			my_record += struct.pack('<{0}H'.format(my_max_stations), *my_durations)
+			my_record += PROGRAM_NAME.pack(my_program[5].encode('utf-8'))
+			my_program_records.append(my_record)
+		my_programs_block = "".join(my_program_records)
+
+		# Everything else in the responses
+		my_other_names = dict((my_key, my_value) for my_key, my_value in station_names.iteritems() if my_key != "snames")
+		my_other_programs = dict((my_key, my_value) for my_key, my_value in program_data.iteritems() if my_key != "pd")
+		if any(len(my_program) > 6 for my_program in my_programs):
+			my_other_programs["pd_extra"] = [my_program[6:] for my_program in my_programs]
+		my_values = self.pack_values(my_other_names, "jn.") + self.pack_values(my_other_programs, "jp.") + self.pack_values(controller_options or {}, "jo.")
+		my_values_block = "".join(my_values)
+
+		my_offset = SNAPSHOT_HEADER.size
+		my_header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, STATION_NAME_SIZE, time.time(), fingerprint,
+			my_offset, len(my_names_block), len(my_names),
+			my_offset + len(my_names_block), len(my_programs_block), len(my_programs),
+			my_offset + len(my_names_block) + len(my_programs_block), len(my_values_block), len(my_values))
+
+		if not os.path.isdir(self.cache_dir):
+			os.makedirs(self.cache_dir)
+		my_tmp_path = "{0}.{1}".format(self.path, os.getpid())
+		my_file = open(my_tmp_path, 'wb')
+		my_file.write(my_header + my_names_block + my_programs_block + my_values_block)
+		my_file.close()
+		os.rename(my_tmp_path, self.path)
+		log.debug("OSPISnapshotCache:save: saved {0} names, {1} programs, {2} values to {3}".format(len(my_names), len(my_programs), len(my_values), self.path))
+
+	def load(self, fingerprint):
+		"""load - returns (station_names, program_data, controller_options) or None when the snapshot isn't valid, fingerprint None takes it however old"""
+		if not os.path.exists(self.path):
+			return None
+
+		my_file = open(self.path, 'rb')
+		try:
+			my_map = mmap.mmap(my_file.fileno(), 0, access=mmap.ACCESS_READ)
+		finally:
+			my_file.close()
+
+		try:
+			my_header = SNAPSHOT_HEADER.unpack_from(my_map, 0)
+			my_magic, my_version, my_name_size, my_saved, my_fingerprint = my_header[:5]
+			if my_magic != SNAPSHOT_MAGIC or my_version != SNAPSHOT_VERSION:
+				log.debug("OSPISnapshotCache:load: {0} is not a snapshot we know".format(self.path))
+				return None
+			if fingerprint != None and my_fingerprint != fingerprint:
+				log.debug("OSPISnapshotCache:load: fingerprint changed, snapshot is stale")
+				return None
+			if fingerprint != None and time.time() - my_saved > self.max_age:
+				log.debug("OSPISnapshotCache:load: snapshot is older than {0} seconds".format(self.max_age))
+				return None
+
+			my_names_offset, my_names_length, my_names_count = my_header[5:8]
+			my_programs_offset, my_programs_length, my_programs_count = my_header[8:11]
+			my_values_offset, my_values_length, my_values_count = my_header[11:14]
+
+			my_names = []
+			for my_count in xrange(my_names_count):
+				my_name = struct.unpack_from('<{0}s'.format(my_name_size), my_map, my_names_offset + (my_count * my_name_size))[0]
+				my_names.append(my_name.rstrip("\0").decode('utf-8'))
+
+			my_programs = []
+			my_position = my_programs_offset
+			for my_count in xrange(my_programs_count):
+				my_flag, my_days0, my_days1, my_start_count, my_s0, my_s1, my_s2, my_s3, my_station_count, my_max_stations = PROGRAM_HEADER.unpack_from(my_map, my_position)
+				my_position += PROGRAM_HEADER.size
+				my_durations = list(struct.unpack_from('<{0}H'.format(my_max_stations), my_map, my_position))[:my_station_count]
+				my_position += my_max_stations * 2
+				my_name = PROGRAM_NAME.unpack_from(my_map, my_position)[0].rstrip("\0").decode('utf-8')
+				my_position += PROGRAM_NAME.size
+				my_programs.append([my_flag, my_days0, my_days1, [my_s0, my_s1, my_s2, my_s3][:my_start_count], my_durations, my_name])
+
+			my_station_names = {"snames": my_names}
+			my_program_data = {"pd": my_programs}
+			my_controller_options = {}
+			my_tables = {"jn.": my_station_names, "jp.": my_program_data, "jo.": my_controller_options}
+			my_position = my_values_offset
+			for my_count in xrange(my_values_count):
+				my_key, my_type, my_size = VALUE_HEADER.unpack_from(my_map, my_position)
+				my_position += VALUE_HEADER.size
+				my_payload = my_map[my_position:my_position + my_size]
+				my_position += my_size
+				my_key = my_key.rstrip("\0").decode('utf-8')
+				if my_type == VALUE_INT:
+					my_value = struct.unpack('<q', my_payload)[0]
+				else:
+					my_value = json.loads(my_payload)
+				my_tables[my_key[:3]][my_key[3:]] = my_value
+		finally:
+			my_map.close()
+
+		# Whatever the firmware has after the name
+		for my_program, my_extra in zip(my_programs, my_program_data.pop("pd_extra", [])):
+			my_program.extend(my_extra)
+
+		log.debug("OSPISnapshotCache:load: warm start from {0}".format(self.path))
+		return my_station_names, my_program_data, my_controller_options
+
+	def warm_start(self, opcs, program_data=None):
+		"""warm_start - fill in the station names and program data on a OSPICheckStatus, from the snapshot when it's still valid (and matches program_data, a /jp just read)"""
+		opcs.return_controller_values()
+		if not opcs.controller_values:
+			return False
+		my_fingerprint = self.fingerprint(opcs.controller_values)
+
+		my_snapshot = self.load(my_fingerprint)
+		if my_snapshot != None and (program_data == None or program_data.get("pd") == my_snapshot[1].get("pd")):
+			opcs.station_names, opcs.program_data, opcs.controller_options = my_snapshot
+			return True
+
+		# Cold start, fetch what's missing and keep it for next time
+		opcs.return_station_names()
+		if program_data != None:
+			opcs.program_data = program_data
+		else:
+			opcs.return_program_data()
+		if opcs.station_names and opcs.program_data:
+			self.save(my_fingerprint, opcs.station_names, opcs.program_data, opcs.controller_options)
+		return False
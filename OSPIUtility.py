@@ -23,10 +23,13 @@
 ################################################################################
 # IMPORT
 ################################################################################
-import os, logging, sys, urllib2, json, time, smtplib, pyowm, datetime
+import os, logging, sys, urllib2, json, time, smtplib, pyowm, datetime, socket, httplib, urlparse
 from email.mime.multipart import MIMEMultipart
 from email.MIMEText import MIMEText
 from datetime import datetime
+from OSPIRequestScheduler import OSPIRequestScheduler
+from OSPIResponseCache import OSPIResponseCache
+from OSPIJobScheduler import OSPIJobScheduler
 
 ################################################################################
 # LOGGING
@@ -39,6 +42,15 @@ logger1.setLevel(logging.DEBUG)
 logger1.setFormatter(formatter)
 log.addHandler(logger1)
 
+################################################################################
+# CONSTANTS
+################################################################################
+# Settings each controller in "controllers" can override, anything missing comes from the top level
+CONTROLLER_SETTINGS = ['open_sprinkler_ip', 'md5_pass', 'weather_location', 'weather_latlong']
+
+# Seconds to wait on a controller before giving up, "query_timeout" in the settings
+QUERY_TIMEOUT = 10
+
 ################################################################################
 # CLASSES
 ################################################################################
@@ -97,7 +109,14 @@ class OSPIDefaultZoneInformation(object):
 		self.zone_dict = {}
 
 	def return_default_zone_times(self, program_data):
+		# Worked out once for each /jp answer, the dict is our own copy
+		self.zone_dict = OSPIResponseCache.shared().derive("zone_times", program_data, self.zone_times)
+		return self.zone_dict
+
+	@staticmethod
+	def zone_times(program_data):
 		# Get the zone information, it's the last record in the programs list
+		my_zone_dict = {}
 		my_programs = program_data.get("pd")
 		my_zone_info = my_programs[-1]
 		log.debug("OSPIDefaultZoneInformation:return_default_zone_times: my_zone_info {0}".format(my_zone_info))
@@ -107,22 +126,29 @@ class OSPIDefaultZoneInformation(object):
 		# Count for the zone position
 		my_count = 0
 		for i in my_zone_times_list:
-			self.zone_dict[my_count] = i
+			my_zone_dict[my_count] = i
 			my_count += 1
 
-		log.debug("OSPIDefaultZoneInformation:return_default_zone_times: self.zone_dict {0}".format(self.zone_dict))
-		return self.zone_dict
+		log.debug("OSPIDefaultZoneInformation:return_default_zone_times: my_zone_dict {0}".format(my_zone_dict))
+		return my_zone_dict
 
 class OSPICheckStatus(object):
 	"""OSPICheckStatus - A class to interact with the Open Sprinkler and return various pieces of information"""
 
-	def __init__(self, station_address, passwd):
+	def __init__(self, station_address, passwd, single_flight=None, health=None, timeout=QUERY_TIMEOUT):
 		self.station_address = station_address
 		self.passwd = passwd
+		self.single_flight = single_flight
+		self.health = health
+		self.timeout = timeout
 		self._stations_running = None
 		self._program_data = None
 		self._flow_value = None
 		self._watering_times = []
+		self.station_states = []
+		self._station_names = None
+		self._controller_values = None
+		self._controller_options = None
 
 	################################################################################
 	# PROPERTIES
@@ -177,6 +203,26 @@ class OSPICheckStatus(object):
 		self._station_names = station_names
 		log.debug("OSPIProperties:station_names: setting station names {0}".format(self._station_names))
 
+	@property
+	def controller_values(self):
+		log.debug("OSPIProperties:controller_values: {0}".format(self._controller_values))
+		return self._controller_values
+
+	@controller_values.setter
+	def controller_values(self, controller_values):
+		self._controller_values = controller_values
+		log.debug("OSPIProperties:controller_values: setting controller values {0}".format(self._controller_values))
+
+	@property
+	def controller_options(self):
+		log.debug("OSPIProperties:controller_options: {0}".format(self._controller_options))
+		return self._controller_options
+
+	@controller_options.setter
+	def controller_options(self, controller_options):
+		self._controller_options = controller_options
+		log.debug("OSPIProperties:controller_options: setting controller options {0}".format(self._controller_options))
+
 	################################################################################
 	# FUNCTIONS
 	################################################################################
@@ -184,21 +230,39 @@ class OSPICheckStatus(object):
 		my_ospi_query= "{0}/js?pw={1}".format(self.station_address,self.passwd)
 		stations_active = self.run_query_and_return(my_ospi_query)
 		log.debug("CheckOSPIStatus:check_stations_running: CGIQuery return {0}".format(stations_active))
+		if not stations_active:
+			log.error("CheckOSPIStatus:check_stations_running: no station status from {0}".format(self.station_address))
+			return
 
 		# Look for "sn" in the json output and read in the list
 		list_stations = stations_active["sn"]
+		# Our own list, the decoded answer is shared with whoever got the same bytes
+		self.station_states = list(list_stations)
 
+		# The same answer as last poll has the same station running
+		my_running = OSPIResponseCache.shared().derive("stations_running", stations_active, self.station_running)
+		if my_running != None:
+			self.stations_running = my_running
+
+	@staticmethod
+	def station_running(stations_active):
+		# The last station that's on, None when nothing is
+		my_running = None
 		station_count = 0
-		for station in list_stations:
+		for station in stations_active["sn"]:
 			station_count += 1
 			if station != 0:
 				log.debug("CheckOSPIStatus:check_stations_running: Station {0} is running".format(station_count))
-				self.stations_running = station
+				my_running = station
 				# We have a active scheduled run, terminate
+		return my_running
 
 	def check_flow_control_running(self):
 		my_ospi_query= "{0}/jc?pw={1}".format(self.station_address,self.passwd)
 		flow_control_active = self.run_query_and_return(my_ospi_query)
+		if not flow_control_active:
+			log.error("CheckOSPIStatus:check_flow_control_running: no controller values from {0}".format(self.station_address))
+			return
 
 		# Look for "flcrt" in the json output and read in the value
 		flow_control_running = flow_control_active["flcrt"]
@@ -208,8 +272,16 @@ class OSPICheckStatus(object):
 		my_ospi_query= "{0}/jp?pw={1}".format(self.station_address,self.passwd)
 		self.program_data = self.run_query_and_return(my_ospi_query)
 
-	def return_log_data(self):
-		my_ospi_query = "{0}/jl?pw={1}&hist={2}".format(self.station_address,self.passwd,1)
+	def return_controller_values(self):
+		my_ospi_query = "{0}/jc?pw={1}".format(self.station_address,self.passwd)
+		self.controller_values = self.run_query_and_return(my_ospi_query)
+
+	def return_controller_options(self):
+		my_ospi_query = "{0}/jo?pw={1}".format(self.station_address,self.passwd)
+		self.controller_options = self.run_query_and_return(my_ospi_query)
+
+	def return_log_data(self, hist=1):
+		my_ospi_query = "{0}/jl?pw={1}&hist={2}".format(self.station_address,self.passwd,hist)
 		self.program_data = self.run_query_and_return(my_ospi_query)
 
 	def return_station_names(self):
@@ -220,11 +292,32 @@ class OSPICheckStatus(object):
 		my_ospi_query = "{0}/dl?pw={1}&day=all".format(self.station_address,self.passwd)
 		self.run_query_and_return(my_ospi_query)
 
-	@staticmethod
-	def run_query_and_return(query):
-		cg = OSPIQuery()
-		cg.ospi_query = query
-		my_return = cg.ospi_query
+	def remove_log_day(self, day):
+		# day is the epoch day, time / 86400
+		my_ospi_query = "{0}/dl?pw={1}&day={2}".format(self.station_address,self.passwd,day)
+		return self.run_query_and_return(my_ospi_query)
+
+	def run_query_and_return(self, query):
+		def run_query():
+			cg = OSPIQuery(self.timeout)
+			my_start = time.time()
+			cg.ospi_query = query
+			if self.health:
+				if cg.error != None:
+					self.health.record_failure(cg.error)
+				else:
+					self.health.record_success(time.time() - my_start)
+			return cg.ospi_query
+
+		# A controller that's known to be down is skipped, instead of waiting out the timeout
+		if self.health and not self.health.allow():
+			return None
+
+		# Overlapping cron runs share one call to the controller
+		if self.single_flight:
+			my_return = self.single_flight.run(query, run_query)
+		else:
+			my_return = run_query()
 		log.debug("CheckOSPIStatus:run_query_and_return: CGIQuery return {0}".format(my_return))
 		return my_return
 
@@ -237,50 +330,31 @@ class OSPIWaterAdjustment(object):
 		self.adjusted_programs = []
 
 	def adjust_duration_default(self):
-		self.programs = self.program_data.get("pd")
-		my_count = 0
-		for my_item in self.programs:
-			my_duration_list = my_item[4]
-			my_default_by_position = self.base_zone_times_dict.get(my_count)
-			if my_default_by_position != None:
-				my_item[4][my_count] = int(my_default_by_position)
-				log.debug("OSPIWaterAdjustment:adjust_duration_default: my_item adjusted {0}".format(my_item))
-				self.adjusted_programs.append(my_item)
-			my_count += 1
-		log.debug("OSPIWaterAdjustment:adjust_duration_positive: self.adjusted_programs {0}".format(self.adjusted_programs.append))
-		return self.adjusted_programs
+		return self.adjust_duration_scaled(1.0)
 
 	def adjust_duration_positive(self, percentage):
-		self.programs = self.program_data.get("pd")
-		my_count = 0
-		for my_item in self.programs:
-			my_duration_list = my_item[4]
-			my_default_by_position = self.base_zone_times_dict.get(my_count)
-			if my_default_by_position != None:
-				my_new_duration_by_percent = (my_default_by_position * percentage) + my_default_by_position
-				log.debug("OSPIWaterAdjustment:adjust_duration_positive: my_new_duration_by_percent {0}".format(my_new_duration_by_percent))
-				my_item[4][my_count] = int(my_new_duration_by_percent)
-				log.debug("OSPIWaterAdjustment:adjust_duration_positive: my_item after adjustment {0}".format(my_item))
-				self.adjusted_programs.append(my_item)
-			my_count += 1
-		log.debug("OSPIWaterAdjustment:adjust_duration_positive: self.adjusted_programs {0}".format(self.adjusted_programs.append))
-		return self.adjusted_programs
-			
+		return self.adjust_duration_scaled(1.0 + percentage)
+
 	def adjust_duration_negative(self, percentage):
+		return self.adjust_duration_scaled(1.0 - percentage)
+
+	def adjust_duration_scaled(self, zone_scales):
+		# zone_scales is either one scale for every zone, or a list of scales by zone position
 		self.programs = self.program_data.get("pd")
 		my_count = 0
 		for my_item in self.programs:
-			my_duration_list = my_item[4]
 			my_default_by_position = self.base_zone_times_dict.get(my_count)
 			if my_default_by_position != None:
-				my_new_duration_by_percent = (my_default_by_position * percentage) - my_default_by_position
-				log.debug("OSPIWaterAdjustment:adjust_duration_positive: my_new_duration_by_percent {0}".format(my_new_duration_by_percent))
-				my_item[4][my_count] = int(my_new_duration_by_percent)
-				log.debug("OSPIWaterAdjustment:adjust_duration_positive: my_item after adjustment {0}".format(my_item))
+				if isinstance(zone_scales, (list, tuple)):
+					my_scale = zone_scales[my_count]
+				else:
+					my_scale = zone_scales
+				my_new_duration_by_scale = max(0, int(round(my_default_by_position * my_scale)))
+				log.debug("OSPIWaterAdjustment:adjust_duration_scaled: zone {0} scale {1} duration {2}".format(my_count, my_scale, my_new_duration_by_scale))
+				my_item[4][my_count] = my_new_duration_by_scale
 				self.adjusted_programs.append(my_item)
-			
 			my_count += 1
-		log.debug("OSPIWaterAdjustment:adjust_duration_positive: self.adjusted_programs {0}".format(self.adjusted_programs.append))
+		log.debug("OSPIWaterAdjustment:adjust_duration_scaled: self.adjusted_programs {0}".format(self.adjusted_programs))
 		return self.adjusted_programs
 
 
@@ -328,16 +402,38 @@ class OSPIWeatherInformation(object):
 		for i in temperature_t:
 			if 'max' in i:
 				value = temperature_t[i]
-				string_value = str(value)
-				whole_value,not_used = string_value.split(".")
-				self.max_temp = int(whole_value)
-				log.debug('OSPIWeatherInformation:max: Max Temp {0}'.format(whole_value))
+				self.max_temp = int(value)
+				log.debug('OSPIWeatherInformation:max: Max Temp {0}'.format(self.max_temp))
+
+class OSPITransport(object):
+	"""OSPITransport - every HTTP exchange with a controller or the weather service goes through here"""
+
+	# A installed transport (see OSPICassette) can record the exchanges, or answer them itself
+	installed = None
+
+	@classmethod
+	def install(cls, transport):
+		cls.installed = transport
+
+	@classmethod
+	def exchange(cls, url, call):
+		# call() makes the real request and returns (status, body)
+		if cls.installed == None:
+			return call()
+		return cls.installed.exchange(url, call)
+
+	@classmethod
+	def offline(cls):
+		# Nothing should leave the box, a replay is running
+		return cls.installed != None and getattr(cls.installed, "offline", False)
 
 class OSPIQuery(object):
 	"""OSPIQuery - class to query the device and return it's status"""
 
-	def __init__(self):
+	def __init__(self, timeout=QUERY_TIMEOUT):
 		self._query = None
+		self.timeout = timeout
+		self.error = None
 
 	@property
 	def ospi_query(self):
@@ -351,19 +447,114 @@ class OSPIQuery(object):
 		log.debug('OSPIQuery:setter: setting query to {0}'.format(query))
 
 	def run_query(self):
+		# The query is None when the controller didn't answer, and error says why
+		my_query = self._query
+		self._query = None
+		self.error = None
 		try:
-			response = urllib2.urlopen(self._query)
-			chk = json.load(response)
+			# Waits its turn on the controller, status polls go ahead of log pulls
+			chk = OSPIRequestScheduler.for_controller(my_query).run(my_query, lambda: self.fetch(my_query))
 			log.debug('CGIQuery:run_query: chk return {0}'.format(chk))
-			response.close()
 			self._query = chk
 			log.debug('CGIQuery:run_query: query {0}'.format(self._query))
 
-		except urllib2.URLError, e:
-			log.error('CGIQuery: Could not connect to server, received error {0}. Attempted: {1}'.format(e,self._query))
+		except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+			self.error = e
+			log.error('CGIQuery: Could not connect to server, received error {0}. Attempted: {1}'.format(e,my_query))
+		except ValueError, e:
+			self.error = e
+			log.error('CGIQuery: Response was not JSON, received error {0}. Attempted: {1}'.format(e,my_query))
 		except IndexError:
 			log.error('CGIQuery: Response from CGI returned nothing. The DB probably does not know about this update')
 
+	def fetch(self, query):
+		my_status, my_body = OSPITransport.exchange(query, lambda: self.urlopen(query))
+		# The same bytes as last time aren't decoded again
+		return OSPIResponseCache.shared().decode(my_body)
+
+	def urlopen(self, query):
+		response = urllib2.urlopen(query, timeout=self.timeout)
+		try:
+			return response.getcode(), response.read()
+		finally:
+			response.close()
+
+class OSPIConnection(object):
+	"""OSPIConnection - one keep-alive HTTP connection to a controller, reused for a run of queries"""
+
+	def __init__(self, station_address, timeout=QUERY_TIMEOUT, health=None):
+		self.station_address = station_address.rstrip("/")
+		my_url = urlparse.urlsplit(station_address)
+		self.scheme = my_url.scheme or "http"
+		self.host = my_url.hostname
+		self.port = my_url.port
+		self.base_path = my_url.path.rstrip("/")
+		self.timeout = timeout
+		self.health = health
+		self.error = None
+		self.request_count = 0
+		self.connect_count = 0
+		self.scheduler = OSPIRequestScheduler.for_controller(station_address)
+		self._connection = None
+
+	def connect(self):
+		if self.scheme == "https":
+			self._connection = httplib.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+		else:
+			self._connection = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+		self.connect_count += 1
+
+	def close(self):
+		if self._connection != None:
+			self._connection.close()
+			self._connection = None
+
+	def request(self, path):
+		"""request - GET path on the controller, returns (status, body)"""
+		self.request_count += 1
+		return OSPITransport.exchange(self.station_address + path, lambda: self.send(path))
+
+	def send(self, path):
+		for my_attempt in xrange(2):
+			if self._connection == None:
+				self.connect()
+			try:
+				self._connection.request("GET", self.base_path + path, headers={"Connection": "keep-alive"})
+				my_response = self._connection.getresponse()
+				my_body = my_response.read()
+				if my_response.will_close:
+					self.close()
+				return my_response.status, my_body
+			except socket.timeout:
+				self.close()
+				raise
+			except (httplib.HTTPException, socket.error):
+				# The controller closed the kept connection, try once more on a new one
+				self.close()
+				if my_attempt:
+					raise
+
+	def query(self, path):
+		"""query - the controller's JSON answer to path, or None when it didn't answer (see error)"""
+		if self.health and not self.health.allow():
+			return None
+		self.error = None
+		my_start = time.time()
+		try:
+			my_status, my_body = self.scheduler.run(path, lambda: self.request(path))
+			if my_status != 200:
+				raise httplib.HTTPException("HTTP {0}".format(my_status))
+			my_return = OSPIResponseCache.shared().decode(my_body)
+		except (httplib.HTTPException, socket.error, ValueError), e:
+			self.error = e
+			log.error('OSPIConnection:query: {0} did not answer, received error {1}'.format(self.host, e))
+			if self.health:
+				self.health.record_failure(e)
+			return None
+		if self.health:
+			self.health.record_success(time.time() - my_start)
+		return my_return
+
 class OSPIEmail(object):
 	"""OSPIEmail - sends notifications"""
 	def __init__(self,user,passwd,sender,recipients):
@@ -373,12 +564,12 @@ class OSPIEmail(object):
 		self.recipients = recipients
 	
 	def send_email_message(self, subject, body):
-		server = smtplib.SMTP('smtp.gmail.com:587')
-		server.starttls()
+		if OSPITransport.offline():
+			log.debug('OSPIEmail:send_email_message: replaying, not sending {0}'.format(subject))
+			return
 		my_user = "{0}".format(self.user)
 		my_passwd = "{0}".format(self.passwd.decode('hex'))
-		server.login(my_user, my_passwd)
-	
+
 		message = MIMEMultipart('alternative')
 		message['From']		= self.sender
 		message['To']		= ", ".join(self.recipients)
@@ -395,8 +586,13 @@ class OSPIEmail(object):
 		message.attach(my_body)
 
 		log.debug('OSPIEmail:send_email_message: smtp variables sent {0}'.format(message))
-		server.sendmail(self.sender, self.recipients,  message.as_string())
-		server.quit()
+		# The fleet's emails go out a few at a time (see OSPIJobScheduler)
+		with OSPIJobScheduler.slot("smtp"):
+			server = smtplib.SMTP('smtp.gmail.com:587')
+			server.starttls()
+			server.login(my_user, my_passwd)
+			server.sendmail(self.sender, self.recipients,  message.as_string())
+			server.quit()
 
 class CommunicateWithDB(object):
 
@@ -455,6 +651,21 @@ class OSPIReadSettings(object):
 
 		return self.settings
 
+	def return_controllers(self):
+		# A fleet is listed under "controllers", otherwise it's the one controller in the settings
+		if not self.settings:
+			self.add_settings()
+		my_controllers = []
+		for my_controller in self.settings.get('controllers') or [{"name": "default"}]:
+			my_controller = dict(my_controller)
+			for key in CONTROLLER_SETTINGS:
+				if key not in my_controller and key in self.settings:
+					my_controller[key] = self.settings[key]
+			my_controller.setdefault('name', my_controller.get('open_sprinkler_ip'))
+			my_controllers.append(my_controller)
+		log.debug("OSPIReadSettings:return_controllers: {0} controllers".format(len(my_controllers)))
+		return my_controllers
+
 class CreateNotificationObject(object):
 
 	def __init__(self):
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPIWateringPlan.py
+
+	DESCRIPTION:
+	Work out when each zone should start so the programs finish as soon
+	as they can, without two zones of a sequential group running at once
+	and without drawing more water than the main can supply. When the
+	weather adjustment makes the runs longer, this is what keeps them
+	inside the watering window.
+
+	NOTES:
+	"watering_window" : {"start" : "04:00", "minutes" : 240} (null to leave the start times alone)
+	"flow_capacity" : null (in the units of the flow sensor, per controller too)
+	"zone_flow" : {"<controller>" : [flow of each zone]}
+	"max_parallel_zones" : null
+
+	The zones of a sequential group run one after another, the rest
+	(group 255, or no sequential bit on older firmware) can run with
+	anything. The groups come from the station names (/jn "stn_grp" or
+	"stn_seq"), or "zone_groups" : {"<controller>" : [group of each zone]}.
+
+	A zone's flow is "zone_flow", or the average from the flow history
+	(OSPIFlowHistory) while it ran. A zone we know nothing about is
+	taken to use the whole capacity, so it runs on its own.
+
+	It's a list schedule, each time a zone finishes the waiting runs
+	that fit are started, the ones in the group with the most watering
+	left first and then the longest. The lower bound (the busiest group,
+	the water over the capacity, the longest run) is kept too, so we can
+	see how far off the plan could be. A few hundred zones take a few
+	milliseconds.
+
+	The plan is made for each watering day. Programs that water on the
+	same day (weekdays, interval, odd/even, over the next few weeks) are
+	planned together, a set of programs that never shares a day with
+	another is planned on its own, from the start of the window. A
+	program that shares a day with two sets joins them into one.
+
+	A program's start time is only moved when it waters one station
+	once a day, at a fixed time: one start time, not repeating, not
+	sunrise or sunset based. Otherwise the programs that water on its
+	days are left alone. The starts are whole minutes, so the plan is
+	made in whole minutes.
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import os, logging, time, heapq
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospiwateringplan')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospiwateringplan.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CONSTANTS
+################################################################################
+# Group 255 runs in parallel with anything
+PARALLEL_GROUP = 255
+
+# Start times with these bits are sunrise or sunset based
+START_SUNRISE = 1 << 14
+START_SUNSET = 1 << 13
+
+# Program flag bits, bit 0 is enabled
+PROGRAM_ODD_EVEN = 0x0c
+PROGRAM_ODD = 0x04
+PROGRAM_EVEN = 0x08
+PROGRAM_TYPE = 0x30
+PROGRAM_WEEKLY = 0x00
+PROGRAM_MONTHLY = 0x20
+PROGRAM_INTERVAL = 0x30
+PROGRAM_FIXED_STARTS = 0x40
+
+PLAN_STEP = 60
+
+# How many days ahead the watering days are worked out, at least
+PLAN_DAYS = 28
+
+# The idle groups are kept in this many buckets by the water they need
+PLAN_BUCKETS = 32
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPIWateringPlan(object):
+	"""OSPIWateringPlan - start offsets for the runs, inside the groups and flow capacity"""
+
+	def __init__(self, capacity=None, max_parallel=None, step=PLAN_STEP, window_start=None, window_minutes=None):
+		self.capacity = capacity
+		self.max_parallel = max_parallel
+		self.step = step
+		self.window_start = window_start
+		self.window_minutes = window_minutes
+		self.groups = []
+		self.flows = []
+		self.runs = []
+		self.plan = []
+		self.makespan = 0
+		self.lower_bound = 0
+		self.elapsed = None
+		self.day_plans = []
+
+	@classmethod
+	def from_settings(cls, settings, controller):
+		"""from_settings - None when there's no "watering_window\""""
+		my_window = settings.get('watering_window')
+		if not my_window:
+			return None
+		my_hours, my_minutes = [int(my_part) for my_part in my_window.get('start', "04:00").split(":")]
+		my_capacity = controller.get('flow_capacity', settings.get('flow_capacity'))
+		return cls(my_capacity, controller.get('max_parallel_zones', settings.get('max_parallel_zones')), PLAN_STEP, (my_hours * 60) + my_minutes, my_window.get('minutes'))
+
+	################################################################################
+	# FUNCTIONS
+	################################################################################
+	@staticmethod
+	def groups_from_stations(station_names, count):
+		"""groups_from_stations - the sequential group of each station from /jn"""
+		if station_names and station_names.get("stn_grp"):
+			return list(station_names["stn_grp"])[:count] + [0] * max(0, count - len(station_names["stn_grp"]))
+		if station_names and station_names.get("stn_seq"):
+			# A bit for each station, one byte per board of 8, the sequential ones share group 0
+			my_bits = station_names["stn_seq"]
+			return [0 if (my_sid // 8) < len(my_bits) and my_bits[my_sid // 8] & (1 << (my_sid % 8)) else PARALLEL_GROUP for my_sid in xrange(count)]
+		# The firmware's default, every station is sequential
+		return [0] * count
+
+	@staticmethod
+	def flows_from_history(settings, controller, count, days=30):
+		"""flows_from_history - the average flow of each zone while it ran, None for a zone with no history"""
+		from OSPIFlowHistory import OSPIFlowHistory
+		my_flows = []
+		my_since = time.time() - (days * 86400)
+		for my_sid in xrange(count):
+			my_series = "{0}.zone{1}".format(controller, my_sid)
+			if not os.path.exists(OSPIFlowHistory.path_for(settings, my_series)):
+				my_flows.append(None)
+				continue
+			ofh = OSPIFlowHistory.from_settings(settings, my_series)
+			try:
+				my_avg = ofh.read("hour", my_since)["avg"]
+			finally:
+				ofh.close()
+			if numpy != None:
+				my_avg = my_avg[~numpy.isnan(my_avg)]
+				my_flows.append(float(my_avg.mean()) if len(my_avg) else None)
+			else:
+				my_avg = [my_value for my_value in my_avg if my_value != None]
+				my_flows.append(float(sum(my_avg)) / len(my_avg) if my_avg else None)
+		return my_flows
+
+	def add_run(self, pid, sid, duration, group=PARALLEL_GROUP, flow=None):
+		if duration > 0:
+			self.runs.append((pid, sid, duration, group, flow))
+
+	def configure(self, settings, controller, station_names, count):
+		"""configure - the group and flow of each of the controller's count stations"""
+		self.groups = settings.get('zone_groups', {}).get(controller) or self.groups_from_stations(station_names, count)
+		self.flows = settings.get('zone_flow', {}).get(controller) or self.flows_from_history(settings, controller, count)
+
+	@staticmethod
+	def runs_on(program, day):
+		"""runs_on - True when the program waters on day (a epoch day number)"""
+		my_flag, my_days0, my_days1 = program[0], program[1], program[2]
+		my_date = time.gmtime(day * 86400)
+		my_odd_even = my_flag & PROGRAM_ODD_EVEN
+		# Odd days skip the 31st and February 29th, like the firmware
+		if my_odd_even == PROGRAM_ODD and (my_date.tm_mday % 2 == 0 or my_date.tm_mday == 31 or (my_date.tm_mon == 2 and my_date.tm_mday == 29)):
+			return False
+		if my_odd_even == PROGRAM_EVEN and my_date.tm_mday % 2 != 0:
+			return False
+
+		my_type = my_flag & PROGRAM_TYPE
+		if my_type == PROGRAM_WEEKLY:
+			# Bit 0 is Monday
+			return bool(my_days0 & (1 << my_date.tm_wday))
+		if my_type == PROGRAM_INTERVAL:
+			return my_days1 > 0 and (day % my_days1) == my_days0
+		if my_type == PROGRAM_MONTHLY:
+			my_mday = my_days0 & 0x1f
+			if my_mday == 0:
+				return time.gmtime((day + 1) * 86400).tm_mday == 1
+			return my_date.tm_mday == my_mday
+		# Anything else, take it that it could run any day
+		return True
+
+	@staticmethod
+	def start_times(program):
+		"""start_times - the program's start times that are in use"""
+		if program[0] & PROGRAM_FIXED_STARTS:
+			return [my_start for my_start in program[3] if my_start >= 0]
+		# Repeating, the first start then how many repeats and how far apart
+		return program[3][:1]
+
+	def unmovable(self, program):
+		"""unmovable - why the program's start can't be moved, None when it can"""
+		my_starts = self.start_times(program)
+		if not program[0] & PROGRAM_FIXED_STARTS and len(program[3]) > 1 and program[3][1] > 0:
+			return "repeats"
+		if len(my_starts) != 1:
+			return "has {0} start times".format(len(my_starts))
+		if my_starts[0] & (START_SUNRISE | START_SUNSET):
+			return "starts at sunrise or sunset"
+		if len([my_duration for my_duration in program[4] if my_duration > 0]) > 1:
+			return "waters more than one station"
+		return None
+
+	def watering_sets(self, program_data, today=None):
+		"""watering_sets - the enabled programs in sets that share a watering day, [[pid, ...]]"""
+		if today == None:
+			today = int(time.time()) // 86400
+		my_programs = program_data.get("pd")
+		my_horizon = max([PLAN_DAYS] + [my_program[2] * 2 for my_program in my_programs if my_program[0] & PROGRAM_TYPE == PROGRAM_INTERVAL])
+		my_parent = {}
+
+		def find(my_pid):
+			while my_parent[my_pid] != my_pid:
+				my_parent[my_pid] = my_parent[my_parent[my_pid]]
+				my_pid = my_parent[my_pid]
+			return my_pid
+
+		for my_day in xrange(today, today + my_horizon):
+			my_first = None
+			for my_pid, my_program in enumerate(my_programs):
+				# Bit 0 of the flag is enabled
+				if not my_program[0] & 1 or not self.runs_on(my_program, my_day):
+					continue
+				my_parent.setdefault(my_pid, my_pid)
+				if my_first == None:
+					my_first = my_pid
+				else:
+					my_parent[find(my_pid)] = find(my_first)
+
+		my_sets = {}
+		for my_pid in sorted(my_parent):
+			my_sets.setdefault(find(my_pid), []).append(my_pid)
+		return sorted(my_sets.values())
+
+	def add_programs(self, program_data, pids=None):
+		"""add_programs - a run for every station in every enabled program (of pids)"""
+		for my_pid, my_program in enumerate(program_data.get("pd")):
+			# Bit 0 of the flag is enabled
+			if not my_program[0] & 1 or (pids != None and my_pid not in pids):
+				continue
+			for my_sid, my_duration in enumerate(my_program[4]):
+				self.add_run(my_pid, my_sid, my_duration, self.groups[my_sid] if my_sid < len(self.groups) else 0, self.flows[my_sid] if my_sid < len(self.flows) else None)
+
+	def run_flow(self, flow):
+		# Unknown, or more than the main can give, means it runs on its own
+		if self.capacity == None:
+			return 0.0
+		if flow == None or flow > self.capacity:
+			return float(self.capacity)
+		return float(flow)
+
+	def solve(self):
+		"""solve - the start of every run, returns [(start seconds, pid, sid, duration)] in start order"""
+		my_start_time = time.time()
+		my_runs = []
+		my_group_work = {}
+		for my_pid, my_sid, my_duration, my_group, my_flow in self.runs:
+			# Whole steps, so the starts can be written as minutes without overlapping
+			my_steps = -(-my_duration // self.step) * self.step
+			my_key = my_group if my_group != PARALLEL_GROUP else ("run", len(my_runs))
+			my_runs.append([my_pid, my_sid, my_duration, my_key, self.run_flow(my_flow), my_steps])
+			my_group_work[my_key] = my_group_work.get(my_key, 0) + my_steps
+
+		my_bounds = [max(my_group_work.values()) if my_group_work else 0]
+		if self.capacity:
+			my_bounds.append(sum(my_run[4] * my_run[5] for my_run in my_runs) / float(self.capacity))
+		if self.max_parallel:
+			my_bounds.append(sum(my_run[5] for my_run in my_runs) / float(self.max_parallel))
+		self.lower_bound = int(-(-max(my_bounds) // self.step) * self.step)
+
+		# Each group's runs, longest last so it's the next off the end
+		my_queues = {}
+		for my_run in sorted(my_runs, key=lambda my_run: (my_run[5], -my_run[1])):
+			my_queues.setdefault(my_run[3], []).append(my_run)
+		# The idle groups with runs waiting, in buckets by the least water
+		# their runs need and most work left first in each. A group's place
+		# only changes when it starts a run, so heaps will do
+		my_buckets = [[] for my_count in xrange(PLAN_BUCKETS if self.capacity else 1)]
+		for my_key in my_queues:
+			self.push_idle(my_buckets, my_group_work, my_key, my_queues[my_key])
+
+		my_waiting = len(my_runs)
+		my_running = []
+		my_flow = 0.0
+		my_now = 0
+		my_plan = []
+		while my_waiting:
+			while not self.max_parallel or len(my_running) < self.max_parallel:
+				my_left = self.capacity - my_flow if self.capacity and my_running else None
+				my_bucket = self.best_bucket(my_buckets, my_left)
+				if my_bucket == None:
+					break
+				my_entry = heapq.heappop(my_bucket)
+				my_queue = my_queues[my_entry[3]]
+				my_index = len(my_queue) - 1
+				if my_left != None:
+					# The longest of the group's runs that fits in the water left
+					while my_queue[my_index][4] > my_left + 1e-9:
+						my_index -= 1
+				my_run = my_queue.pop(my_index)
+				my_flow += my_run[4]
+				my_group_work[my_run[3]] -= my_run[5]
+				heapq.heappush(my_running, (my_now + my_run[5], my_run[1], my_run))
+				my_plan.append((my_now, my_run[0], my_run[1], my_run[2]))
+				my_waiting -= 1
+
+			if not my_waiting:
+				break
+			if not my_running:
+				raise ValueError("nothing can start, check the capacity and groups")
+
+			# On to the next run finishing, everything finishing then frees up together
+			my_now = my_running[0][0]
+			while my_running and my_running[0][0] == my_now:
+				my_end, my_sid, my_run = heapq.heappop(my_running)
+				my_flow -= my_run[4]
+				if my_queues[my_run[3]]:
+					self.push_idle(my_buckets, my_group_work, my_run[3], my_queues[my_run[3]])
+
+		self.makespan = max([my_end for my_end, my_sid, my_run in my_running] + [my_now])
+		self.plan = my_plan
+		self.elapsed = time.time() - my_start_time
+		log.debug("OSPIWateringPlan:solve: {0} runs in {1}s (lower bound {2}s), solved in {3:.4f}s".format(len(my_plan), self.makespan, self.lower_bound, self.elapsed))
+		return self.plan
+
+	def push_idle(self, buckets, group_work, key, queue):
+		my_least = min(my_run[4] for my_run in queue)
+		my_bucket = min(len(buckets) - 1, int(my_least * len(buckets) / self.capacity)) if self.capacity else 0
+		heapq.heappush(buckets[my_bucket], (-group_work[key], -queue[-1][5], queue[-1][1], key, my_least))
+
+	def best_bucket(self, buckets, left):
+		"""best_bucket - the bucket whose first group goes next, None when nothing fits in left"""
+		my_best = None
+		for my_count, my_bucket in enumerate(buckets):
+			if left != None and my_count * self.capacity > (left + 1e-9) * len(buckets):
+				break
+			# The group at the front of the bucket on the edge may still need too much
+			if my_bucket and (left == None or my_bucket[0][4] <= left + 1e-9) and (my_best == None or my_bucket[0] < my_best[0]):
+				my_best = my_bucket
+		return my_best
+
+	def schedule(self, program_data, today=None):
+		"""schedule - plan the programs that water on the same days together and move their start times, True when any were moved"""
+		my_moved = False
+		my_makespan = 0
+		self.day_plans = []
+		for my_pids in self.watering_sets(program_data, today):
+			self.runs = []
+			self.add_programs(program_data, my_pids)
+			self.solve()
+			my_makespan = max(my_makespan, self.makespan)
+			self.day_plans.append((my_pids, self.makespan, self.plan))
+			if not self.fits():
+				log.error("OSPIWateringPlan:schedule: programs {0} take {1} minutes, {2} more than the window".format(my_pids, self.makespan // 60, (self.makespan // 60) - self.window_minutes))
+			my_moved = self.apply(program_data) or my_moved
+		# What fits() and the callers look at is the longest watering day
+		self.makespan = my_makespan
+		self.plan = [my_entry for my_pids, my_span, my_plan in self.day_plans for my_entry in my_plan]
+		return my_moved
+
+	def fits(self):
+		return self.window_minutes == None or self.makespan <= self.window_minutes * 60
+
+	def apply(self, program_data):
+		"""apply - move each program in the plan to its start time, False when they can't all be moved"""
+		if self.window_start == None:
+			return False
+		my_starts = {}
+		my_programs = program_data.get("pd")
+		for my_start, my_pid, my_sid, my_duration in self.plan:
+			my_reason = "waters more than one station" if my_pid in my_starts else self.unmovable(my_programs[my_pid])
+			if my_reason != None:
+				log.error("OSPIWateringPlan:apply: program {0} {1}, leaving the start times of the programs it shares days with alone".format(my_pid, my_reason))
+				return False
+			my_starts[my_pid] = my_start
+
+		for my_pid, my_start in my_starts.iteritems():
+			# The one start time in use, a fixed list can have it in any place
+			my_program_starts = my_programs[my_pid][3]
+			my_index = my_program_starts.index(self.start_times(my_programs[my_pid])[0])
+			my_program_starts[my_index] = (self.window_start + (my_start // 60)) % 1440
+		log.debug("OSPIWateringPlan:apply: moved {0} programs, done {1} minutes after {2}".format(len(my_starts), self.makespan // 60, self.window_start))
+		return True
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPIWeatherBatch.py
+
+	DESCRIPTION:
+	Fetch the weather for a whole fleet of controllers. Controllers are
+	grouped into lat/long grid cells, and each cell gets one forecast
+	request which is shared by every controller in it.
+
+	NOTES:
+	The forecast is pulled straight from the OpenWeatherMap daily forecast
+	API so the base url can point at a local stand-in weather server.
+	"weather_api_url" : "http://api.openweathermap.org/data/2.5"
+	"weather_cell_size" : 0.25 (degrees)
+	"weather_max_workers" : 4
+
+	Controllers with no "weather_latlong" are grouped by "weather_location".
+	A controller with neither gets no forecast (it's skipped, not fetched).
+
+	fetch_all hands back the models keyed by controller_key, the
+	controller's host and location, since two entries in "controllers"
+	can have the same name (or none).
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import logging, urllib, urllib2, json, math, threading, Queue, socket
+from OSPIWeatherModel import OSPIWeatherModel, FORECAST_COLUMNS
+from OSPIUtility import OSPITransport
+from OSPIJobScheduler import OSPIJobScheduler
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospiweatherbatch')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospiweatherbatch.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CONSTANTS
+################################################################################
+OWM_API_URL = "http://api.openweathermap.org/data/2.5"
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPIWeatherBatch(object):
+	"""OSPIWeatherBatch - one forecast request per grid cell, shared by the controllers in it"""
+
+	def __init__(self, api_key, cell_size=0.25, max_workers=4, api_url=OWM_API_URL, cache_dir="/tmp", horizon=7, timeout=30):
+		self.api_key = api_key
+		self.cell_size = cell_size
+		self.max_workers = max_workers
+		self.api_url = api_url
+		self.cache_dir = cache_dir
+		self.horizon = horizon
+		self.timeout = timeout
+		self.fetch_count = 0
+		self._lock = threading.Lock()
+
+	@classmethod
+	def from_settings(cls, settings):
+		return cls(settings['open_weather_api'], settings.get('weather_cell_size', 0.25), settings.get('weather_max_workers', 4), settings.get('weather_api_url', OWM_API_URL), settings.get('weather_cache_dir', "/tmp"), settings.get('weather_horizon', 7))
+
+	def cell_for(self, controller):
+		# The cell is the grid square the controller sits in, or its city when there's no lat/long
+		my_latlong = controller.get('weather_latlong')
+		if not my_latlong:
+			return ('location', controller.get('weather_location'))
+		my_lat, my_lon = [float(my_value) for my_value in my_latlong.split(",")]
+		return (int(math.floor(my_lat / self.cell_size)), int(math.floor(my_lon / self.cell_size)))
+
+	@staticmethod
+	def controller_key(controller):
+		return (controller.get('open_sprinkler_ip'), controller.get('weather_latlong') or controller.get('weather_location'))
+
+	def group_controllers(self, controllers):
+		my_cells = {}
+		for my_controller in controllers:
+			my_cell = self.cell_for(my_controller)
+			if my_cell == ('location', None):
+				log.error("OSPIWeatherBatch:group_controllers: {0} has no weather_location or weather_latlong, skipping".format(my_controller.get('name')))
+				continue
+			my_cells.setdefault(my_cell, []).append(my_controller)
+		log.debug("OSPIWeatherBatch:group_controllers: {0} controllers in {1} cells".format(len(controllers), len(my_cells)))
+		return my_cells
+
+	def model_for_cell(self, cell):
+		# Every controller in a cell uses the forecast for the middle of the cell
+		if cell[0] == 'location':
+			return OSPIWeatherModel(self.api_key, cell[1], None, self.cache_dir, self.horizon)
+		my_lat = (cell[0] + 0.5) * self.cell_size
+		my_lon = (cell[1] + 0.5) * self.cell_size
+		return OSPIWeatherModel(self.api_key, None, "{0},{1}".format(my_lat, my_lon), self.cache_dir, self.horizon)
+
+	def fetch_forecast(self, model):
+		my_params = {'cnt': self.horizon, 'units': 'metric', 'APPID': self.api_key}
+		if model.latitude != None:
+			my_params['lat'] = model.latitude
+			my_params['lon'] = model.longitude
+		else:
+			my_params['q'] = model.location
+		my_url = "{0}/forecast/daily?{1}".format(self.api_url, urllib.urlencode(my_params))
+
+		try:
+			with OSPIJobScheduler.slot("weather"):
+				my_status, my_body = OSPITransport.exchange(my_url, lambda: self.urlopen(my_url))
+			my_return = json.loads(my_body)
+		except (urllib2.URLError, socket.error, ValueError), e:
+			log.error("OSPIWeatherBatch:fetch_forecast: could not reach the weather service, received error {0}".format(e))
+			return None
+		with self._lock:
+			self.fetch_count += 1
+
+		if model.latitude == None:
+			model.latitude = my_return["city"]["coord"]["lat"]
+
+		my_columns = dict((my_column, []) for my_column in FORECAST_COLUMNS)
+		for my_day in my_return["list"]:
+			my_columns["dt"].append(my_day["dt"])
+			my_columns["tmin"].append(my_day["temp"]["min"])
+			my_columns["tmax"].append(my_day["temp"]["max"])
+			my_columns["humidity"].append(my_day.get("humidity", 0))
+			my_columns["rain"].append(my_day.get("rain", 0.0))
+		log.debug("OSPIWeatherBatch:fetch_forecast: {0} days for {1},{2} {3}".format(len(my_return["list"]), model.latitude, model.longitude, model.location))
+		return my_columns
+
+	def urlopen(self, url):
+		response = urllib2.urlopen(url, timeout=self.timeout)
+		try:
+			return response.getcode(), response.read()
+		finally:
+			response.close()
+
+	def fetch_all(self, controllers):
+		"""fetch_all - returns a dict of controller_key to the shared OSPIWeatherModel, or None when the cell failed"""
+		my_cells = self.group_controllers(controllers)
+		my_models = {}
+		my_queue = Queue.Queue()
+		for my_cell in my_cells:
+			my_queue.put(my_cell)
+
+		def worker():
+			while True:
+				try:
+					my_cell = my_queue.get_nowait()
+				except Queue.Empty:
+					return
+				my_model = self.model_for_cell(my_cell)
+				try:
+					my_loaded = my_model.load_forecast(lambda: self.fetch_forecast(my_model))
+				except Exception, e:
+					log.error("OSPIWeatherBatch:fetch_all: cell {0} failed, received error {1}".format(my_cell, e))
+					my_loaded = False
+				with self._lock:
+					my_models[my_cell] = my_model if my_loaded else None
+
+		# Bounded concurrency, never more than max_workers requests in flight
+		my_threads = []
+		for my_count in xrange(min(self.max_workers, len(my_cells))):
+			my_thread = threading.Thread(target=worker)
+			my_thread.daemon = True
+			my_thread.start()
+			my_threads.append(my_thread)
+		for my_thread in my_threads:
+			my_thread.join()
+
+		my_shared = {}
+		for my_cell, my_controllers in my_cells.iteritems():
+			for my_controller in my_controllers:
+				my_shared[self.controller_key(my_controller)] = my_models.get(my_cell)
+		log.debug("OSPIWeatherBatch:fetch_all: {0} forecast requests for {1} controllers".format(self.fetch_count, len(controllers)))
+		return my_shared
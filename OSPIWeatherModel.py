@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	OSPIWeatherModel.py
+
+	DESCRIPTION:
+	A weather model that pulls the daily forecast once, works out the
+	reference evapotranspiration (ET) and rain offsets for every day in
+	the forecast, and turns that into a water budget for each zone.
+
+	NOTES:
+	ET uses the Hargreaves equation (FAO-56, eq. 52), it only needs the
+	min and max temperature and the latitude, which is what the daily
+	forecast gives us. The math is done on numpy arrays across the whole
+	forecast horizon.
+
+	The forecast is cached once per location per day, so every controller
+	at the same location shares one forecast call.
+	/tmp/ospi_weather_<location>_<YYYYMMDD>.json
+
+	A model with no "weather_location" or "weather_latlong" has nothing
+	to ask for, load_forecast says so and returns False. A day the
+	forecast has no min or max temperature for is NaN in the arrays and
+	masked, forecast_for and zone_water_budget return None for it, same
+	as no forecast at all.
+
+	HISTORY:
+	06/19/17 -RH
+	Initial developtment
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import os, logging, json, time, re, pyowm
+import numpy
+
+################################################################################
+# LOGGING
+################################################################################
+log = logging.getLogger('ospiweathermodel')
+log.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+logger1 = logging.FileHandler('/tmp/ospiweathermodel.log')
+logger1.setLevel(logging.DEBUG)
+logger1.setFormatter(formatter)
+log.addHandler(logger1)
+
+################################################################################
+# CONSTANTS
+################################################################################
+SOLAR_CONSTANT = 0.0820		# MJ m-2 min-1
+RADIATION_TO_MM = 0.408		# MJ m-2 day-1 to mm day-1 of evaporation
+FORECAST_COLUMNS = ["dt", "tmin", "tmax", "humidity", "rain"]
+
+################################################################################
+# CLASSES
+################################################################################
+
+class OSPIWeatherModel(object):
+	"""OSPIWeatherModel - forecast, evapotranspiration and water budget for one location"""
+
+	def __init__(self, api_key, location=None, latlong=None, cache_dir="/tmp", horizon=7):
+		self.api_key = api_key
+		self.location = location
+		self.latitude = None
+		self.longitude = None
+		if latlong:
+			my_lat, my_lon = latlong.split(",")
+			self.latitude = float(my_lat)
+			self.longitude = float(my_lon)
+		self.cache_dir = cache_dir
+		self.horizon = horizon
+		self._forecast = None
+		self._et = None
+		self._valid = None
+
+	@classmethod
+	def from_settings(cls, settings):
+		return cls(settings['open_weather_api'], settings.get('weather_location'), settings.get('weather_latlong'), settings.get('weather_cache_dir', "/tmp"), settings.get('weather_horizon', 7))
+
+	################################################################################
+	# PROPERTIES
+	################################################################################
+	@property
+	def cache_path(self):
+		if self.latitude != None:
+			my_key = "{0:.4f}_{1:.4f}".format(self.latitude, self.longitude)
+		elif self.location:
+			my_key = self.location
+		else:
+			return None
+		my_key = re.sub(r'[^A-Za-z0-9.\-]+', '_', my_key)
+		my_day = time.strftime('%Y%m%d')
+		return os.path.join(self.cache_dir, "ospi_weather_{0}_{1}.json".format(my_key, my_day))
+
+	@property
+	def forecast(self):
+		return self._forecast
+
+	@property
+	def et(self):
+		log.debug("OSPIWeatherModel:et: {0}".format(self._et))
+		return self._et
+
+	################################################################################
+	# FUNCTIONS
+	################################################################################
+	def load_forecast(self, fetcher=None):
+		# Today's forecast for this location may already be cached by another controller
+		my_path = self.cache_path
+		if my_path == None:
+			log.error("OSPIWeatherModel:load_forecast: no weather_location or weather_latlong, no forecast")
+			return False
+		if os.path.exists(my_path):
+			my_json_file = open(my_path, 'r')
+			my_cached = json.load(my_json_file)
+			my_json_file.close()
+			log.debug("OSPIWeatherModel:load_forecast: using cached forecast {0}".format(my_path))
+			self.set_forecast(my_cached["forecast"], my_cached.get("latitude"))
+			return True
+
+		# The batch fetch hands in its own fetcher, otherwise we ask OWM directly
+		my_columns = (fetcher or self.fetch_forecast)()
+		if my_columns == None:
+			return False
+
+		my_tmp_path = "{0}.{1}".format(my_path, os.getpid())
+		my_json_file = open(my_tmp_path, 'w')
+		json.dump({"forecast": my_columns, "latitude": self.latitude}, my_json_file)
+		my_json_file.close()
+		os.rename(my_tmp_path, my_path)
+		log.debug("OSPIWeatherModel:load_forecast: cached forecast to {0}".format(my_path))
+
+		self.set_forecast(my_columns, self.latitude)
+		return True
+
+	def fetch_forecast(self):
+		owm = pyowm.OWM(self.api_key)
+
+		# OWM is not available
+		if not owm.is_API_online():
+			log.debug("OSPIWeatherModel:fetch_forecast: OWM is not available, returning None type")
+			return None
+
+		if self.latitude != None:
+			fc = owm.daily_forecast_at_coords(self.latitude, self.longitude, limit=self.horizon)
+		else:
+			fc = owm.daily_forecast(self.location, limit=self.horizon)
+			self.latitude = fc.get_forecast().get_location().get_lat()
+		log.debug("OSPIWeatherModel:fetch_forecast: {0} {1}".format(self.location, self.latitude))
+
+		my_columns = dict((my_column, []) for my_column in FORECAST_COLUMNS)
+		for my_weather in fc.get_forecast().get_weathers():
+			my_temperature = my_weather.get_temperature("celsius")
+			my_columns["dt"].append(my_weather.get_reference_time())
+			my_columns["tmin"].append(my_temperature.get("min"))
+			my_columns["tmax"].append(my_temperature.get("max"))
+			my_columns["humidity"].append(my_weather.get_humidity())
+			my_columns["rain"].append(my_weather.get_rain().get("all", 0.0))
+		return my_columns
+
+	def set_forecast(self, columns, latitude=None):
+		# Forecast columns are plain lists, one entry per forecast day
+		if latitude != None:
+			self.latitude = latitude
+		self._forecast = {}
+		for my_column in FORECAST_COLUMNS:
+			# A day the service left a value out of is NaN
+			self._forecast[my_column] = numpy.asarray([numpy.nan if my_value == None else my_value for my_value in columns[my_column]], dtype=numpy.float64)
+		self._et = self.compute_et()
+		# The days with both temperatures, the rest have no ET
+		self._valid = numpy.isfinite(self._forecast["tmin"]) & numpy.isfinite(self._forecast["tmax"])
+		if not self._valid.all():
+			log.error("OSPIWeatherModel:set_forecast: no temperatures for days {0}, masked".format(numpy.flatnonzero(~self._valid).tolist()))
+		self._et = numpy.ma.masked_array(self._et, ~self._valid)
+
+	def compute_et(self):
+		# Hargreaves reference ET for every day in the horizon at once
+		my_tmin = self._forecast["tmin"]
+		my_tmax = self._forecast["tmax"]
+		my_day_of_year = numpy.array([time.gmtime(my_dt).tm_yday for my_dt in self._forecast["dt"]], dtype=numpy.float64)
+
+		my_phi = numpy.radians(self.latitude)
+		my_dr = 1 + 0.033 * numpy.cos(2 * numpy.pi * my_day_of_year / 365)
+		my_delta = 0.409 * numpy.sin((2 * numpy.pi * my_day_of_year / 365) - 1.39)
+		my_ws = numpy.arccos(numpy.clip(-numpy.tan(my_phi) * numpy.tan(my_delta), -1.0, 1.0))
+		my_ra = (24 * 60 / numpy.pi) * SOLAR_CONSTANT * my_dr * ((my_ws * numpy.sin(my_phi) * numpy.sin(my_delta)) + (numpy.cos(my_phi) * numpy.cos(my_delta) * numpy.sin(my_ws)))
+
+		my_tmean = (my_tmin + my_tmax) / 2
+		my_et = 0.0023 * RADIATION_TO_MM * my_ra * (my_tmean + 17.8) * numpy.sqrt(numpy.maximum(my_tmax - my_tmin, 0))
+		log.debug("OSPIWeatherModel:compute_et: {0}".format(my_et))
+		return my_et
+
+	def rain_offsets(self, efficiency=0.8):
+		# Only part of the forecast rain makes it into the root zone, no rain in the forecast is none
+		return numpy.nan_to_num(self._forecast["rain"]) * efficiency
+
+	def forecast_for(self, day=1):
+		# The forecast inputs the adjustment policies use, tomorrow by default
+		if self._forecast == None or day >= len(self._forecast["dt"]) or not self._valid[day]:
+			return None
+		my_forecast = {
+			"max_temp": int(self._forecast["tmax"][day] * 9 / 5 + 32),
+			"humidity": float(self._forecast["humidity"][day]),
+			"rain": float(self._forecast["rain"][day]),
+			"et": float(self._et[day]),
+		}
+		log.debug("OSPIWeatherModel:forecast_for: day {0} {1}".format(day, my_forecast))
+		return my_forecast
+
+	def zone_water_budget(self, zone_count, crop_coefficients=None, baseline_et=5.0, efficiency=0.8, day=1, limits=(0.0, 2.0)):
+		# Net water need for the day scaled by each zone's crop coefficient,
+		# relative to the ET the default zone times were set up for
+		if self._forecast == None or day >= len(self._forecast["dt"]) or not self._valid[day]:
+			return None
+		my_net = max(float(self._et[day]) - self.rain_offsets(efficiency)[day], 0.0)
+		my_kc = numpy.ones(zone_count)
+		for my_zone, my_coefficient in (crop_coefficients or {}).iteritems():
+			if int(my_zone) < zone_count:
+				my_kc[int(my_zone)] = my_coefficient
+		my_budget = numpy.clip(my_kc * my_net / baseline_et, limits[0], limits[1])
+		log.debug("OSPIWeatherModel:zone_water_budget: net {0} budget {1}".format(my_net, my_budget))
+		return my_budget.tolist()